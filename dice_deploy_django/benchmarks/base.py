@@ -0,0 +1,31 @@
+from __future__ import print_function
+
+import timeit
+
+"""
+Helpers for benchmarks.
+
+Benchmarks are regular Django test cases that live in modules named
+bench_*.py, which means that default test discovery skips them. Run them
+using "./run.sh bench".
+"""
+
+
+def measure(func, repeat=5, number=1):
+    """
+    Run func repeat times (each run calls func number times) and return the
+    list of durations in seconds.
+    """
+    return timeit.repeat(func, repeat=repeat, number=number)
+
+
+def report(name, durations, **extra):
+    """
+    Print a single line summary of measured durations.
+    """
+    fields = [
+        "best={:.4f}s".format(min(durations)),
+        "mean={:.4f}s".format(sum(durations) / len(durations)),
+    ]
+    fields.extend("{}={}".format(k, v) for k, v in sorted(extra.items()))
+    print("\n[bench] {}: {}".format(name, ", ".join(fields)))
@@ -0,0 +1,142 @@
+from .base import measure, report
+
+from cfy_wrapper.tests.base import BaseTest
+from cfy_wrapper import utils
+
+import multiprocessing
+import tarfile
+import shutil
+import os
+
+
+def change_permissions(root, folder_permissions, file_permissions):
+    """
+    Recursively change permissions of root and everything below it, as
+    utils.change_permissions used to do after extraction.
+    """
+    for prefix, folders, files in os.walk(root, topdown=False):
+        for file in files:
+            os.chmod(os.path.join(prefix, file), file_permissions)
+        for folder in folders:
+            os.chmod(os.path.join(prefix, folder), folder_permissions)
+    os.chmod(root, folder_permissions)
+
+
+def extract_archive_two_pass(archive, destination):
+    """
+    Extraction that used to be done by utils.extract_archive: read complete
+    member index, extract members and then walk the tree to set permissions.
+    """
+    with tarfile.open(fileobj=archive) as tar:
+        members = []
+        for member in tar.getmembers():
+            path = os.path.normpath(member.name).split(os.sep)
+            member.name = os.sep.join(path[1:])
+            members.append(member)
+        for member in members:
+            tar.extract(member, destination)
+        change_permissions(destination, utils.FOLDER_PERMISSIONS,
+                           utils.FILE_PERMISSIONS)
+    return True, "All OK"
+
+
+class ArchiveExtractionBenchmark(BaseTest):
+
+    SMALL_FILES = 10000
+    SMALL_FILES_PER_FOLDER = 100
+    HUGE_FILES = 3
+    HUGE_FILE_SIZE = 64 * 1024 ** 2
+
+    def _create_archive(self, name, files):
+        archive = self.wd.getpath(name + ".tar.gz")
+        with tarfile.open(archive, "w:gz", compresslevel=1) as tar:
+            tar.add(self.wd.getpath(name), arcname="toplevel")
+        shutil.rmtree(self.wd.getpath(name))
+        return archive, os.path.getsize(archive), files
+
+    def _small_files(self):
+        for i in range(self.SMALL_FILES):
+            folder = "f{}".format(i // self.SMALL_FILES_PER_FOLDER)
+            self.wd.write(("small", folder, "{}.sh".format(i)), b"echo x\n")
+        return self._create_archive("small", self.SMALL_FILES)
+
+    def _huge_files(self):
+        chunk = os.urandom(1024 ** 2)
+        self.wd.makedir(("huge", "data"))
+        for i in range(self.HUGE_FILES):
+            path = self.wd.getpath(("huge", "data", "{}.bin".format(i)))
+            with open(path, "wb") as f:
+                for _ in range(self.HUGE_FILE_SIZE // len(chunk)):
+                    f.write(chunk)
+        return self._create_archive("huge", self.HUGE_FILES)
+
+    def _run(self, name, extract, archive, size, files):
+        destinations = []
+
+        def run():
+            # Each run extracts into fresh folder, since removing previous
+            # results would dominate the measurement.
+            folder = "result-{}".format(len(destinations))
+            destination = self.wd.getpath(folder)
+            destinations.append(destination)
+            os.mkdir(destination)
+            with open(archive, "rb") as f:
+                self.assertTrue(extract(f, destination)[0])
+
+        durations = measure(run, repeat=3)
+        for destination in destinations:
+            shutil.rmtree(destination)
+        report(name, durations, files=files, archive_bytes=size)
+
+    def test_small_files(self):
+        archive = self._small_files()
+        self._run("extract small files (two pass)",
+                  extract_archive_two_pass, *archive)
+        self._run("extract small files (streaming)",
+                  utils.extract_archive, *archive)
+
+    def test_huge_files(self):
+        archive = self._huge_files()
+        self._run("extract huge files (two pass)",
+                  extract_archive_two_pass, *archive)
+        self._run("extract huge files (streaming)",
+                  utils.extract_archive, *archive)
+
+
+class ArchiveCreationBenchmark(BaseTest):
+
+    FILES = 4
+    FILE_SIZE = 16 * 1024 ** 2
+
+    def setUp(self):
+        super(ArchiveCreationBenchmark, self).setUp()
+        # Repeated text compresses about as well as typical blueprint content
+        chunk = b"".join(
+            "{} {}\n".format(i, os.urandom(8).encode("hex")).encode("ascii")
+            for i in range(32 * 1024)
+        )
+        self.wd.makedir("content")
+        for i in range(self.FILES):
+            path = self.wd.getpath(("content", "{}.txt".format(i)))
+            with open(path, "wb") as f:
+                while f.tell() < self.FILE_SIZE:
+                    f.write(chunk)
+
+    def _run(self, level, threads):
+        archive = self.wd.getpath("content.tar.gz")
+
+        def run():
+            utils.create_archive(archive, self.wd.getpath("content"),
+                                 level=level, threads=threads)
+
+        durations = measure(run, repeat=3)
+        name = "create archive (level {}, {} thread(s))".format(level, threads)
+        report(name, durations, archive_bytes=os.path.getsize(archive))
+
+    def test_levels(self):
+        for level in (0, 1, 6, 9):
+            self._run(level, 1)
+
+    def test_threads(self):
+        for threads in (1, 2, 4, multiprocessing.cpu_count()):
+            self._run(6, threads)
@@ -0,0 +1,56 @@
+from .base import measure, report
+
+from cfy_wrapper.tests.base import BaseViewTest
+from cfy_wrapper.models import Blueprint
+from cfy_wrapper.views import BlueprintsView
+
+from django.core.urlresolvers import reverse
+from django.db.models.signals import post_init
+
+import mock
+import os
+
+
+def create_blueprint_folder(instance, **_):
+    """
+    Folder creation that used to be executed on each blueprint instantiation.
+    Receiver is connected without sender, since querysets that defer fields
+    instantiate deferred subclasses of Blueprint.
+    """
+    if not isinstance(instance, Blueprint):
+        return
+    if not os.path.isdir(instance.content_folder):
+        os.mkdir(instance.content_folder)
+
+
+class BlueprintListBenchmark(BaseViewTest):
+
+    BLUEPRINTS = 5000
+
+    def setUp(self):
+        super(BlueprintListBenchmark, self).setUp()
+        Blueprint.objects.bulk_create(
+            Blueprint() for _ in range(self.BLUEPRINTS)
+        )
+
+    def _list(self):
+        req = self.get(reverse("blueprints"), auth=True)
+        resp = BlueprintsView.as_view()(req)
+        self.assertEqual(self.BLUEPRINTS, len(resp.data))
+
+    def _run(self, name):
+        durations = measure(self._list)
+        with mock.patch("os.path.isdir", wraps=os.path.isdir) as isdir:
+            self._list()
+        report(name, durations, blueprints=self.BLUEPRINTS,
+               stat_calls=isdir.call_count)
+
+    def test_list_with_post_init_folder_creation(self):
+        post_init.connect(create_blueprint_folder,
+                          dispatch_uid="bench_create_blueprint_folder")
+        self.addCleanup(post_init.disconnect,
+                        dispatch_uid="bench_create_blueprint_folder")
+        self._run("blueprint list (post_init folder creation)")
+
+    def test_list(self):
+        self._run("blueprint list")
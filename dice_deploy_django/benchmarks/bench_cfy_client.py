@@ -0,0 +1,180 @@
+from .base import measure, report
+
+from cfy_wrapper.tests.base import BaseTest
+from cfy_wrapper.models import Blueprint, Container, PublishedBlueprint
+from cfy_wrapper import tasks, utils
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from celery import chain
+from cloudify_rest_client.client import CloudifyClient
+from django.test import override_settings
+
+import collections
+import threading
+import base64
+import json
+import mock
+
+"""
+Benchmark that counts connections opened against Cloudify manager during a
+single deploy pipeline. Manager is replaced by a minimal local HTTP server
+that knows just enough of the REST API to get the pipeline through.
+"""
+
+BLUEPRINT = b"""
+tosca_definitions_version: cloudify_dsl_1_3
+node_types:
+  test.Node: {}
+node_templates:
+  node:
+    type: test.Node
+"""
+# Number of status polls before each execution terminates
+EXECUTION_POLLS = 3
+
+
+def get_cfy_client():
+    """
+    Client factory that used to create new client on each call.
+    """
+    creds = "{}:{}".format("username", "password")
+    creds_enc = base64.urlsafe_b64encode(creds.encode("utf-8"))
+    headers = {"Authorization": "Basic {}".format(creds_enc)}
+    return CloudifyClient(host="127.0.0.1", headers=headers)
+
+
+class StandInManager(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+        self.connections = 0
+        self.polls = collections.Counter()
+        self.lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+        ThreadingMixIn.process_request(self, request, client_address)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    # Send each response in one piece, like real web servers do, or else
+    # keep-alive connections suffer from delayed ACKs.
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            size = int(self.rfile.readline().strip(), 16)
+            while size > 0:
+                self.rfile.read(size + 2)
+                size = int(self.rfile.readline().strip(), 16)
+            self.rfile.readline()
+        else:
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _reply(self, code, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _reply_list(self, items):
+        self._reply(200, {
+            "items": items,
+            "metadata": {"pagination": {"total": len(items),
+                                        "size": len(items), "offset": 0}},
+        })
+
+    def do_PUT(self):
+        self._read_body()
+        self._reply(201, {"id": self.path.split("?")[0].split("/")[-1]})
+
+    def do_POST(self):
+        self._read_body()
+        self._reply(201, {"id": "install", "status": "pending"})
+
+    def do_GET(self):
+        parts = self.path.split("?")[0].split("/")[3:]
+        if parts == ["executions"]:
+            self._reply_list([{"id": "create", "status": "pending"}])
+        elif parts == ["nodes"]:
+            self._reply_list([{"id": "node", "type": "test.Node"}])
+        elif parts == ["node-instances"]:
+            self._reply_list([{
+                "id": "node_1", "node_id": "node", "host_id": "node_1",
+                "runtime_properties": {"ip": "127.0.0.1"},
+            }])
+        elif parts[0] == "executions":
+            with self.server.lock:
+                self.server.polls[parts[1]] += 1
+                polls = self.server.polls[parts[1]]
+            if polls % EXECUTION_POLLS != 0:
+                status = "started"
+            else:
+                status = "terminated"
+            self._reply(200, {"id": parts[1], "status": status})
+        else:
+            self._reply(200, {"id": parts[1], "outputs": {}})
+
+
+@override_settings(CFY_MANAGER_URL="127.0.0.1", EXECUTION_WAIT_MODE="sleep",
+                   POOL_SLEEP_INTERVAL=0)
+class DeployPipelineBenchmark(BaseTest):
+
+    def setUp(self):
+        super(DeployPipelineBenchmark, self).setUp()
+        mock.patch.object(tasks, "logger").start()
+
+        self.manager = StandInManager()
+        thread = threading.Thread(target=self.manager.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.manager.server_close)
+        self.addCleanup(self.manager.shutdown)
+        self.addCleanup(self._close_sessions)
+        mock.patch("cloudify_rest_client.client.DEFAULT_PORT",
+                   self.manager.server_port).start()
+
+    @staticmethod
+    def _close_sessions():
+        for client in utils._cfy_clients.values():
+            client._client.session.close()
+
+    def _deploy(self):
+        b = Blueprint.objects.create()
+        self.wd.write("blueprint.yaml", BLUEPRINT)
+        with open(self.wd.getpath("blueprint.yaml")) as f:
+            b.store_content(f)
+        c = Container.objects.create(queue=b)
+        pipe = [tasks.process_container_queue.si(c.cfy_id)]
+        pipe.extend(tasks._get_deploy_pipe(c, False))
+        chain(*pipe).apply_async()
+        b.refresh_from_db()
+        self.assertEqual(Blueprint.State.deployed, b.state)
+        # Make sure that next deploy uploads blueprint again
+        PublishedBlueprint.objects.all().delete()
+
+    def _run(self, name):
+        self._deploy()  # Warm up parser and client
+        self.manager.connections = 0
+        durations = measure(self._deploy)
+        report(name, durations,
+               connections_per_deploy=self.manager.connections /
+               float(len(durations)))
+
+    def test_deploy_new_client_per_call(self):
+        with mock.patch.object(utils, "get_cfy_client", get_cfy_client):
+            self._run("deploy pipeline (new client per call)")
+
+    def test_deploy_pooled_client(self):
+        self._run("deploy pipeline (pooled client)")
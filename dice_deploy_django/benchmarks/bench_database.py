@@ -0,0 +1,78 @@
+from .base import measure, report
+
+from cfy_wrapper.models import Container
+from cfy_wrapper import tasks
+
+from django.db import connection, OperationalError
+from django.test import TransactionTestCase
+
+import collections
+import threading
+import random
+import mock
+
+
+class SyncContainerBenchmark(TransactionTestCase):
+    """
+    Concurrent container acquisition and release, as done by web workers
+    (sync_container) and celery workers (release_container). Benchmark runs
+    on configured database, so in order to compare backends, run it once
+    with SQLite and once with PostgreSQL profile. Threads cannot share
+    in-memory database, so SQLite profile uses a file for tests.
+    """
+
+    CONTAINERS = 20
+    THREADS = 8
+    ROUNDS = 50
+
+    def setUp(self):
+        if (connection.vendor == "sqlite" and
+                connection.is_in_memory_db(connection.settings_dict["NAME"])):
+            self.skipTest("In-memory database cannot be used from threads")
+
+        mock.patch.object(tasks, "logger").start()
+        mock.patch.object(tasks, "chain").start()
+        self.addCleanup(mock.patch.stopall)
+        self.ids = [
+            Container.objects.create(description=str(i)).cfy_id
+            for i in range(self.CONTAINERS)
+        ]
+
+    def _work(self, stats):
+        try:
+            for _ in range(self.ROUNDS):
+                id = random.choice(self.ids)
+                try:
+                    success, msg = tasks.sync_container(Container.get(id),
+                                                        None, False)
+                    if success:
+                        tasks.release_container(id)
+                        stats["acquired"] += 1
+                    else:
+                        stats["busy"] += 1
+                except OperationalError:
+                    stats["locked"] += 1
+        finally:
+            connection.close()
+
+    def test_sync_container(self):
+        stats = collections.Counter()
+
+        def run():
+            # Reported numbers are those of the last run
+            stats.clear()
+            counters = [collections.Counter() for _ in range(self.THREADS)]
+            threads = [threading.Thread(target=self._work, args=(c,))
+                       for c in counters]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            for counter in counters:
+                stats.update(counter)
+
+        durations = measure(run, repeat=3)
+        name = "concurrent sync_container ({})".format(connection.vendor)
+        report(name, durations, threads=self.THREADS,
+               syncs=self.THREADS * self.ROUNDS, acquired=stats["acquired"],
+               busy=stats["busy"], locked=stats["locked"])
@@ -0,0 +1,124 @@
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+from django.conf import settings
+from django.db.models import Max
+
+from .serializers import EventSerializer
+
+import time
+
+"""
+Waiting for container state events.
+
+Instead of polling container endpoints, clients can wait for the next state
+transition. Two flavours are supported: long polling, where request returns
+as soon as there are events newer than the version client already knows
+about (or when wait time runs out), and Server-Sent Events, where events are
+streamed to client as they are recorded.
+
+Events are recorded by celery workers, so waiting requests check database for
+new events periodically. This is a cheap query over primary key, executed in
+the service instead of having clients repeat complete requests.
+"""
+
+# Comment line is sent to idle streams to keep proxies from closing them
+KEEPALIVE_INTERVAL = 15  # In seconds
+# Long polling responses carry version that next request should continue
+# from, even if no events were returned.
+VERSION_HEADER = "X-Events-Version"
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Renderer that makes views accept text/event-stream requests. Streams are
+    produced by views themselves, this renderer is only used for errors.
+    """
+
+    media_type = "text/event-stream"
+    format = "event-stream"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return b"event: error\ndata: " + JSONRenderer().render(data) + b"\n\n"
+
+
+def get_since_version(request):
+    """
+    Get version of the last event that client knows about. EventSource
+    clients send it in Last-Event-ID header when they reconnect.
+    """
+    since = request.META.get("HTTP_LAST_EVENT_ID",
+                             request.query_params.get("since_version"))
+    if since is None:
+        return None
+    try:
+        return int(since)
+    except ValueError:
+        raise ParseError("Invalid since_version: {}".format(since))
+
+
+def get_wait(request):
+    wait = request.query_params.get("wait", "0")
+    try:
+        wait = float(wait)
+    except ValueError:
+        raise ParseError("Invalid wait: {}".format(wait))
+    if wait < 0:
+        raise ParseError("Invalid wait: {}".format(wait))
+    return min(wait, settings.EVENT_MAX_WAIT)
+
+
+def _latest_version(events):
+    return events.aggregate(Max("id"))["id__max"] or 0
+
+
+def wait_for_events(events, since, wait):
+    """
+    Return events that are newer than since, waiting at most wait seconds
+    for the first one to appear, and version that waiting for next events
+    should continue from. If since is None, only events that are recorded
+    from now on are returned.
+    """
+    if since is None:
+        since = _latest_version(events)
+
+    deadline = time.time() + wait
+    while True:
+        found = list(events.filter(id__gt=since).order_by("id"))
+        if len(found) > 0:
+            return found, found[-1].id
+        if time.time() >= deadline:
+            return found, since
+        time.sleep(settings.EVENT_POLL_INTERVAL)
+
+
+def _format_event(event):
+    data = JSONRenderer().render(EventSerializer(event).data)
+    header = "id: {}\nevent: state\ndata: ".format(event.id)
+    return header.encode("utf-8") + data + b"\n\n"
+
+
+def stream_events(events, since):
+    """
+    Generate Server-Sent Events messages for events that are newer than
+    since. Stream ends after EVENT_MAX_WAIT seconds to release the worker.
+    Clients then reconnect and continue from the last received event.
+    """
+    if since is None:
+        since = _latest_version(events)
+
+    retry = int(settings.EVENT_POLL_INTERVAL * 1000)
+    yield "retry: {}\n\n".format(retry).encode("utf-8")
+
+    deadline = time.time() + settings.EVENT_MAX_WAIT
+    while True:
+        wait = min(KEEPALIVE_INTERVAL, max(deadline - time.time(), 0))
+        found, since = wait_for_events(events, since, wait)
+        if len(found) > 0:
+            for event in found:
+                yield _format_event(event)
+        else:
+            yield b": keep-alive\n\n"
+        if time.time() >= deadline:
+            return
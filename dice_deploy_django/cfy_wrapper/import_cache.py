@@ -0,0 +1,141 @@
+from dsl_parser import exceptions
+from dsl_parser.import_resolver.abstract_import_resolver import (
+    AbstractImportResolver
+)
+
+import tempfile
+import hashlib
+import json
+import time
+import os
+
+import requests
+
+"""
+Import resolver for Cloudify DSL parser that keeps remote imports in local
+cache.
+
+Cache is stored on disk and is content addressed: each fetched document is
+stored once under its sha256 digest in "blobs" folder, while "index" folder
+maps import URLs to digests and HTTP validators (ETag and Last-Modified
+headers). Entries that are older than TTL are revalidated using conditional
+requests, so unchanged imports are never downloaded twice.
+
+This module does not depend on Django, which makes it usable from command
+line tools that parse blueprints.
+"""
+
+REQUEST_TIMEOUT = 10  # In seconds
+
+
+class CachingImportResolver(AbstractImportResolver):
+    """
+    Import resolver that serves repeated remote imports from local cache.
+
+    :param root: cache folder (created on demand)
+    :param ttl: number of seconds cached entries are used without
+        revalidation, None means that entries never expire
+    :param offline: if True, never access network and fail on imports that
+        are not cached yet
+    """
+
+    def __init__(self, root, ttl=None, offline=False):
+        self.root = root
+        self.ttl = ttl
+        self.offline = offline
+
+    def resolve(self, import_url):
+        entry = self._load_entry(import_url)
+        if entry is not None and (self.offline or self._is_fresh(entry)):
+            return self._read_blob(entry["digest"])
+
+        if self.offline:
+            msg = "Import failed: {} is not cached (offline mode)"
+            raise exceptions.DSLParsingLogicException(
+                13, msg.format(import_url)
+            )
+
+        try:
+            entry = self._fetch(import_url, entry)
+        except requests.RequestException as e:
+            if entry is None:
+                msg = "Import failed: Unable to open import url {}; {}"
+                raise exceptions.DSLParsingLogicException(
+                    13, msg.format(import_url, e)
+                )
+            # Stale content is better than no content at all
+
+        return self._read_blob(entry["digest"])
+
+    def _is_fresh(self, entry):
+        return self.ttl is None or time.time() - entry["fetched"] < self.ttl
+
+    def _fetch(self, import_url, entry):
+        headers = {}
+        if entry is not None and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry is not None and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = requests.get(import_url, headers=headers,
+                                timeout=REQUEST_TIMEOUT)
+        if response.status_code == 304 and entry is not None:
+            entry["fetched"] = time.time()
+        else:
+            response.raise_for_status()
+            entry = dict(
+                url=import_url,
+                digest=self._write_blob(response.content),
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+                fetched=time.time(),
+            )
+        self._write_file(self._entry_path(import_url),
+                         json.dumps(entry).encode("utf-8"))
+        return entry
+
+    def _entry_path(self, import_url):
+        key = hashlib.sha256(import_url.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, "index", key + ".json")
+
+    def _blob_path(self, digest):
+        return os.path.join(self.root, "blobs", digest)
+
+    def _load_entry(self, import_url):
+        try:
+            with open(self._entry_path(import_url), "rb") as f:
+                entry = json.loads(f.read().decode("utf-8"))
+        except (IOError, OSError, ValueError):
+            return None
+        if not os.path.isfile(self._blob_path(entry["digest"])):
+            return None
+        return entry
+
+    def _read_blob(self, digest):
+        with open(self._blob_path(digest), "rb") as f:
+            return f.read().decode("utf-8")
+
+    def _write_blob(self, content):
+        digest = hashlib.sha256(content).hexdigest()
+        path = self._blob_path(digest)
+        if not os.path.isfile(path):
+            self._write_file(path, content)
+        return digest
+
+    @staticmethod
+    def _write_file(path, content):
+        """
+        Atomically write content to path, since multiple workers may be
+        populating cache at the same time.
+        """
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                if not os.path.isdir(folder):
+                    raise
+        fd, tmp = tempfile.mkstemp(dir=folder)
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.rename(tmp, path)
@@ -0,0 +1,54 @@
+from __future__ import (
+    print_function, absolute_import, unicode_literals, division
+)
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from cfy_wrapper import retention
+
+"""
+This management command removes historical blueprints, errors and events that
+are not covered by retention policy. Policy is configured by RETENTION_*
+settings and can be overridden using command line options, where "none"
+disables the limit.
+
+Example calls:
+python manage.py prune-history
+python manage.py prune-history --keep 3 --max-age none --dry-run
+"""
+
+
+def _limit(value):
+    if value.lower() == 'none':
+        return None
+    return int(value)
+
+
+class Command(BaseCommand):
+    help = 'Remove historical data that is not covered by retention policy'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep', type=_limit,
+                            default=settings.RETENTION_KEEP_BLUEPRINTS,
+                            help='Historical blueprints to keep per container')
+        parser.add_argument('--max-age', type=_limit,
+                            default=settings.RETENTION_MAX_AGE,
+                            help='Maximal age of history in seconds')
+        parser.add_argument('--keep-errors', type=_limit,
+                            default=settings.RETENTION_KEEP_ERRORS,
+                            help='Errors to keep per blueprint')
+        parser.add_argument('--batch-size', type=int,
+                            default=settings.RETENTION_BATCH_SIZE,
+                            help='Number of blueprints deleted at once')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report what would be removed')
+
+    def handle(self, *args, **options):
+        removed = retention.apply_retention(
+            options['keep'], options['max_age'], options['keep_errors'],
+            options['batch_size'], dry_run=options['dry_run'],
+        )
+        action = 'Would remove' if options['dry_run'] else 'Removed'
+        for kind in ('blueprints', 'errors', 'events'):
+            print('{} {} {}'.format(action, removed[kind], kind))
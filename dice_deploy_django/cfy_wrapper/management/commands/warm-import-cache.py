@@ -0,0 +1,40 @@
+from __future__ import (
+    print_function, absolute_import, unicode_literals, division
+)
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dsl_parser import exceptions, parser
+
+from cfy_wrapper import utils
+
+"""
+This management command populates blueprint import cache by parsing selected
+blueprints. All imports are revalidated, regardless of their age.
+
+Example calls:
+python manage.py warm-import-cache ../tests/blueprints/test-setup.yaml
+python manage.py warm-import-cache http://example.com/blueprint.yaml
+"""
+
+
+class Command(BaseCommand):
+    help = 'Populate blueprint import cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('blueprints', nargs='+', metavar='blueprint',
+                            help='Path or URL of blueprint to parse')
+
+    def handle(self, *args, **options):
+        resolver = utils.get_import_resolver(ttl=0)
+        for blueprint in options['blueprints']:
+            print('Warming cache using {}'.format(blueprint))
+            if blueprint.split(':')[0] in ('http', 'https', 'ftp'):
+                parse = parser.parse_from_url
+            else:
+                parse = parser.parse_from_path
+            try:
+                parse(blueprint, resolver=resolver)
+            except (IOError, exceptions.DSLParsingException) as e:
+                raise CommandError('Cannot parse {}: {}'.format(blueprint, e))
+        print('Success')
@@ -3,7 +3,10 @@ from enum import IntEnum, unique
 from rest_framework.exceptions import NotFound
 
 from django.utils.encoding import python_2_unicode_compatible
+from django.utils import timezone
 from django.conf import settings
+from django.core.files import File
+from django.core.files.move import file_move_safe
 from django.db import IntegrityError
 from django.db import models
 
@@ -14,6 +17,8 @@ from dsl_parser import parser
 
 from . import utils
 
+import multiprocessing
+import shutil
 import uuid
 import yaml
 import os
@@ -33,8 +38,19 @@ class Base(models.Model):
         abstract = True
 
 
+class BlueprintQuerySet(models.QuerySet):
+
+    def with_errors(self):
+        """
+        Prefetch errors that are part of blueprint's serialized form.
+        """
+        return self.prefetch_related("errors")
+
+
 @python_2_unicode_compatible
 class Blueprint(Base):
+    objects = BlueprintQuerySet.as_manager()
+
     # Possible states
     @unique
     class State(IntEnum):
@@ -68,19 +84,78 @@ class Blueprint(Base):
         deleting_deployment = 12
         deleting_from_cloudify = 14
 
+    @unique
+    class Validation(IntEnum):
+        """
+        Validation states of uploaded content. Uploads are stored as they are
+        received and are pending until ingest task extracts and validates
+        them.
+        """
+        invalid = -1
+        pending = 0
+        valid = 1
+
     # Fields
     id = models.UUIDField(
         primary_key=True, default=uuid.uuid4, editable=False
     )
-    state = models.IntegerField(default=State.present.value)
+    state = models.IntegerField(default=State.present.value, db_index=True)
+    validation = models.IntegerField(default=Validation.valid.value)
     outputs = JSONField(blank=True, null=True)
-    created_date = models.DateTimeField(auto_now_add=True)
+    # VMs with installed components, None until collected from Cloudify
+    topology = JSONField(blank=True, null=True)
+    # Digest of stored content, empty until content is stored
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    # Inputs section of parsed blueprint, cached by content hash
+    declared_inputs = JSONField(blank=True, null=True)
+    declared_inputs_hash = models.CharField(max_length=64, blank=True)
+    # Container that blueprint has been deployed into. Reference is kept when
+    # blueprint is replaced, which makes retention of history per container
+    # possible.
+    owner = models.ForeignKey("Container", null=True, blank=True,
+                              on_delete=models.SET_NULL, related_name="+")
+    # Blueprint with pending upload that this blueprint is a copy of. Content
+    # is taken from source when it is ingested (see copy).
+    source = models.ForeignKey("self", null=True, blank=True,
+                               on_delete=models.SET_NULL, related_name="+")
+    created_date = models.DateTimeField(auto_now_add=True, db_index=True)
     modified_date = models.DateTimeField(auto_now=True)
 
     @property
     def cfy_id(self):
         return str(self.id)
 
+    @property
+    def cfy_blueprint_id(self):
+        """
+        Id of Cloudify blueprint. Stored content is published under its hash,
+        which makes it possible to reuse it across deployments.
+        """
+        return self.content_hash or self.cfy_id
+
+    @property
+    def is_published(self):
+        """
+        Check if blueprint content is already published to Cloudify.
+        """
+        if not self.content_hash:
+            return False
+        return PublishedBlueprint.objects.filter(
+            content_hash=self.content_hash
+        ).exists()
+
+    def set_published(self, published):
+        if not self.content_hash:
+            return
+        if published:
+            PublishedBlueprint.objects.get_or_create(
+                content_hash=self.content_hash
+            )
+        else:
+            PublishedBlueprint.objects.filter(
+                content_hash=self.content_hash
+            ).delete()
+
     @property
     def state_name(self):
         return Blueprint.State(abs(self.state)).name
@@ -89,8 +164,28 @@ class Blueprint(Base):
     def in_error(self):
         return self.state < 0
 
+    @property
+    def validation_name(self):
+        return Blueprint.Validation(self.validation).name
+
+    @property
+    def is_pending(self):
+        return self.validation == Blueprint.Validation.pending
+
+    @property
+    def upload_path(self):
+        return os.path.join(settings.MEDIA_ROOT, "incoming", self.cfy_id)
+
     @property
     def content_folder(self):
+        """
+        Blueprints with the same content share content folder (and archive),
+        named after content hash. Until the content is stored, blueprint's
+        own staging folder is used.
+        """
+        if self.content_hash:
+            return os.path.join(settings.MEDIA_ROOT, "content",
+                                self.content_hash)
         return os.path.join(settings.MEDIA_ROOT, self.cfy_id)
 
     @property
@@ -101,15 +196,171 @@ class Blueprint(Base):
     def content_tar(self):
         return self.content_folder + ".tar.gz"
 
+    def create_content_folder(self):
+        """
+        Create folder for blueprint content. Folder is only created when some
+        content is about to be stored, which keeps loading of blueprints from
+        database free of any filesystem access.
+        """
+        if not os.path.isdir(self.content_folder):
+            os.mkdir(self.content_folder)
+
     def store_content(self, content):
         """
-        First, try to untar the content. If this fails, simply copy the file
-        to content folder. This function does no validation of blueprints!
+        First, try to untar the content. If this is not a tarball, simply copy
+        the file to content folder. Tarballs that are rejected by extraction
+        checks raise ContentError. This function does no validation of
+        blueprints!
+
+        Content is first stored into blueprint's staging folder and then moved
+        into shared content folder, unless the same content is already stored
+        there, in which case staging folder is simply removed.
         """
-        if not utils.extract_archive(content, self.content_folder)[0]:
+        self.content_hash = ""
+        self.create_content_folder()
+        extracted, msg = utils.extract_archive(
+            content, self.content_folder,
+            max_size=settings.BLUEPRINT_MAX_EXTRACTED_SIZE,
+            max_members=settings.BLUEPRINT_MAX_MEMBERS,
+        )
+        if extracted is False:
+            shutil.rmtree(self.content_folder, ignore_errors=True)
+            raise Blueprint.ContentError(msg)
+        if extracted is None:
+            content.seek(0)
             path = os.path.join(self.content_folder, "blueprint.yaml")
-            with open(path, "w") as file:
-                file.write(content.read())
+            with open(path, "wb") as file:
+                for chunk in File(content).chunks():
+                    file.write(chunk)
+
+        staging = self.content_folder
+        self.content_hash = utils.hash_folder(staging)
+        # Deletion of other blueprints with the same content checks for
+        # remaining references and removes shared folder under the same lock,
+        # so shared folder cannot disappear after we decide to reuse it.
+        with utils.content_lock():
+            self.save(update_fields=["content_hash"])
+            if os.path.isdir(self.content_folder):
+                shutil.rmtree(staging)
+                return
+
+            utils.create_folder(os.path.dirname(self.content_folder))
+            try:
+                os.rename(staging, self.content_folder)
+            except OSError:
+                # Same content can be stored concurrently by another upload
+                # (on storage where locks do not work), in which case it won
+                # the race and we simply drop our copy.
+                if not os.path.isdir(self.content_folder):
+                    raise
+                shutil.rmtree(staging)
+
+    def store_upload(self, upload):
+        """
+        Store uploaded file as it is and mark blueprint as pending. Uploads
+        are already streamed to disk, so this is (in most cases) a simple
+        rename. Content is stored and validated later by calling ingest.
+        """
+        utils.create_folder(os.path.dirname(self.upload_path))
+        if hasattr(upload, "temporary_file_path"):
+            file_move_safe(upload.temporary_file_path(), self.upload_path,
+                           allow_overwrite=True)
+            # Upload is gone, close it now instead of having temporary file
+            # wrapper complain about missing file when it is collected.
+            upload.close()
+        else:
+            with open(self.upload_path, "wb") as file:
+                for chunk in upload.chunks():
+                    file.write(chunk)
+        self.validation = Blueprint.Validation.pending.value
+        self.save(update_fields=["validation"])
+
+    def ingest(self):
+        """
+        Store and validate content of pending upload. Returns the same result
+        as is_valid.
+
+        Copies of pending blueprints have no upload of their own and take
+        content of their source, which must be ingested first.
+        """
+        if self.source is not None:
+            return self._ingest_source()
+
+        try:
+            with open(self.upload_path, "rb") as upload:
+                self.store_content(upload)
+        except Blueprint.ContentError as e:
+            success, msg = False, str(e)
+        else:
+            success, msg = self.is_valid()
+        os.unlink(self.upload_path)
+        self.set_validation(success)
+        return success, msg
+
+    def _ingest_source(self):
+        source = self.source
+        self.content_hash = source.content_hash
+        self.declared_inputs = source.declared_inputs
+        self.declared_inputs_hash = source.declared_inputs_hash
+        self.validation = source.validation
+        self.save(update_fields=["content_hash", "declared_inputs",
+                                 "declared_inputs_hash", "validation",
+                                 "modified_date"])
+        if self.validation != Blueprint.Validation.valid:
+            return False, "Uploaded blueprint is not valid"
+        return True, "All ok for now"
+
+    def set_validation(self, valid):
+        if valid:
+            self.validation = Blueprint.Validation.valid.value
+        else:
+            self.validation = Blueprint.Validation.invalid.value
+        self.save(update_fields=["validation", "modified_date"])
+
+    def copy(self):
+        """
+        Create new blueprint that shares stored content with this one.
+        Content is not copied, it is referenced by its hash.
+
+        Copy of pending blueprint is pending as well and gets content when it
+        is ingested, after this blueprint has been ingested.
+        """
+        if self.is_pending:
+            return Blueprint.objects.create(
+                source=self, validation=Blueprint.Validation.pending.value
+            )
+        return Blueprint.objects.create(
+            content_hash=self.content_hash,
+            declared_inputs=self.declared_inputs,
+            declared_inputs_hash=self.declared_inputs_hash,
+        )
+
+    @property
+    def is_content_shared(self):
+        """
+        Check if there are other blueprints that use the same content.
+        """
+        if not self.content_hash:
+            return False
+        others = Blueprint.objects.filter(content_hash=self.content_hash)
+        return others.exclude(id=self.id).exists()
+
+    @property
+    def is_content_in_use(self):
+        """
+        Check if other blueprints with the same content are deployed or queued
+        in some container. Historical blueprints are not taken into account,
+        since they will never be deployed again.
+        """
+        if not self.content_hash:
+            return False
+        queued = Container.objects.filter(queue__isnull=False).values("queue")
+        others = Blueprint.objects.filter(
+            content_hash=self.content_hash
+        ).exclude(id=self.id)
+        return others.filter(
+            models.Q(container__isnull=False) | models.Q(id__in=queued)
+        ).exists()
 
     def is_valid(self):
         """
@@ -129,16 +380,57 @@ class Blueprint(Base):
     def pack(self):
         """
         Create tarball that contains complete blueprint contents, augmented
-        with admin supplied inputs.
+        with admin supplied inputs. Archives of stored content are immutable,
+        so they are only created once and then reused.
         """
-        utils.create_archive(self.content_tar, self.content_folder)
+        if not self.is_packed:
+            threads = (settings.BLUEPRINT_ARCHIVE_THREADS or
+                       multiprocessing.cpu_count())
+            utils.create_archive(
+                self.content_tar, self.content_folder,
+                level=settings.BLUEPRINT_ARCHIVE_COMPRESSION, threads=threads
+            )
         return self.content_tar
 
+    @property
+    def is_packed(self):
+        """
+        Check if archive of stored content exists. Archive is named after
+        content hash, so existing archive is always up to date.
+        """
+        return bool(self.content_hash) and os.path.isfile(self.content_tar)
+
     def log_error(self, msg):
         """
-        Log error for this blueprint
+        Log error for this blueprint. Blueprint's modification date is
+        updated, since errors are part of blueprint's representation.
         """
         self.errors.create(message=msg)
+        self.modified_date = timezone.now()
+        Blueprint.objects.filter(id=self.id).update(
+            modified_date=self.modified_date
+        )
+
+    def get_declared_inputs(self):
+        """
+        Return inputs section of parsed blueprint.
+
+        Parsing blueprint is expensive (imports are resolved, possibly over
+        network), so results are cached in database and only refreshed when
+        content hash changes.
+        """
+        content_hash = (self.content_hash or
+                        utils.hash_folder(self.content_folder))
+        if (self.declared_inputs is None or
+                self.declared_inputs_hash != content_hash):
+            plan = parser.parse_from_path(
+                self.content_blueprint, resolver=utils.get_import_resolver()
+            )
+            self.declared_inputs = plan.get("inputs", {})
+            self.declared_inputs_hash = content_hash
+            self.save(update_fields=["declared_inputs",
+                                     "declared_inputs_hash"])
+        return self.declared_inputs
 
     def prepare_inputs(self):
         """
@@ -155,8 +447,7 @@ class Blueprint(Base):
         deploy doesn't need them set explicitly.
         """
 
-        blueprint = self.content_blueprint
-        blueprint_inputs = parser.parse_from_path(blueprint).get("inputs", {})
+        blueprint_inputs = self.get_declared_inputs()
         blueprint_keys = blueprint_inputs.keys()
         required_blueprint_keys = {
             k for k, v in blueprint_inputs.items() if "default" not in v
@@ -178,6 +469,9 @@ class Blueprint(Base):
             self.id, self.state_name, self.in_error
         )
 
+    class ContentError(Exception):
+        pass
+
     class InputsError(Exception):
 
         def __init__(self, missing_inputs):
@@ -196,6 +490,16 @@ class ContainerQuerySet(models.QuerySet):
         for obj in self:
             obj.delete()
 
+    def with_blueprint(self):
+        """
+        Fetch blueprint (and its errors) that is part of container's
+        serialized form in constant number of queries. Large internal fields
+        of blueprint are never serialized, so they are not loaded.
+        """
+        return self.select_related("blueprint").prefetch_related(
+            "blueprint__errors"
+        ).defer("blueprint__topology", "blueprint__declared_inputs")
+
 
 @python_2_unicode_compatible
 class Container(Base):
@@ -210,9 +514,9 @@ class Container(Base):
                                   related_name="container")
     queue = models.ForeignKey(Blueprint, null=True, blank=True,
                               on_delete=models.SET_NULL, related_name="+")
-    created_date = models.DateTimeField(auto_now_add=True)
+    created_date = models.DateTimeField(auto_now_add=True, db_index=True)
     modified_date = models.DateTimeField(auto_now=True)
-    busy = models.BooleanField(default=False)
+    busy = models.BooleanField(default=False, db_index=True)
 
     # Optimistic concurrency protection
     version = IntegerVersionField()
@@ -276,6 +580,10 @@ class Error(models.Model):
                                   related_name="errors")
     created = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # Errors are listed per blueprint in order of creation
+        index_together = (("blueprint", "created"),)
+
     def __str__(self):
         return "id: {}, msg: {}, blueprint: {}".format(
             self.id, self.message, self.blueprint.id
@@ -290,7 +598,77 @@ class Metadata(models.Model):
     blueprint = models.ForeignKey(Blueprint, on_delete=models.CASCADE,
                                   related_name="metadata")
 
+    class Meta:
+        index_together = (("blueprint", "key"),)
+
     def __str__(self):
         return "blueprint: {} key: {}, value: {}".format(
             self.blueprint.id, self.key, self.value
         )
+
+
+@python_2_unicode_compatible
+class Event(models.Model):
+    """
+    Snapshot of container state, recorded on each blueprint state transition
+    and when container is released. Event ids are increasing, which makes
+    them usable as versions that clients can wait on.
+    """
+
+    container = models.ForeignKey(Container, on_delete=models.CASCADE,
+                                  related_name="events")
+    blueprint = models.ForeignKey(Blueprint, null=True, blank=True,
+                                  on_delete=models.SET_NULL,
+                                  related_name="+")
+    state = models.IntegerField(null=True)  # None if container is empty
+    busy = models.BooleanField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        # Clients wait for events that are newer than some version
+        index_together = (("container", "id"),)
+
+    @property
+    def state_name(self):
+        if self.state is None:
+            return None
+        return Blueprint.State(abs(self.state)).name
+
+    @property
+    def in_error(self):
+        return self.state is not None and self.state < 0
+
+    def __str__(self):
+        return "id: {}, container: {}, state: {}, busy: {}".format(
+            self.id, self.container_id, self.state_name, self.busy
+        )
+
+
+@python_2_unicode_compatible
+class TrackedExecution(models.Model):
+    """
+    Cloudify execution that some task is waiting for. Status is periodically
+    refreshed by execution watcher.
+    """
+
+    id = models.CharField(max_length=64, primary_key=True)
+    status = models.CharField(max_length=32, blank=True)
+    missing = models.BooleanField(default=False)
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "id: {}, status: {}, missing: {}".format(
+            self.id, self.status, self.missing
+        )
+
+
+class PublishedBlueprint(models.Model):
+    """
+    Blueprint content that is published to Cloudify Manager under its hash.
+    """
+
+    content_hash = models.CharField(max_length=64, primary_key=True)
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "content_hash: {}".format(self.content_hash)
@@ -0,0 +1,40 @@
+from rest_framework.pagination import CursorPagination, _positive_int
+from rest_framework.response import Response
+
+"""
+Pagination of list endpoints.
+
+List endpoints used to return complete lists and existing clients (web GUI,
+command line tool) still expect plain lists in response body. This is why
+pagination is opt-in (client needs to set limit query parameter) and why
+links to neighbouring pages are returned in Link header (RFC 5988) instead
+of being wrapped around results.
+"""
+
+
+class LinkHeaderCursorPagination(CursorPagination):
+
+    page_size_query_param = "limit"
+    max_page_size = 1000
+
+    def __init__(self, ordering):
+        self.ordering = ordering
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.page_size_query_param],
+                strict=True, cutoff=self.max_page_size
+            )
+        except (KeyError, ValueError):
+            return None
+
+    def get_paginated_response(self, data):
+        links = [
+            '<{}>; rel="{}"'.format(url, rel) for url, rel in (
+                (self.get_next_link(), "next"),
+                (self.get_previous_link(), "prev"),
+            ) if url is not None
+        ]
+        headers = {"Link": ", ".join(links)} if links else None
+        return Response(data, headers=headers)
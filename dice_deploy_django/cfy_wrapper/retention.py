@@ -0,0 +1,186 @@
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.signals import pre_delete
+from django.utils import timezone
+
+from .models import Blueprint, Container, Error, Event
+from .signals import delete_blueprint_folder
+from . import utils
+
+import datetime
+import shutil
+import os
+
+"""
+Retention of historical data.
+
+Each deploy creates new blueprint and replaced blueprints are normally
+removed when container switches to new one. Blueprints that are left behind
+(failed uploads, queued blueprints that never got deployed, ...) are kept as
+history of their container, together with their errors, metadata and stored
+content. This module limits the amount of history that is kept:
+
+ - at most `keep` most recent historical blueprints of each container are
+   kept, and blueprints older than max_age are removed,
+ - at most keep_errors most recent errors of each blueprint are kept and
+ - events older than max_age are removed.
+
+Blueprints are removed in batches with a constant number of queries per
+batch, related rows are removed (or detached) by regular queryset deletion.
+Stored content is removed when the last blueprint that references it is
+removed, as is done when blueprints are deleted one by one.
+"""
+
+# Blueprints younger than this are never removed, since they can be in the
+# middle of being uploaded and not yet assigned to container.
+GRACE_PERIOD = 60 * 60  # In seconds
+
+
+def _orphans(queryset):
+    """
+    Limit queryset to blueprints that are neither deployed nor queued.
+    """
+    queued = Container.objects.filter(queue__isnull=False).values("queue")
+    return queryset.filter(container__isnull=True).exclude(id__in=queued)
+
+
+def get_expired_blueprints(keep, max_age, now=None):
+    """
+    Return ids of historical blueprints that are not covered by retention
+    policy. None disables corresponding policy.
+    """
+    now = now or timezone.now()
+    grace = now - datetime.timedelta(seconds=GRACE_PERIOD)
+    cutoff = None
+    if max_age is not None:
+        cutoff = now - datetime.timedelta(seconds=max_age)
+
+    orphans = _orphans(Blueprint.objects.filter(created_date__lt=grace))
+    expired = []
+    kept = {}
+    for id, owner, created in orphans.order_by(
+        "owner", "-created_date"
+    ).values_list("id", "owner", "created_date"):
+        kept[owner] = kept.get(owner, 0) + 1
+        if ((keep is not None and kept[owner] > keep) or
+                (cutoff is not None and created < cutoff)):
+            expired.append(id)
+    return expired
+
+
+def _remove_content(blueprint):
+    shutil.rmtree(blueprint.content_folder, ignore_errors=True)
+    for path in (blueprint.content_tar, blueprint.upload_path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def delete_blueprints(ids, batch_size):
+    """
+    Delete selected historical blueprints, their errors, metadata and stored
+    content in batches. Blueprints that got deployed in the meantime are
+    skipped. Returns number of deleted blueprints.
+    """
+    # Folder removal would cost a query per blueprint, content is removed in
+    # bulk below instead. Retention runs in its own process (beat task or
+    # management command), so other deletions are not affected.
+    pre_delete.disconnect(delete_blueprint_folder, sender=Blueprint)
+    try:
+        return _delete_blueprints(ids, batch_size)
+    finally:
+        pre_delete.connect(delete_blueprint_folder, sender=Blueprint)
+
+
+def _delete_blueprints(ids, batch_size):
+    deleted = 0
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        with transaction.atomic():
+            blueprints = list(_orphans(
+                Blueprint.objects.select_for_update().filter(id__in=batch)
+            ).only("id", "content_hash"))
+            batch = [b.id for b in blueprints]
+            hashes = {b.content_hash for b in blueprints if b.content_hash}
+
+            Blueprint.objects.filter(id__in=batch).delete()
+
+        # Blueprint's own folders are only present if content was never
+        # stored, shared content is removed when it is not used anymore.
+        # References are checked under content lock, since new uploads can
+        # store the same content concurrently.
+        for blueprint in blueprints:
+            _remove_content(Blueprint(id=blueprint.id))
+        with utils.content_lock():
+            used = set(Blueprint.objects.filter(
+                content_hash__in=hashes
+            ).values_list("content_hash", flat=True))
+            for content_hash in hashes - used:
+                _remove_content(Blueprint(content_hash=content_hash))
+        deleted += len(batch)
+    return deleted
+
+
+def _crowded_errors(keep):
+    return Error.objects.values("blueprint").annotate(
+        count=Count("id")
+    ).filter(count__gt=keep).values_list("blueprint", "count")
+
+
+def prune_errors(keep, batch_size):
+    """
+    Keep only keep most recent errors of each blueprint. Returns number of
+    deleted errors.
+    """
+    if keep is None:
+        return 0
+
+    deleted = 0
+    for blueprint, _ in _crowded_errors(keep):
+        ids = list(Error.objects.filter(blueprint=blueprint).order_by(
+            "-created"
+        ).values_list("id", flat=True)[keep:])
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            deleted += Error.objects.filter(id__in=batch).delete()[0]
+    return deleted
+
+
+def _expired_events(max_age, now):
+    cutoff = now - datetime.timedelta(seconds=max_age)
+    return Event.objects.filter(created__lt=cutoff)
+
+
+def prune_events(max_age, now=None):
+    """
+    Delete events older than max_age. Returns number of deleted events.
+    """
+    if max_age is None:
+        return 0
+    return _expired_events(max_age, now or timezone.now()).delete()[0]
+
+
+def apply_retention(keep, max_age, keep_errors, batch_size, dry_run=False):
+    """
+    Apply retention policy and return number of removed items by type. If
+    dry_run is set, nothing is removed and numbers of items that would be
+    removed are returned instead.
+    """
+    now = timezone.now()
+    expired = get_expired_blueprints(keep, max_age, now)
+    if not dry_run:
+        return dict(
+            blueprints=delete_blueprints(expired, batch_size),
+            errors=prune_errors(keep_errors, batch_size),
+            events=prune_events(max_age, now),
+        )
+
+    errors = 0
+    if keep_errors is not None:
+        errors = sum(count - keep_errors
+                     for _, count in _crowded_errors(keep_errors))
+    events = 0
+    if max_age is not None:
+        events = _expired_events(max_age, now).count()
+    return dict(blueprints=len(expired), errors=errors, events=events)
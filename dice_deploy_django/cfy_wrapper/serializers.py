@@ -2,22 +2,57 @@ import collections
 
 from rest_framework import serializers
 
-from .models import Blueprint, Container, Input, Error
+from .models import Blueprint, Container, Event, Input, Error
 
 
-class ErrorSerializer(serializers.ModelSerializer):
+class SparseFieldsMixin(object):
+    """
+    Serializer mixin that limits output to fields that are listed in fields
+    argument. All fields are serialized if fields argument is missing.
+    """
+
+    # Model fields that serializer fields are computed from (only needed for
+    # serializer fields that do not map to model field with the same name)
+    field_sources = {}
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop("fields", None)
+        super(SparseFieldsMixin, self).__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    @classmethod
+    def get_model_fields(cls, fields):
+        """
+        Return names of model fields that are needed to serialize fields.
+        """
+        return {
+            source for field in fields
+            for source in cls.field_sources.get(field, (field,))
+        }
+
+
+class ErrorSerializer(SparseFieldsMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Error
         fields = ("id", "created", "message")
 
 
-class BlueprintSerializer(serializers.ModelSerializer):
+class BlueprintSerializer(SparseFieldsMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Blueprint
-        fields = ("id", "state_name", "modified_date", "outputs",
-                  "in_error", "errors")
+        fields = ("id", "state_name", "validation_name", "modified_date",
+                  "outputs", "in_error", "errors")
+
+    field_sources = {
+        "state_name": ("state",),
+        "validation_name": ("validation",),
+        "in_error": ("state",),
+        "errors": (),
+    }
 
     outputs = serializers.JSONField(read_only=True)
     errors = ErrorSerializer(read_only=True, many=True)
@@ -29,16 +64,36 @@ class BlueprintSerializer(serializers.ModelSerializer):
         raise RuntimeError("Blueprint updating is not supported")
 
 
-class ContainerSerializer(serializers.ModelSerializer):
+class ContainerSerializer(SparseFieldsMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Container
         fields = ("id", "description", "blueprint", "modified_date", "busy")
         read_only_fields = ("busy",)
 
+    # Blueprint is loaded together with container (see with_blueprint), so
+    # its fields need to be listed as well to keep large ones deferred.
+    field_sources = {
+        "blueprint": ("blueprint",) + tuple(
+            "blueprint__" + f for f in BlueprintSerializer.get_model_fields(
+                BlueprintSerializer.Meta.fields
+            )
+        ),
+    }
+
     blueprint = BlueprintSerializer(read_only=True)
 
 
+class EventSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = Event
+        fields = ("version", "container", "blueprint", "state_name",
+                  "in_error", "busy", "created")
+
+    version = serializers.IntegerField(source="id", read_only=True)
+
+
 class InputListSerializer(serializers.ListSerializer):
 
     def validate(self, data):
@@ -52,7 +107,7 @@ class InputListSerializer(serializers.ListSerializer):
         raise serializers.ValidationError("Duplicated keys: {}".format(dups))
 
 
-class InputSerializer(serializers.ModelSerializer):
+class InputSerializer(SparseFieldsMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Input
@@ -1,34 +1,64 @@
-from django.db.models.signals import post_init, post_save, pre_delete
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, pre_delete
 from django.dispatch import receiver
 from django.conf import settings
 
 from rest_framework.authtoken.models import Token
 
+from . import utils
 from .models import Blueprint
 
 import shutil
 import os
 
 
-@receiver(post_init, sender=Blueprint)
-def create_blueprint_folder(instance, **_):
+@receiver(pre_delete, sender=Blueprint)
+def delete_blueprint_folder(instance, **_):
     """
-    This method can be called multiple times, so we need to make sure we
-    create folder only the first time.
+    Content can be shared between blueprints, so we only remove it when the
+    last blueprint that references it is deleted. Uploads that were never
+    ingested are removed as well.
+
+    Check and removal of shared content are done under content lock, which
+    keeps concurrent store_content of the same content from reusing folder
+    that is about to be removed.
     """
-    if not os.path.isdir(instance.content_folder):
-        os.mkdir(instance.content_folder)
+    try:
+        os.unlink(instance.upload_path)
+    except OSError:
+        pass
 
+    if not instance.content_hash:
+        _remove_content(instance)
+        return
+    with utils.content_lock():
+        if not instance.is_content_shared:
+            _remove_content(instance)
 
-@receiver(pre_delete, sender=Blueprint)
-def delete_blueprint_folder(instance, **_):
-    shutil.rmtree(instance.content_folder, ignore_errors=True)
+
+def _remove_content(blueprint):
+    shutil.rmtree(blueprint.content_folder, ignore_errors=True)
     try:
-        os.unlink(instance.content_tar)
+        os.unlink(blueprint.content_tar)
     except OSError:
         pass
 
 
+@receiver(connection_created)
+def enable_sqlite_wal(connection, **_):
+    """
+    In write-ahead log mode, SQLite readers do not block writers and writers
+    do not block readers, which avoids most of "database is locked" errors
+    when web and celery workers use database concurrently.
+    """
+    if connection.vendor != "sqlite":
+        return
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_auth_token(sender, instance=None, created=False, **kwargs):
     if created:
@@ -3,14 +3,17 @@ from __future__ import absolute_import
 from celery import Task, shared_task, chain
 from celery.utils.log import get_task_logger
 
-from . import utils
-from .models import Blueprint, Container, Input
+from . import retention, topology, utils
+from .models import Blueprint, Container, Event, Input, TrackedExecution
 
 from cloudify_rest_client import exceptions, executions
-from concurrency.exceptions import RecordModifiedError
 
 from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
 
+import collections
 import time
 
 import requests
@@ -32,6 +35,17 @@ prevents concurrent executions of multiple tasks in single container.
 logger = get_task_logger("tasks")
 
 
+class _ProcessClient(object):
+    """
+    Descriptor that returns Cloudify client of current process. Client is not
+    stored on task instance, since tasks are instantiated before worker forks
+    its children, which must not share connection pool.
+    """
+
+    def __get__(self, instance, owner):
+        return utils.get_cfy_client()
+
+
 class Job(Task):
     """
     Custom celery tasks that takes care of error handling. This should be used
@@ -47,16 +61,14 @@ class Job(Task):
     max_retries = None
     default_retry_delay = 10
 
-    def __init__(self):
-        self.client = utils.get_cfy_client()
+    client = _ProcessClient()
 
     def on_failure(self, exc, task_id, args, kwargs, einfo):
         container_id = args[-1]
         logger.error("Operation in container {} failed.".format(container_id))
 
         blueprint = Container.get(container_id).blueprint
-        blueprint.state = -abs(blueprint.state)
-        blueprint.save()
+        _save_state(blueprint, -abs(blueprint.state), container_id)
 
         blueprint.log_error(str(exc))
         logger.error(str(exc))
@@ -64,10 +76,63 @@ class Job(Task):
         release_container(container_id)
 
 
-def _get_blueprint_with_state(container_id, state):
-    blueprint = Container.get(container_id).blueprint
+class IngestJob(Job):
+    """
+    Ingest runs before anything in container is changed, so its failures
+    only invalidate queued blueprint and leave deployed blueprint alone.
+    """
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        container_id = args[-1]
+        logger.error("Ingest in container {} failed.".format(container_id))
+
+        blueprint = Container.get(container_id).queue
+        blueprint.set_validation(False)
+
+        blueprint.log_error(str(exc))
+        logger.error(str(exc))
+
+        release_container(container_id)
+
+
+def _save_state(blueprint, state, container_id):
+    """
+    Save new blueprint state and record state transition event that clients
+    can wait on.
+    """
     blueprint.state = state
     blueprint.save()
+    Event.objects.create(container_id=container_id, blueprint=blueprint,
+                         state=state, busy=True)
+
+
+@shared_task(bind=True, base=IngestJob)
+def ingest_blueprint(task, container_id):
+    blueprint = Container.get(container_id).queue
+    # Copies (batch deploys) wait for their source to be ingested first
+    if blueprint.source is not None and blueprint.source.is_pending:
+        raise task.retry(countdown=settings.POOL_SLEEP_INTERVAL)
+
+    logger.info("Ingesting blueprint '{}'.".format(blueprint.cfy_id))
+    success, msg = blueprint.ingest()
+    if not success:
+        raise Exception(msg)
+
+
+@shared_task(bind=True, base=IngestJob)
+def pack_blueprint(task, container_id):
+    # Prepare archive here, off the critical path of deploy (and its
+    # retries). This runs on regular queue, since packing large blueprints
+    # would delay validation of other uploads in ingest queue.
+    blueprint = Container.get(container_id).queue
+    if not (blueprint.is_published or blueprint.is_packed):
+        logger.info("Creating archive for '{}'.".format(blueprint.cfy_id))
+        blueprint.pack()
+
+
+def _get_blueprint_with_state(container_id, state):
+    blueprint = Container.get(container_id).blueprint
+    _save_state(blueprint, state, container_id)
     return blueprint, blueprint.cfy_id
 
 
@@ -78,11 +143,25 @@ def upload_blueprint(task, container_id):
         container_id, Blueprint.State.uploading_to_cloudify
     )
 
-    logger.info("Creating archive for '{}'.".format(id))
+    if blueprint.is_published:
+        msg = "Content of '{}' is already published as '{}'."
+        logger.info(msg.format(id, blueprint.cfy_blueprint_id))
+        return
+
+    if not blueprint.is_packed:
+        logger.info("Creating archive for '{}'.".format(id))
     archive = blueprint.pack()
 
     logger.info("Uploading blueprint archive '{}'.".format(archive))
-    task.client.blueprints.publish_archive(archive, id)
+    try:
+        task.client.blueprints.publish_archive(
+            archive, blueprint.cfy_blueprint_id
+        )
+    except exceptions.CloudifyClientError as e:
+        # Same content can be published concurrently from another container
+        if not (blueprint.content_hash and e.status_code == 409):
+            raise
+    blueprint.set_published(True)
 
 
 @shared_task(bind=True, base=Job, autoretry_for=Job.autoretry_excs,
@@ -96,9 +175,16 @@ def create_deployment(task, container_id):
     inputs = blueprint.prepare_inputs()
 
     logger.info("Creating deployment '{}'.".format(id))
-    task.client.deployments.create(id, id, inputs=inputs)
-    blueprint.state = Blueprint.State.prepared_deployment
-    blueprint.save()
+    try:
+        task.client.deployments.create(blueprint.cfy_blueprint_id, id,
+                                       inputs=inputs)
+    except exceptions.CloudifyClientError as e:
+        # Published blueprint has been removed from manager behind our back,
+        # make sure that next deploy uploads it again.
+        if e.status_code == 404:
+            blueprint.set_published(False)
+        raise
+    _save_state(blueprint, Blueprint.State.prepared_deployment, container_id)
 
     executions = task.client.executions.list(
         id, workflow_id="create_deployment_environment"
@@ -122,20 +208,101 @@ def wait_for_execution(task, execution_id, allow_missing, container_id):
 
     logger.info("Waiting for execution {}.".format(execution_id))
 
+    if settings.EXECUTION_WAIT_MODE == "watch":
+        status = _get_watched_status(task, execution_id, allow_missing)
+    else:
+        status = _get_polled_status(task, execution_id, allow_missing)
+
+    if status is None:
+        logger.info("Execution '{}' succeeded.".format(execution_id))
+        return
+
+    if status != executions.Execution.TERMINATED:
+        msg = "Execution '{}' terminated abnormally.".format(execution_id)
+        raise Exception(msg)
+
+
+def _get_polled_status(task, execution_id, allow_missing):
+    """
+    Query Cloudify Manager for execution status until execution terminates
+    or, in reschedule mode, reschedule the task if execution is still
+    running. Returns None if execution is allowed to be missing and it is.
+    """
     try:
         execution = task.client.executions.get(execution_id)
         while execution.status not in executions.Execution.END_STATES:
+            if settings.EXECUTION_WAIT_MODE != "sleep":
+                # Release worker and check the execution status again after
+                # the poll interval. Chain is carried over to the new task.
+                raise task.retry(countdown=settings.POOL_SLEEP_INTERVAL)
             time.sleep(settings.POOL_SLEEP_INTERVAL)
             execution = task.client.executions.get(execution_id)
     except exceptions.CloudifyClientError as e:
         if allow_missing and e.status_code == 404:
-            logger.info("Execution '{}' succeeded.".format(execution_id))
-            return
+            return None
         raise
+    return execution.status
 
-    if execution.status != executions.Execution.TERMINATED:
-        msg = "Execution '{}' terminated abnormally.".format(execution_id)
-        raise Exception(msg)
+
+def _get_watched_status(task, execution_id, allow_missing):
+    """
+    Obtain execution status that has been collected by watch_executions task
+    and reschedule the task if execution is still running. Returns None if
+    execution is allowed to be missing and it is.
+    """
+    tracked, _ = TrackedExecution.objects.get_or_create(id=execution_id)
+    if (not tracked.missing and
+            tracked.status not in executions.Execution.END_STATES):
+        raise task.retry(countdown=settings.POOL_SLEEP_INTERVAL)
+
+    tracked.delete()
+    if not tracked.missing:
+        return tracked.status
+    if allow_missing:
+        return None
+    raise Exception("Execution '{}' is missing.".format(execution_id))
+
+
+@shared_task(ignore_result=True)
+def watch_executions():
+    """
+    Periodic task that collects statuses of all tracked executions using a
+    single request to Cloudify Manager.
+    """
+    pending = list(TrackedExecution.objects.filter(
+        missing=False
+    ).exclude(
+        status__in=executions.Execution.END_STATES
+    ).values_list("id", flat=True))
+    if len(pending) == 0:
+        return
+
+    logger.debug("Watching {} execution(s).".format(len(pending)))
+    client = utils.get_cfy_client()
+    found = client.executions.list(include_system_workflows=True, id=pending,
+                                   _include=["id", "status"])
+
+    statuses = collections.defaultdict(list)
+    for execution in found:
+        statuses[execution.status].append(execution.id)
+    for status, ids in statuses.items():
+        TrackedExecution.objects.filter(id__in=ids).update(status=status)
+
+    missing = set(pending) - {e.id for e in found}
+    TrackedExecution.objects.filter(id__in=missing).update(missing=True)
+
+
+@shared_task(ignore_result=True)
+def prune_history():
+    """
+    Periodic task that removes historical data that is not covered by
+    retention policy.
+    """
+    removed = retention.apply_retention(
+        settings.RETENTION_KEEP_BLUEPRINTS, settings.RETENTION_MAX_AGE,
+        settings.RETENTION_KEEP_ERRORS, settings.RETENTION_BATCH_SIZE,
+    )
+    logger.info("Pruned history: {}".format(removed))
 
 
 @shared_task(bind=True, base=Job, autoretry_for=Job.autoretry_excs,
@@ -170,8 +337,19 @@ def fetch_blueprint_outputs(task, container_id):
         }
 
     blueprint.outputs = outs
-    blueprint.state = Blueprint.State.deployed
-    blueprint.save()
+
+    # Topology is not essential for deploy and nodes view builds it on demand
+    # when it is missing, so failures are only logged here.
+    logger.info("Collecting topology of deployment '{}'.".format(id))
+    try:
+        blueprint.topology = topology.build(task.client, id)
+    except (exceptions.CloudifyClientError,
+            requests.RequestException) as e:
+        logger.error("Collecting topology of deployment '{}' failed: "
+                     "{}".format(id, e))
+        blueprint.topology = None
+
+    _save_state(blueprint, Blueprint.State.deployed, container_id)
 
 
 @shared_task(bind=True, base=Job, autoretry_for=Job.autoretry_excs,
@@ -181,6 +359,9 @@ def uninstall_blueprint(task, container_id):
         container_id, Blueprint.State.uninstalling
     )
 
+    blueprint.topology = None
+    blueprint.save()
+
     logger.info("Scheduling uninstall on deployment '{}'.".format(id))
     return task.client.executions.start(id, "uninstall").id
 
@@ -218,10 +399,19 @@ def delete_blueprint(task, container_id):
         container_id, Blueprint.State.deleting_from_cloudify
     )
 
-    logger.info("Deleting blueprint '{}'.".format(id))
-    task.client.blueprints.delete(id)
-    blueprint.state = Blueprint.State.present
-    blueprint.save()
+    # Published content is kept on manager for as long as some blueprint can
+    # still be deployed from it (redeploy or other deployed or queued
+    # blueprints with the same content).
+    container = Container.get(container_id)
+    reuse = blueprint.is_content_in_use or container.queue_id == blueprint.id
+    if blueprint.content_hash and reuse:
+        msg = "Keeping published content of '{}' for reuse."
+        logger.info(msg.format(id))
+    else:
+        logger.info("Deleting blueprint '{}'.".format(id))
+        task.client.blueprints.delete(blueprint.cfy_blueprint_id)
+        blueprint.set_published(False)
+    _save_state(blueprint, Blueprint.State.present, container_id)
 
 
 @shared_task(base=Job)
@@ -239,8 +429,16 @@ def process_container_queue(container_id):
 def release_container(container_id):
     logger.info("Releasing container {}".format(container_id))
     container = Container.get(container_id)
-    container.busy = False
-    container.save()
+    # Single statement, like acquire in sync_container. Version is bumped,
+    # so that saving an instance that was loaded while container was busy
+    # fails instead of marking container busy again.
+    Container.objects.filter(id=container.id).update(
+        busy=False, version=F("version") + 1, modified_date=timezone.now()
+    )
+
+    blueprint = container.blueprint
+    Event.objects.create(container=container, blueprint=blueprint,
+                         state=blueprint and blueprint.state, busy=False)
 
 
 @shared_task(base=Job, autoretry_for=Job.autoretry_excs,
@@ -320,6 +518,40 @@ def _get_undeploy_pipe(container):
     return pipe[index:]
 
 
+def _acquire_container(container, blueprint):
+    """
+    Mark container as busy and enqueue blueprint in a single transaction.
+
+    Container is only acquired if it is not busy and has not been modified
+    since it was loaded (compare-and-set on version field), which is checked
+    by the same UPDATE statement that acquires it. Failed remnants in queue
+    are removed in the same transaction. Returns True if container has been
+    acquired, in which case container instance is updated to match database.
+    """
+    if container.busy:
+        return False
+
+    version = container.version + 1
+    with transaction.atomic():
+        acquired = Container.objects.filter(
+            id=container.id, busy=False, version=container.version
+        ).update(busy=True, queue=blueprint, version=version,
+                 modified_date=timezone.now())
+        if not acquired:
+            return False
+
+        if container.queue_id is not None and container.queue != blueprint:
+            container.queue.delete()
+        if blueprint is not None and blueprint.owner_id != container.id:
+            blueprint.owner = container
+            blueprint.save(update_fields=["owner"])
+
+    container.busy = True
+    container.queue = blueprint
+    container.version = version
+    return True
+
+
 # This should be the only entry point into celery
 def sync_container(container, blueprint, register_app):
     """
@@ -356,29 +588,21 @@ def sync_container(container, blueprint, register_app):
          - find container       [c = Container.get(uuid_of_container)]
          - create new blueprint [b = Blueprint()]
          - commit changes       [success, msg = sync_container(c, b)]
-    """
-    busy_msg = "Container '{}' is busy.".format(container.id)
-
-    if container.busy:
-        return False, busy_msg
 
-    # Try to acquire exclusive access to container
-    container.busy = True
-    try:
-        container.save()
-    except RecordModifiedError:
-        return False, busy_msg
+    Blueprints with pending uploads (see Blueprint.store_upload) are ingested
+    first, before existing deployment is touched. If upload turns out to be
+    invalid, sequence is terminated and container is left as it was.
+    """
+    if not _acquire_container(container, blueprint):
+        return False, "Container '{}' is busy.".format(container.id)
 
     # We have sole ownership over this container from now
 
-    # Remove any failed remnants in queue and enqueue new blueprint
-    if container.queue:
-        container.queue.delete()
-    container.queue = blueprint
-    container.save()
-
     # Construct task sequence and execute it
     pipe = []
+    if blueprint is not None and blueprint.is_pending:
+        pipe.append(ingest_blueprint.si(container.cfy_id))
+        pipe.append(pack_blueprint.si(container.cfy_id))
     pipe.extend(_get_undeploy_pipe(container))
     pipe.append(process_container_queue.si(container.cfy_id))
     pipe.extend(_get_deploy_pipe(container, register_app))
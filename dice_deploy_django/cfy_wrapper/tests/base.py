@@ -8,6 +8,8 @@ from rest_framework.test import (
 )
 from testfixtures import TempDirectory
 
+from cfy_wrapper import utils
+
 from collections import namedtuple
 import mock
 
@@ -42,7 +44,11 @@ class BaseTest(APITestCase):
 
         # Django settings patches
         mock.patch.object(settings, "MEDIA_ROOT", self.wd.path).start()
+        mock.patch.object(settings, "IMPORT_CACHE_ROOT",
+                          self.wd.getpath("import_cache")).start()
         mock.patch.object(settings, "CELERY_TASK_ALWAYS_EAGER", True).start()
+        # Each test gets fresh Cloudify client
+        mock.patch.dict(utils._cfy_clients, clear=True).start()
         self.addCleanup(mock.patch.stopall)
 
 
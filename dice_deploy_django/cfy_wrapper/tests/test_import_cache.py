@@ -0,0 +1,121 @@
+from .base import BaseTest
+
+from cfy_wrapper.import_cache import CachingImportResolver
+
+from dsl_parser.exceptions import DSLParsingLogicException
+
+import requests
+import mock
+import os
+
+URL = "http://example.com/types.yaml"
+
+
+def response(status_code, content=b"", headers={}):
+    resp = mock.Mock(status_code=status_code, content=content,
+                     headers=headers)
+    if status_code >= 400:
+        resp.raise_for_status.side_effect = requests.HTTPError(status_code)
+    return resp
+
+
+@mock.patch("cfy_wrapper.import_cache.requests.get")
+class CachingImportResolverTest(BaseTest):
+
+    def _resolver(self, **kwargs):
+        return CachingImportResolver(self.wd.getpath("cache"), **kwargs)
+
+    def test_cache_miss(self, mock_get):
+        mock_get.return_value = response(200, b"types: {}")
+
+        content = self._resolver().fetch_import(URL)
+
+        self.assertEqual("types: {}", content)
+        mock_get.assert_called_once()
+
+    def test_cache_hit(self, mock_get):
+        mock_get.return_value = response(200, b"types: {}")
+
+        self._resolver().fetch_import(URL)
+        content = self._resolver().fetch_import(URL)
+
+        self.assertEqual("types: {}", content)
+        mock_get.assert_called_once()
+
+    def test_content_addressed(self, mock_get):
+        mock_get.return_value = response(200, b"types: {}")
+
+        resolver = self._resolver()
+        resolver.fetch_import(URL)
+        resolver.fetch_import(URL + "?copy")
+
+        self.assertEqual(1, len(os.listdir(self.wd.getpath("cache/blobs"))))
+        self.assertEqual(2, mock_get.call_count)
+
+    def test_revalidate_not_modified(self, mock_get):
+        mock_get.side_effect = [
+            response(200, b"types: {}", {"ETag": "abc",
+                                         "Last-Modified": "yesterday"}),
+            response(304),
+        ]
+
+        self._resolver(ttl=0).fetch_import(URL)
+        content = self._resolver(ttl=0).fetch_import(URL)
+
+        self.assertEqual("types: {}", content)
+        headers = mock_get.mock_calls[1][2]["headers"]
+        self.assertEqual({"If-None-Match": "abc",
+                          "If-Modified-Since": "yesterday"}, headers)
+
+    def test_revalidate_modified(self, mock_get):
+        mock_get.side_effect = [
+            response(200, b"types: {}", {"ETag": "abc"}),
+            response(200, b"types: {a: b}", {"ETag": "def"}),
+        ]
+
+        self._resolver(ttl=0).fetch_import(URL)
+        content = self._resolver(ttl=0).fetch_import(URL)
+
+        self.assertEqual("types: {a: b}", content)
+
+    def test_revalidate_failure_serves_stale(self, mock_get):
+        mock_get.side_effect = [
+            response(200, b"types: {}"),
+            requests.ConnectionError("down"),
+        ]
+
+        self._resolver(ttl=0).fetch_import(URL)
+        content = self._resolver(ttl=0).fetch_import(URL)
+
+        self.assertEqual("types: {}", content)
+
+    def test_fetch_failure(self, mock_get):
+        mock_get.return_value = response(404)
+
+        with self.assertRaises(DSLParsingLogicException):
+            self._resolver().fetch_import(URL)
+
+    def test_offline_hit(self, mock_get):
+        mock_get.return_value = response(200, b"types: {}")
+        self._resolver().fetch_import(URL)
+
+        content = self._resolver(ttl=0, offline=True).fetch_import(URL)
+
+        self.assertEqual("types: {}", content)
+        mock_get.assert_called_once()
+
+    def test_offline_miss(self, mock_get):
+        with self.assertRaises(DSLParsingLogicException):
+            self._resolver(offline=True).fetch_import(URL)
+
+        mock_get.assert_not_called()
+
+    def test_local_file(self, mock_get):
+        self.wd.write("types.yaml", b"types: {}")
+
+        content = self._resolver().fetch_import(
+            "file://" + self.wd.getpath("types.yaml")
+        )
+
+        self.assertEqual(b"types: {}", content)
+        mock_get.assert_not_called()
@@ -1,11 +1,16 @@
 from .base import BaseTest
 
+from django.core.files import File
 from django.db import IntegrityError
+from django.test import override_settings
 from concurrency.exceptions import RecordModifiedError
 
 import mock
 
 import tarfile
+import shutil
+import fcntl
+import errno
 import os
 
 from cfy_wrapper.models import (
@@ -23,13 +28,15 @@ class BlueprintTest(BaseTest):
         b = Blueprint.objects.create()
         content_folder = self.wd.getpath(str(b.id))
         # Make sure blueprint is created with proper defaults and that
-        # associated folder is created
+        # associated folder is not created until content is stored
         self.assertEqual(b.state, Blueprint.State.present)
         self.assertEqual(b.cfy_id, str(b.id))
         self.assertEqual(b.content_folder, content_folder)
         self.assertEqual(b.content_tar, content_folder + ".tar.gz")
         success, _ = b.is_valid()
         self.assertFalse(success)
+        self.wd.compare(expected=())
+        b.create_content_folder()
         self.wd.compare([str(b.id) + "/"])
         # Deletion should remove folder (and any created archives)
         b.delete()
@@ -48,9 +55,22 @@ class BlueprintTest(BaseTest):
             self.assertEqual(b.content_tar, content_folder + ".tar.gz")
             success, _ = b.is_valid()
             self.assertFalse(success)
+            b.create_content_folder()
 
         self.wd.compare(sorted(folders))
 
+    def test_loading_does_not_touch_filesystem(self):
+        for i in range(5):
+            Blueprint.objects.create()
+
+        with mock.patch("os.mkdir") as mock_mkdir, \
+                mock.patch("os.path.isdir") as mock_isdir:
+            list(Blueprint.objects.all())
+
+        mock_mkdir.assert_not_called()
+        mock_isdir.assert_not_called()
+        self.wd.compare(expected=())
+
     def test_valid_blueprint_yaml(self):
         b = Blueprint.objects.create()
         self.wd.write((str(b.id), "blueprint.yaml"), b"test: pair")
@@ -82,6 +102,244 @@ class BlueprintTest(BaseTest):
             os.path.join(str(b.id), "blueprint.yaml"),
         }, content)
 
+    def _store(self, blueprint, content=b"test: pair"):
+        self.wd.write("test.yaml", content)
+        with open(self.wd.getpath("test.yaml")) as f:
+            blueprint.store_content(f)
+
+    @override_settings(BLUEPRINT_MAX_EXTRACTED_SIZE=4)
+    def test_store_content_rejected_archive(self):
+        b = Blueprint.objects.create()
+        self.wd.write(("toplevel", "blueprint.yaml"), b"test: pair")
+        archive = self.wd.getpath("test.tar.gz")
+        with tarfile.open(archive, "w:gz") as tar:
+            tar.add(self.wd.getpath("toplevel"), arcname="toplevel")
+
+        with open(archive, "rb") as f:
+            with self.assertRaises(Blueprint.ContentError) as cm:
+                b.store_content(f)
+
+        self.assertEqual("Tarball content is too large", str(cm.exception))
+        self.assertFalse(os.path.exists(b.content_blueprint))
+
+    def test_store_content_shared(self):
+        b1 = Blueprint.objects.create()
+        b2 = Blueprint.objects.create()
+        b3 = Blueprint.objects.create()
+        self._store(b1)
+        self._store(b2)
+        self._store(b3, b"test: other")
+
+        self.assertEqual(b1.content_hash, b2.content_hash)
+        self.assertEqual(b1.content_folder, b2.content_folder)
+        self.assertNotEqual(b1.content_folder, b3.content_folder)
+        b1.refresh_from_db()
+        self.assertEqual(b2.content_hash, b1.content_hash)
+        self.wd.compare([b1.content_hash, b3.content_hash],
+                        path="content", files_only=True, recursive=False)
+
+    def test_store_content_concurrently(self):
+        b1 = Blueprint.objects.create()
+        b2 = Blueprint.objects.create()
+        self._store(b1)
+
+        def rename(src, dst):
+            # Other upload of the same content stores it in the meantime
+            shutil.copytree(src, dst)
+            raise OSError(errno.ENOTEMPTY, "Directory not empty")
+
+        with mock.patch("cfy_wrapper.models.os.rename", side_effect=rename):
+            b1.delete()
+            self._store(b2)
+
+        self.assertTrue(os.path.isfile(b2.content_blueprint))
+        self.assertFalse(os.path.exists(self.wd.getpath(b2.cfy_id)))
+
+    def test_store_content_rename_fails(self):
+        b = Blueprint.objects.create()
+
+        with mock.patch("cfy_wrapper.models.os.rename",
+                        side_effect=OSError(errno.EACCES, "Denied")):
+            with self.assertRaises(OSError):
+                self._store(b)
+
+    def test_shared_content_deleted_with_last_blueprint(self):
+        b1 = Blueprint.objects.create()
+        b2 = Blueprint.objects.create()
+        self._store(b1)
+        self._store(b2)
+        b1.pack()
+
+        b1.delete()
+        self.assertTrue(os.path.isdir(b2.content_folder))
+        self.assertTrue(os.path.isfile(b2.content_tar))
+
+        b2.delete()
+        self.assertFalse(os.path.exists(b2.content_folder))
+        self.assertFalse(os.path.exists(b2.content_tar))
+
+    def _is_content_locked(self):
+        with open(self.wd.getpath("content.lock"), "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return True
+            fcntl.flock(f, fcntl.LOCK_UN)
+            return False
+
+    def test_store_content_saves_hash_under_lock(self):
+        b = Blueprint.objects.create()
+        locked = []
+        save = Blueprint.save
+
+        def locked_save(blueprint, *args, **kwargs):
+            locked.append(self._is_content_locked())
+            save(blueprint, *args, **kwargs)
+
+        with mock.patch.object(Blueprint, "save", autospec=True,
+                               side_effect=locked_save):
+            self._store(b)
+
+        self.assertEqual([True], locked)
+
+    def test_delete_checks_references_under_lock(self):
+        b = Blueprint.objects.create()
+        self._store(b)
+        locked = []
+
+        with mock.patch.object(
+            Blueprint, "is_content_shared", new_callable=mock.PropertyMock,
+            side_effect=lambda: locked.append(self._is_content_locked()),
+        ):
+            b.delete()
+
+        self.assertEqual([True], locked)
+        self.assertFalse(os.path.exists(b.content_folder))
+
+    def test_copy(self):
+        b1 = Blueprint.objects.create(declared_inputs={"a": {}},
+                                      declared_inputs_hash="hash")
+        self._store(b1)
+
+        b2 = b1.copy()
+
+        self.assertNotEqual(b1.id, b2.id)
+        self.assertEqual(b1.content_folder, b2.content_folder)
+        self.assertEqual({"a": {}}, b2.declared_inputs)
+        self.assertEqual("hash", b2.declared_inputs_hash)
+        b1.delete()
+        self.assertTrue(os.path.isfile(b2.content_blueprint))
+
+    def _upload(self, blueprint, content):
+        self.wd.write("upload", content)
+        with open(self.wd.getpath("upload")) as f:
+            blueprint.store_upload(File(f))
+
+    def test_store_upload(self):
+        b = Blueprint.objects.create()
+
+        self._upload(b, b"test: pair")
+
+        b.refresh_from_db()
+        self.assertTrue(b.is_pending)
+        self.assertEqual(b"test: pair", self.wd.read(b.upload_path))
+        self.assertFalse(os.path.exists(b.content_folder))
+
+    def test_ingest_valid(self):
+        b = Blueprint.objects.create()
+        self._upload(b, b"test: pair")
+
+        success, _ = b.ingest()
+
+        b.refresh_from_db()
+        self.assertTrue(success)
+        self.assertEqual("valid", b.validation_name)
+        self.assertNotEqual("", b.content_hash)
+        self.assertTrue(os.path.isfile(b.content_blueprint))
+        self.assertFalse(os.path.exists(b.upload_path))
+
+    def test_ingest_invalid(self):
+        b = Blueprint.objects.create()
+        self._upload(b, b"} not { valid } yaml {{")
+
+        success, _ = b.ingest()
+
+        b.refresh_from_db()
+        self.assertFalse(success)
+        self.assertEqual("invalid", b.validation_name)
+
+    def test_copy_pending(self):
+        b1 = Blueprint.objects.create()
+        self._upload(b1, b"test: pair")
+
+        b2 = b1.copy()
+
+        self.assertEqual(b1, b2.source)
+        self.assertTrue(b2.is_pending)
+        self.assertEqual("", b2.content_hash)
+
+    def test_ingest_copy(self):
+        b1 = Blueprint.objects.create()
+        self._upload(b1, b"test: pair")
+        b2 = b1.copy()
+        b1.ingest()
+
+        success, _ = b2.ingest()
+
+        b2.refresh_from_db()
+        self.assertTrue(success)
+        self.assertEqual("valid", b2.validation_name)
+        self.assertEqual(b1.content_folder, b2.content_folder)
+        b1.delete()
+        self.assertTrue(os.path.isfile(b2.content_blueprint))
+
+    def test_ingest_copy_invalid(self):
+        b1 = Blueprint.objects.create()
+        self._upload(b1, b"} not { valid } yaml {{")
+        b2 = b1.copy()
+        b1.ingest()
+
+        success, _ = b2.ingest()
+
+        b2.refresh_from_db()
+        self.assertFalse(success)
+        self.assertEqual("invalid", b2.validation_name)
+
+    def test_upload_deleted_with_blueprint(self):
+        b = Blueprint.objects.create()
+        self._upload(b, b"test: pair")
+
+        b.delete()
+
+        self.assertFalse(os.path.exists(b.upload_path))
+
+    @mock.patch("cfy_wrapper.models.utils.create_archive")
+    def test_pack_reuses_archive(self, mock_create):
+        b1 = Blueprint.objects.create()
+        b2 = Blueprint.objects.create()
+        self._store(b1)
+        self._store(b2)
+        mock_create.side_effect = lambda archive, *_, **__: open(
+            archive, "w"
+        ).close()
+
+        self.assertEqual(b1.pack(), b2.pack())
+        mock_create.assert_called_once()
+        self.assertEqual((b1.content_tar, b1.content_folder),
+                         mock_create.call_args[0])
+
+    @override_settings(BLUEPRINT_ARCHIVE_COMPRESSION=0,
+                       BLUEPRINT_ARCHIVE_THREADS=3)
+    @mock.patch("cfy_wrapper.models.utils.create_archive")
+    def test_pack_settings(self, mock_create):
+        b = Blueprint.objects.create()
+        self._store(b)
+
+        b.pack()
+
+        mock_create.assert_called_once_with(b.content_tar, b.content_folder,
+                                            level=0, threads=3)
+
     @mock.patch("cfy_wrapper.models.parser.parse_from_path")
     def test_prepare_inputs_present(self, mock_parse):
         mock_parse.return_value = {
@@ -96,7 +354,8 @@ class BlueprintTest(BaseTest):
 
         inputs = b.prepare_inputs()
 
-        mock_parse.assert_called_once_with(b.content_blueprint)
+        mock_parse.assert_called_once_with(b.content_blueprint,
+                                           resolver=mock.ANY)
         self.assertEqual({"1": "val-1", "5": "val-5"}, inputs)
 
     @mock.patch("cfy_wrapper.models.parser.parse_from_path")
@@ -113,7 +372,8 @@ class BlueprintTest(BaseTest):
 
         inputs = b.prepare_inputs()
 
-        mock_parse.assert_called_once_with(b.content_blueprint)
+        mock_parse.assert_called_once_with(b.content_blueprint,
+                                           resolver=mock.ANY)
         self.assertEqual({"5": "val-5"}, inputs)
 
     @mock.patch("cfy_wrapper.models.parser.parse_from_path")
@@ -131,7 +391,8 @@ class BlueprintTest(BaseTest):
         with self.assertRaises(Blueprint.InputsError) as cm:
             b.prepare_inputs()
 
-        mock_parse.assert_called_once_with(b.content_blueprint)
+        mock_parse.assert_called_once_with(b.content_blueprint,
+                                           resolver=mock.ANY)
         self.assertEqual({"5"}, cm.exception.missing_inputs)
 
     @mock.patch("cfy_wrapper.models.parser.parse_from_path")
@@ -149,9 +410,41 @@ class BlueprintTest(BaseTest):
         with self.assertRaises(Blueprint.InputsError) as cm:
             b.prepare_inputs()
 
-        mock_parse.assert_called_once_with(b.content_blueprint)
+        mock_parse.assert_called_once_with(b.content_blueprint,
+                                           resolver=mock.ANY)
         self.assertEqual({"5"}, cm.exception.missing_inputs)
 
+    @mock.patch("cfy_wrapper.models.parser.parse_from_path")
+    def test_prepare_inputs_cached(self, mock_parse):
+        mock_parse.return_value = {"inputs": {"5": {"desc": "desc5"}}}
+        Input.objects.create(key="5", value="val-5")
+        b = Blueprint.objects.create()
+        self.wd.write((str(b.id), "blueprint.yaml"), b"test: pair")
+
+        b.prepare_inputs()
+        b = Blueprint.objects.get(id=b.id)
+        inputs = b.prepare_inputs()
+
+        mock_parse.assert_called_once_with(b.content_blueprint,
+                                           resolver=mock.ANY)
+        self.assertEqual({"5": "val-5"}, inputs)
+
+    @mock.patch("cfy_wrapper.models.parser.parse_from_path")
+    def test_prepare_inputs_content_changed(self, mock_parse):
+        mock_parse.return_value = {"inputs": {"5": {"desc": "desc5"}}}
+        Input.objects.create(key="5", value="val-5")
+        Input.objects.create(key="6", value="val-6")
+        b = Blueprint.objects.create()
+        self.wd.write((str(b.id), "blueprint.yaml"), b"test: pair")
+
+        b.prepare_inputs()
+        self.wd.write((str(b.id), "blueprint.yaml"), b"test: other")
+        mock_parse.return_value = {"inputs": {"6": {"desc": "desc6"}}}
+        inputs = b.prepare_inputs()
+
+        self.assertEqual(2, mock_parse.call_count)
+        self.assertEqual({"6": "val-6"}, inputs)
+
     def test_store_content_yaml(self):
         b = Blueprint.objects.create()
         file = "test.yaml"
@@ -159,9 +452,9 @@ class BlueprintTest(BaseTest):
         self.wd.write(file, content)
         with open(self.wd.getpath(file)) as f:
             b.store_content(f)
-        self.wd.compare(["blueprint.yaml"], path=str(b.id))
-        self.assertEqual(content,
-                         self.wd.read((str(b.id), "blueprint.yaml")))
+        self.wd.compare(["blueprint.yaml"], path=b.content_folder)
+        self.assertEqual(content, self.wd.read(b.content_blueprint))
+        self.assertFalse(os.path.exists(self.wd.getpath(str(b.id))))
         success, _ = b.is_valid()
         self.assertTrue(success)
 
@@ -185,7 +478,7 @@ class BlueprintTest(BaseTest):
             "y/toplevel/b/",
             "y/toplevel/b/c/",
             "y/toplevel/b/c/file2.txt",
-        ], path=str(b.id))
+        ], path=b.content_folder)
         valid, _ = b.is_valid()
         self.assertFalse(valid)
 
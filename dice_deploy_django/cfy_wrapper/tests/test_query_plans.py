@@ -0,0 +1,80 @@
+from .base import BaseTest
+
+from cfy_wrapper.models import Blueprint, Container, Error, Metadata
+
+from django.db import connection
+
+import unittest
+import re
+
+
+# Full table scan in SQLite query plan ("SCAN TABLE x" in older versions),
+# while scans that use an index end with "USING [COVERING] INDEX i". Sorting
+# in temporary tree means that all matching rows are read before first one
+# is returned.
+FULL_SCAN = re.compile(r"^(SCAN (TABLE )?\w+( AS \w+)?|USE TEMP B-TREE .*)$")
+
+
+@unittest.skipUnless(connection.vendor == "sqlite",
+                     "Query plans are only checked on SQLite")
+class QueryPlanTest(BaseTest):
+    """
+    Make sure that frequently executed queries use indexes. Tables are empty
+    here, but SQLite's planner picks indexes without statistics anyway.
+    """
+
+    def get_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertNoFullScan(self, queryset):
+        plan = self.get_plan(queryset)
+        scans = [step for step in plan if FULL_SCAN.match(step)]
+        self.assertEqual([], scans, "Full scan in plan: {}".format(plan))
+
+    def test_blueprint_state(self):
+        self.assertNoFullScan(Blueprint.objects.filter(
+            state__in=(Blueprint.State.deployed, -Blueprint.State.deployed)
+        ))
+
+    def test_blueprint_in_error(self):
+        self.assertNoFullScan(Blueprint.objects.filter(state__lt=0))
+
+    def test_blueprint_list(self):
+        self.assertNoFullScan(Blueprint.objects.order_by("created_date"))
+
+    def test_shared_content(self):
+        b = Blueprint.objects.create(content_hash="abc")
+        self.assertNoFullScan(Blueprint.objects.filter(
+            content_hash=b.content_hash
+        ).exclude(id=b.id))
+
+    def test_container_list(self):
+        self.assertNoFullScan(Container.objects.order_by("created_date"))
+
+    def test_busy_containers(self):
+        self.assertNoFullScan(Container.objects.filter(busy=True))
+
+    def test_blueprint_errors(self):
+        b = Blueprint.objects.create()
+        self.assertNoFullScan(b.errors.order_by("created"))
+        self.assertNoFullScan(Error.objects.filter(blueprint=b))
+
+    def test_blueprint_metadata(self):
+        b = Blueprint.objects.create()
+        self.assertNoFullScan(b.metadata.all())
+        queryset = Metadata.objects.filter(blueprint=b, key="k")
+        self.assertNoFullScan(queryset)
+        self.assertIn("key=?", " ".join(self.get_plan(queryset)))
+
+    def test_container_events(self):
+        c = Container.objects.create()
+        self.assertNoFullScan(c.events.filter(id__gt=10).order_by("id"))
+
+    def test_detects_full_scan(self):
+        with self.assertRaises(AssertionError):
+            self.assertNoFullScan(Metadata.objects.filter(value="v"))
+        with self.assertRaises(AssertionError):
+            self.assertNoFullScan(Metadata.objects.order_by("value"))
@@ -0,0 +1,248 @@
+from .base import BaseTest
+
+from cfy_wrapper.models import Blueprint, Container, Error, Event, Metadata
+from cfy_wrapper import retention
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+import datetime
+import mock
+import os
+
+DAY = 24 * 60 * 60
+
+
+class BaseRetentionTest(BaseTest):
+
+    def setUp(self):
+        super(BaseRetentionTest, self).setUp()
+        self.now = timezone.now()
+
+    def create(self, age, **kwargs):
+        b = Blueprint.objects.create(**kwargs)
+        created = self.now - datetime.timedelta(seconds=age)
+        Blueprint.objects.filter(id=b.id).update(created_date=created)
+        return b
+
+
+class GetExpiredBlueprintsTest(BaseRetentionTest):
+
+    def test_keep_per_owner(self):
+        c1 = Container.objects.create()
+        c2 = Container.objects.create()
+        old1 = self.create(3 * DAY, owner=c1)
+        old2 = self.create(4 * DAY, owner=c2)
+        self.create(DAY, owner=c1)
+        self.create(DAY, owner=c2)
+
+        expired = retention.get_expired_blueprints(1, None, self.now)
+
+        self.assertEqual({old1.id, old2.id}, set(expired))
+
+    def test_max_age(self):
+        old = self.create(10 * DAY)
+        self.create(DAY)
+
+        expired = retention.get_expired_blueprints(None, 5 * DAY, self.now)
+
+        self.assertEqual([old.id], expired)
+
+    def test_grace_period(self):
+        self.create(0)
+        self.create(0)
+
+        expired = retention.get_expired_blueprints(0, 0, self.now)
+
+        self.assertEqual([], expired)
+
+    def test_deployed_and_queued_kept(self):
+        deployed = self.create(10 * DAY)
+        queued = self.create(10 * DAY)
+        Container.objects.create(blueprint=deployed, queue=queued)
+
+        expired = retention.get_expired_blueprints(0, 0, self.now)
+
+        self.assertEqual([], expired)
+
+    def test_no_policy(self):
+        self.create(10 * DAY)
+
+        expired = retention.get_expired_blueprints(None, None, self.now)
+
+        self.assertEqual([], expired)
+
+
+class DeleteBlueprintsTest(BaseRetentionTest):
+
+    def test_related_rows(self):
+        c = Container.objects.create()
+        b = self.create(DAY)
+        Error.objects.create(blueprint=b, message="e")
+        Metadata.objects.create(blueprint=b, key="k", value="v")
+        e = Event.objects.create(container=c, blueprint=b, busy=False)
+        copy = self.create(DAY, source=b)
+
+        deleted = retention.delete_blueprints([b.id], 10)
+
+        self.assertEqual(1, deleted)
+        self.assertFalse(Blueprint.objects.filter(id=b.id).exists())
+        self.assertEqual(0, Error.objects.count())
+        self.assertEqual(0, Metadata.objects.count())
+        e.refresh_from_db()
+        self.assertIsNone(e.blueprint)
+        copy.refresh_from_db()
+        self.assertIsNone(copy.source)
+
+    def test_batches(self):
+        ids = [self.create(DAY).id for _ in range(5)]
+
+        deleted = retention.delete_blueprints(ids, 2)
+
+        self.assertEqual(5, deleted)
+        self.assertEqual(0, Blueprint.objects.count())
+
+    def _count_queries(self, blueprints):
+        c = Container.objects.create()
+        ids = []
+        for i in range(blueprints):
+            b = self.create(DAY, content_hash=str(i))
+            Error.objects.create(blueprint=b, message="e")
+            Metadata.objects.create(blueprint=b, key="k", value="v")
+            Event.objects.create(container=c, blueprint=b, busy=False)
+            ids.append(b.id)
+
+        with CaptureQueriesContext(connection) as queries:
+            retention.delete_blueprints(ids, 100)
+        return len(queries)
+
+    def test_constant_queries(self):
+        self.assertEqual(self._count_queries(2), self._count_queries(10))
+
+    def test_folder_signal_reconnected(self):
+        b = Blueprint.objects.create()
+        retention.delete_blueprints([self.create(DAY).id], 10)
+        self.wd.write((b.cfy_id, "blueprint.yaml"), b"a: b")
+
+        b.delete()
+
+        self.assertFalse(os.path.exists(b.content_folder))
+
+    def test_skips_deployed(self):
+        b = self.create(DAY)
+        Container.objects.create(blueprint=b)
+
+        deleted = retention.delete_blueprints([b.id], 10)
+
+        self.assertEqual(0, deleted)
+        self.assertTrue(Blueprint.objects.filter(id=b.id).exists())
+
+    def test_shared_content(self):
+        b1 = self.create(DAY, content_hash="abc")
+        b2 = self.create(DAY, content_hash="abc")
+        self.wd.write(("content", "abc", "blueprint.yaml"), b"a: b")
+        self.wd.write(("content", "abc.tar.gz"), b"tar")
+
+        retention.delete_blueprints([b1.id], 10)
+        self.assertTrue(os.path.isdir(b2.content_folder))
+        self.assertTrue(os.path.isfile(b2.content_tar))
+
+        retention.delete_blueprints([b2.id], 10)
+        self.assertFalse(os.path.exists(b2.content_folder))
+        self.assertFalse(os.path.exists(b2.content_tar))
+
+    def test_own_content(self):
+        b = self.create(DAY)
+        self.wd.write((b.cfy_id, "blueprint.yaml"), b"a: b")
+        self.wd.write(("incoming", b.cfy_id), b"upload")
+
+        retention.delete_blueprints([b.id], 10)
+
+        self.assertFalse(os.path.exists(b.content_folder))
+        self.assertFalse(os.path.exists(b.upload_path))
+
+
+class PruneTest(BaseRetentionTest):
+
+    def test_errors(self):
+        b1 = self.create(DAY)
+        b2 = self.create(DAY)
+        for i in range(5):
+            Error.objects.create(blueprint=b1, message=str(i))
+        Error.objects.create(blueprint=b2, message="b2")
+
+        deleted = retention.prune_errors(2, 2)
+
+        self.assertEqual(3, deleted)
+        self.assertEqual(["3", "4"], sorted(
+            b1.errors.values_list("message", flat=True)
+        ))
+        self.assertEqual(1, b2.errors.count())
+
+    def test_errors_no_policy(self):
+        b = self.create(DAY)
+        Error.objects.create(blueprint=b, message="e")
+
+        self.assertEqual(0, retention.prune_errors(None, 10))
+        self.assertEqual(1, Error.objects.count())
+
+    def test_events(self):
+        c = Container.objects.create()
+        old = Event.objects.create(container=c, busy=False)
+        new = Event.objects.create(container=c, busy=True)
+        Event.objects.filter(id=old.id).update(
+            created=self.now - datetime.timedelta(seconds=10 * DAY)
+        )
+
+        deleted = retention.prune_events(5 * DAY, self.now)
+
+        self.assertEqual(1, deleted)
+        self.assertEqual([new.id], list(c.events.values_list("id", flat=True)))
+
+
+class ApplyRetentionTest(BaseRetentionTest):
+
+    def setUp(self):
+        super(ApplyRetentionTest, self).setUp()
+        c = Container.objects.create()
+        self.b = self.create(10 * DAY)
+        for i in range(3):
+            Error.objects.create(blueprint=self.create(DAY), message=str(i))
+        Event.objects.create(container=c, busy=False)
+        Event.objects.update(
+            created=self.now - datetime.timedelta(seconds=10 * DAY)
+        )
+
+    def test_apply(self):
+        removed = retention.apply_retention(None, 5 * DAY, 0, 10)
+
+        self.assertEqual(dict(blueprints=1, errors=3, events=1), removed)
+        self.assertEqual(3, Blueprint.objects.count())
+        self.assertEqual(0, Error.objects.count())
+        self.assertEqual(0, Event.objects.count())
+
+    def test_dry_run(self):
+        removed = retention.apply_retention(None, 5 * DAY, 0, 10,
+                                            dry_run=True)
+
+        self.assertEqual(dict(blueprints=1, errors=3, events=1), removed)
+        self.assertEqual(4, Blueprint.objects.count())
+        self.assertEqual(3, Error.objects.count())
+        self.assertEqual(1, Event.objects.count())
+
+    @override_settings(RETENTION_KEEP_BLUEPRINTS=None,
+                       RETENTION_MAX_AGE=5 * DAY)
+    @mock.patch("sys.stdout")
+    def test_command(self, mock_stdout):
+        call_command("prune-history", "--keep-errors", "none", "--dry-run")
+
+        self.assertEqual(4, Blueprint.objects.count())
+
+        call_command("prune-history", "--keep-errors", "none")
+
+        self.assertFalse(Blueprint.objects.filter(id=self.b.id).exists())
+        self.assertEqual(3, Error.objects.count())
+        self.assertEqual(0, Event.objects.count())
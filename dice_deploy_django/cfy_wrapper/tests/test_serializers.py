@@ -22,12 +22,14 @@ class BlueprintSerializerTest(BaseTest):
     def test_valid_serialization(self):
         id = uuid.uuid4()
         b = mock.MagicMock(id=id, state_name="test", outputs={"k": "v"},
+                           validation_name="valid",
                            modified_date=datetime.datetime(2015, 10, 3),
                            in_error=False)
         d = BlueprintSerializer(b).data
         self.assertEqual({
             "id": str(id),
             "state_name": "test",
+            "validation_name": "valid",
             "modified_date": "2015-10-03T00:00:00",
             "outputs": {"k": "v"},
             "in_error": False,
@@ -55,7 +57,8 @@ class BlueprintSerializerTest(BaseTest):
 
         d = BlueprintSerializer(b).data
 
-        for field in ("state_name", "outputs", "in_error"):
+        for field in ("state_name", "validation_name", "outputs",
+                      "in_error"):
             self.assertEqual(getattr(b, field), d[field])
         self.assertEqual(1, len(d["errors"]))
         self.assertEqual(d["errors"][0]["message"], "message")
@@ -67,6 +70,7 @@ class ContainerSerializerTest(BaseTest):
         b_id = uuid.uuid4()
         c_id = uuid.uuid4()
         b = mock.MagicMock(id=b_id, state_name="test", outputs={"k": "v"},
+                           validation_name="valid",
                            modified_date=datetime.datetime(2015, 10, 3),
                            in_error=True)
         c = mock.MagicMock(id=c_id, description="desc", blueprint=b,
@@ -86,6 +90,7 @@ class ContainerSerializerTest(BaseTest):
             "blueprint": {
                 "id": str(b_id),
                 "state_name": "test",
+                "validation_name": "valid",
                 "modified_date": "2015-10-03T00:00:00",
                 "outputs": {"k": "v"},
                 "in_error": True,
@@ -0,0 +1,24 @@
+from .base import BaseTest
+
+from cfy_wrapper import signals
+
+import mock
+
+
+class EnableSqliteWalTest(BaseTest):
+
+    def test_sqlite(self):
+        connection = mock.Mock(vendor="sqlite")
+
+        signals.enable_sqlite_wal(connection)
+
+        cursor = connection.cursor.return_value
+        cursor.execute.assert_any_call("PRAGMA journal_mode=WAL")
+        cursor.close.assert_called_once()
+
+    def test_other_vendor(self):
+        connection = mock.Mock(vendor="postgresql")
+
+        signals.enable_sqlite_wal(connection)
+
+        connection.cursor.assert_not_called()
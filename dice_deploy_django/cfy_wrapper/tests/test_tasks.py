@@ -1,13 +1,24 @@
 from .base import BaseTest
 
-from cfy_wrapper.models import Blueprint, Container, Input
+from cfy_wrapper.models import (
+    Blueprint, Container, Event, Input, PublishedBlueprint, TrackedExecution
+)
 from cfy_wrapper import tasks
 
+from celery.exceptions import Retry
+from concurrency.exceptions import RecordModifiedError
 from cloudify_rest_client.exceptions import CloudifyClientError
 
-from django.test import override_settings
+from django.conf import settings
+from django.core.files import File
+from django.db import connection, transaction
+from django.test import TransactionTestCase, override_settings
+from testfixtures import TempDirectory
 
+import threading
+import tarfile
 import mock
+import os
 
 
 class BaseCeleryTest(BaseTest):
@@ -44,6 +55,51 @@ class UploadBlueprintTest(BaseCeleryTest):
         with self.assertRaises(CloudifyClientError):
             tasks.upload_blueprint(c.cfy_id)
 
+    def test_content_blueprint_upload(self, mock_cfy):
+        b = Blueprint.objects.create(content_hash="abc")
+        self.wd.write(("content", "abc", "blueprint.yaml"), b"test: pair")
+        c = Container.objects.create(blueprint=b)
+        call = mock_cfy.blueprints.publish_archive
+
+        tasks.upload_blueprint(c.cfy_id)
+
+        call.assert_called_once_with(b.content_tar, "abc")
+        self.assertTrue(b.is_published)
+
+    @mock.patch("cfy_wrapper.models.utils.create_archive")
+    def test_content_packed(self, mock_create, mock_cfy):
+        b = Blueprint.objects.create(content_hash="abc")
+        self.wd.write(("content", "abc", "blueprint.yaml"), b"test: pair")
+        self.wd.write(("content", "abc.tar.gz"), b"archive")
+        c = Container.objects.create(blueprint=b)
+
+        tasks.upload_blueprint(c.cfy_id)
+
+        mock_create.assert_not_called()
+        mock_cfy.blueprints.publish_archive.assert_called_once_with(
+            b.content_tar, "abc"
+        )
+
+    def test_content_already_published(self, mock_cfy):
+        b = Blueprint.objects.create(content_hash="abc")
+        PublishedBlueprint.objects.create(content_hash="abc")
+        c = Container.objects.create(blueprint=b)
+
+        tasks.upload_blueprint(c.cfy_id)
+
+        mock_cfy.blueprints.publish_archive.assert_not_called()
+
+    def test_content_published_concurrently(self, mock_cfy):
+        b = Blueprint.objects.create(content_hash="abc")
+        self.wd.write(("content", "abc", "blueprint.yaml"), b"test: pair")
+        c = Container.objects.create(blueprint=b)
+        call = mock_cfy.blueprints.publish_archive
+        call.side_effect = CloudifyClientError("test", status_code=409)
+
+        tasks.upload_blueprint(c.cfy_id)
+
+        self.assertTrue(b.is_published)
+
 
 @mock.patch("cfy_wrapper.models.parser.parse_from_path")
 @mock.patch("cfy_wrapper.tasks.create_deployment.client")
@@ -99,8 +155,32 @@ class CreateDeploymentTest(BaseCeleryTest):
                                        inputs={"1": "v", "3": "v"})
         l_call.assert_not_called()
 
+    def test_published_content(self, mock_cfy, mock_parse):
+        b = Blueprint.objects.create(content_hash="abc")
+        c = Container.objects.create(blueprint=b)
+        c_call = mock_cfy.deployments.create
+        mock_cfy.executions.list.return_value = [mock.Mock(id="abc123")]
+        mock_parse.return_value = {"inputs": {}}
+
+        tasks.create_deployment(c.cfy_id)
+
+        c_call.assert_called_once_with("abc", b.cfy_id, inputs={})
+
+    def test_published_content_missing(self, mock_cfy, mock_parse):
+        b = Blueprint.objects.create(content_hash="abc")
+        PublishedBlueprint.objects.create(content_hash="abc")
+        c = Container.objects.create(blueprint=b)
+        c_call = mock_cfy.deployments.create
+        c_call.side_effect = CloudifyClientError("test", status_code=404)
+        mock_parse.return_value = {"inputs": {}}
+
+        with self.assertRaises(CloudifyClientError):
+            tasks.create_deployment(c.cfy_id)
 
-@override_settings(POOL_SLEEP_INTERVAL=0.01)
+        self.assertFalse(b.is_published)
+
+
+@override_settings(POOL_SLEEP_INTERVAL=0.01, EXECUTION_WAIT_MODE="sleep")
 @mock.patch("cfy_wrapper.tasks.wait_for_execution.client")
 class WaitForExecutionTest(BaseCeleryTest):
 
@@ -153,6 +233,130 @@ class WaitForExecutionTest(BaseCeleryTest):
         l_call.assert_has_calls([mock.call("e_id")] * 2)
 
 
+@override_settings(POOL_SLEEP_INTERVAL=0.01, EXECUTION_WAIT_MODE="reschedule")
+@mock.patch("cfy_wrapper.tasks.wait_for_execution.client")
+class WaitForExecutionRescheduleTest(BaseCeleryTest):
+
+    def test_reschedule(self, mock_cfy):
+        l_call = mock_cfy.executions.get
+        l_call.return_value = mock.Mock(status="started")
+
+        with self.assertRaises(Retry):
+            tasks.wait_for_execution("e_id", False, "c_id")
+
+        l_call.assert_called_once_with("e_id")
+
+    def test_success_eager(self, mock_cfy):
+        l_call = mock_cfy.executions.get
+        l_call.side_effect = [
+            mock.Mock(status="started"), mock.Mock(status="started"),
+            mock.Mock(status="terminated")
+        ]
+
+        tasks.wait_for_execution.apply(("e_id", False, "c_id"))
+
+        l_call.assert_has_calls([mock.call("e_id")] * 3)
+
+    def test_success_immediate(self, mock_cfy):
+        l_call = mock_cfy.executions.get
+        l_call.return_value = mock.Mock(status="terminated")
+
+        tasks.wait_for_execution("e_id", False, "c_id")
+
+        l_call.assert_called_once_with("e_id")
+
+    def test_execution_failure(self, mock_cfy):
+        l_call = mock_cfy.executions.get
+        l_call.return_value = mock.Mock(status="failed")
+
+        with self.assertRaises(Exception):
+            tasks.wait_for_execution("e_id", False, "c_id")
+
+        l_call.assert_called_once_with("e_id")
+
+
+@override_settings(POOL_SLEEP_INTERVAL=0.01, EXECUTION_WAIT_MODE="watch")
+@mock.patch("cfy_wrapper.tasks.wait_for_execution.client")
+class WaitForExecutionWatchTest(BaseCeleryTest):
+
+    def test_reschedule(self, mock_cfy):
+        with self.assertRaises(Retry):
+            tasks.wait_for_execution("e_id", False, "c_id")
+
+        mock_cfy.executions.get.assert_not_called()
+        e = TrackedExecution.objects.get(id="e_id")
+        self.assertEqual("", e.status)
+
+    def test_success(self, mock_cfy):
+        TrackedExecution.objects.create(id="e_id", status="terminated")
+
+        tasks.wait_for_execution("e_id", False, "c_id")
+
+        mock_cfy.executions.get.assert_not_called()
+        self.assertEqual(0, TrackedExecution.objects.all().count())
+
+    def test_execution_failure(self, mock_cfy):
+        TrackedExecution.objects.create(id="e_id", status="failed")
+
+        with self.assertRaises(Exception):
+            tasks.wait_for_execution("e_id", False, "c_id")
+
+        self.assertEqual(0, TrackedExecution.objects.all().count())
+
+    def test_missing(self, mock_cfy):
+        TrackedExecution.objects.create(id="e_id", missing=True)
+
+        with self.assertRaises(Exception):
+            tasks.wait_for_execution("e_id", False, "c_id")
+
+        self.assertEqual(0, TrackedExecution.objects.all().count())
+
+    def test_missing_ok(self, mock_cfy):
+        TrackedExecution.objects.create(id="e_id", missing=True)
+
+        tasks.wait_for_execution("e_id", True, "c_id")
+
+        self.assertEqual(0, TrackedExecution.objects.all().count())
+
+
+@mock.patch("cfy_wrapper.utils.PooledCloudifyClient")
+class WatchExecutionsTest(BaseCeleryTest):
+
+    def test_nothing_to_watch(self, mock_cfy):
+        TrackedExecution.objects.create(id="e1", status="terminated")
+        TrackedExecution.objects.create(id="e2", missing=True)
+
+        tasks.watch_executions()
+
+        mock_cfy.return_value.executions.list.assert_not_called()
+
+    def test_single_request(self, mock_cfy):
+        for i in range(4):
+            TrackedExecution.objects.create(id="e{}".format(i))
+        l_call = mock_cfy.return_value.executions.list
+        l_call.return_value = [
+            mock.Mock(id="e0", status="started"),
+            mock.Mock(id="e1", status="terminated"),
+            mock.Mock(id="e2", status="failed"),
+        ]
+
+        tasks.watch_executions()
+
+        l_call.assert_called_once()
+        self.assertEqual({"e0", "e1", "e2", "e3"},
+                         set(l_call.mock_calls[0][2]["id"]))
+        statuses = {
+            e.id: (e.status, e.missing)
+            for e in TrackedExecution.objects.all()
+        }
+        self.assertEqual({
+            "e0": ("started", False),
+            "e1": ("terminated", False),
+            "e2": ("failed", False),
+            "e3": ("", True),
+        }, statuses)
+
+
 @mock.patch("cfy_wrapper.tasks.install_blueprint.client")
 class InstallTest(BaseCeleryTest):
 
@@ -167,6 +371,30 @@ class InstallTest(BaseCeleryTest):
         call.assert_called_once_with(b.cfy_id, "install")
         self.assertEqual("abc123", result)
 
+    def test_event(self, mock_cfy):
+        b = Blueprint.objects.create()
+        c = Container.objects.create(blueprint=b)
+
+        tasks.install_blueprint(c.cfy_id)
+
+        e = Event.objects.get()
+        self.assertEqual(c, e.container)
+        self.assertEqual(b, e.blueprint)
+        self.assertEqual(Blueprint.State.installing, e.state)
+        self.assertTrue(e.busy)
+
+    def test_on_failure(self, mock_cfy):
+        b = Blueprint.objects.create(state=Blueprint.State.installing)
+        c = Container.objects.create(blueprint=b, busy=True)
+
+        tasks.install_blueprint.on_failure(Exception("test"), "task_id",
+                                           (c.cfy_id,), {}, None)
+
+        self.assertEqual([
+            (-Blueprint.State.installing, True),
+            (-Blueprint.State.installing, False),
+        ], list(Event.objects.order_by("id").values_list("state", "busy")))
+
     def test_fail(self, mock_cfy):
         b = Blueprint.objects.create()
         c = Container.objects.create(blueprint=b)
@@ -291,6 +519,45 @@ class FetchOutputsTest(BaseCeleryTest):
         self.assertEqual(b.outputs, result)
         self.assertEqual(b.state, Blueprint.State.deployed)
 
+    def test_topology(self, mock_cfy):
+        b = Blueprint.objects.create()
+        c = Container.objects.create(blueprint=b)
+        mock_cfy.deployments.get.return_value = {}
+        mock_cfy.deployments.outputs.get.return_value = {}
+        mock_cfy.nodes.list.return_value = [
+            mock.Mock(id="nid1", type="node.Type1"),
+        ]
+        mock_cfy.node_instances.list.return_value = [
+            mock.Mock(id="id1", node_id="nid1", host_id="id1",
+                      runtime_properties=dict(ip="127.0.0.1")),
+        ]
+
+        tasks.fetch_blueprint_outputs(c.cfy_id)
+
+        b.refresh_from_db()
+        self.assertEqual([{"id": "id1", "node_id": "nid1", "ip": "127.0.0.1",
+                           "components": ["node.Type1"]}], b.topology)
+        mock_cfy.nodes.list.assert_called_once_with(
+            _offset=0, _size=1000, deployment_id=b.cfy_id,
+            _include=["id", "type"]
+        )
+
+    def test_topology_error(self, mock_cfy):
+        b = Blueprint.objects.create()
+        c = Container.objects.create(blueprint=b)
+        mock_cfy.deployments.get.return_value = {}
+        mock_cfy.deployments.outputs.get.return_value = {
+            "outputs": {"key": "value"},
+        }
+        mock_cfy.nodes.list.side_effect = CloudifyClientError("error")
+
+        tasks.fetch_blueprint_outputs(c.cfy_id)
+
+        b.refresh_from_db()
+        self.assertIsNone(b.topology)
+        self.assertEqual("value", b.outputs["key"]["value"])
+        self.assertEqual(Blueprint.State.deployed, b.state)
+
 
 @mock.patch("cfy_wrapper.tasks.uninstall_blueprint.client")
 class UninstallTest(BaseCeleryTest):
@@ -306,6 +573,15 @@ class UninstallTest(BaseCeleryTest):
         call.assert_called_once_with(b.cfy_id, "uninstall")
         self.assertEqual("abc123", result)
 
+    def test_clears_topology(self, mock_cfy):
+        b = Blueprint.objects.create(topology=[])
+        c = Container.objects.create(blueprint=b)
+
+        tasks.uninstall_blueprint(c.cfy_id)
+
+        b.refresh_from_db()
+        self.assertIsNone(b.topology)
+
     def test_fail(self, mock_cfy):
         b = Blueprint.objects.create()
         c = Container.objects.create(blueprint=b)
@@ -392,6 +668,63 @@ class DeleteBlueprintTest(BaseCeleryTest):
 
         call.assert_called_once_with(b.cfy_id)
 
+    def test_published_content(self, mock_cfy):
+        b = Blueprint.objects.create(content_hash="abc")
+        PublishedBlueprint.objects.create(content_hash="abc")
+        c = Container.objects.create(blueprint=b)
+
+        tasks.delete_blueprint(c.cfy_id)
+
+        mock_cfy.blueprints.delete.assert_called_once_with("abc")
+        self.assertFalse(b.is_published)
+
+    def test_published_content_redeploy(self, mock_cfy):
+        b = Blueprint.objects.create(content_hash="abc")
+        PublishedBlueprint.objects.create(content_hash="abc")
+        c = Container.objects.create(blueprint=b, queue=b)
+
+        tasks.delete_blueprint(c.cfy_id)
+
+        b.refresh_from_db()
+        mock_cfy.blueprints.delete.assert_not_called()
+        self.assertTrue(b.is_published)
+        self.assertEqual(b.state, Blueprint.State.present)
+
+    def test_published_content_shared(self, mock_cfy):
+        b = Blueprint.objects.create(content_hash="abc")
+        other = Blueprint.objects.create(content_hash="abc")
+        Container.objects.create(blueprint=other)
+        PublishedBlueprint.objects.create(content_hash="abc")
+        c = Container.objects.create(blueprint=b)
+
+        tasks.delete_blueprint(c.cfy_id)
+
+        mock_cfy.blueprints.delete.assert_not_called()
+        self.assertTrue(b.is_published)
+
+    def test_published_content_queued_elsewhere(self, mock_cfy):
+        b = Blueprint.objects.create(content_hash="abc")
+        other = Blueprint.objects.create(content_hash="abc")
+        Container.objects.create(queue=other)
+        PublishedBlueprint.objects.create(content_hash="abc")
+        c = Container.objects.create(blueprint=b)
+
+        tasks.delete_blueprint(c.cfy_id)
+
+        mock_cfy.blueprints.delete.assert_not_called()
+        self.assertTrue(b.is_published)
+
+    def test_published_content_historical(self, mock_cfy):
+        b = Blueprint.objects.create(content_hash="abc")
+        Blueprint.objects.create(content_hash="abc")
+        PublishedBlueprint.objects.create(content_hash="abc")
+        c = Container.objects.create(blueprint=b)
+
+        tasks.delete_blueprint(c.cfy_id)
+
+        mock_cfy.blueprints.delete.assert_called_once_with("abc")
+        self.assertFalse(b.is_published)
+
 
 @mock.patch.object(tasks, "requests")
 class RegisterAppTest(BaseCeleryTest):
@@ -500,6 +833,142 @@ class ProcessContainerQueue(BaseCeleryTest):
         self.assertIsNone(c.queue)
 
 
+class ReleaseContainerTest(BaseCeleryTest):
+
+    def test_release(self):
+        b = Blueprint.objects.create(state=Blueprint.State.deployed)
+        c = Container.objects.create(blueprint=b, busy=True)
+
+        tasks.release_container(c.cfy_id)
+
+        c.refresh_from_db()
+        self.assertFalse(c.busy)
+        e = Event.objects.get()
+        self.assertEqual(b, e.blueprint)
+        self.assertEqual(Blueprint.State.deployed, e.state)
+        self.assertFalse(e.busy)
+
+    def test_release_empty(self):
+        c = Container.objects.create(busy=True)
+
+        tasks.release_container(c.cfy_id)
+
+        e = Event.objects.get()
+        self.assertIsNone(e.blueprint)
+        self.assertIsNone(e.state)
+        self.assertIsNone(e.state_name)
+
+    def test_stale_instance_save(self):
+        c = Container.objects.create(busy=True)
+        stale = Container.objects.get(id=c.id)
+
+        tasks.release_container(c.cfy_id)
+
+        with self.assertRaises(RecordModifiedError):
+            with transaction.atomic():
+                stale.save()
+        self.assertFalse(Container.objects.get(id=c.id).busy)
+
+
+class IngestBlueprintTest(BaseCeleryTest):
+
+    def _queue_upload(self, content, **kwargs):
+        self.wd.write("upload", content)
+        b = Blueprint.objects.create()
+        with open(self.wd.getpath("upload")) as f:
+            b.store_upload(File(f))
+        return b, Container.objects.create(queue=b, busy=True, **kwargs)
+
+    def test_valid(self):
+        b, c = self._queue_upload(b"valid: yaml")
+
+        tasks.ingest_blueprint(c.cfy_id)
+
+        b.refresh_from_db()
+        self.assertEqual(Blueprint.Validation.valid, b.validation)
+        self.assertTrue(os.path.isfile(b.content_blueprint))
+        self.assertFalse(b.is_packed)
+
+    def test_pack(self):
+        b, c = self._queue_upload(b"valid: yaml")
+        tasks.ingest_blueprint(c.cfy_id)
+
+        tasks.pack_blueprint(c.cfy_id)
+
+        b.refresh_from_db()
+        self.assertTrue(b.is_packed)
+
+    @mock.patch.object(Blueprint, "is_published",
+                       new_callable=mock.PropertyMock, return_value=True)
+    def test_published_not_packed(self, mock_published):
+        b, c = self._queue_upload(b"valid: yaml")
+        tasks.ingest_blueprint(c.cfy_id)
+
+        tasks.pack_blueprint(c.cfy_id)
+
+        b.refresh_from_db()
+        self.assertFalse(b.is_packed)
+
+    def test_pack_not_routed_to_ingest_queue(self):
+        self.assertNotIn(tasks.pack_blueprint.name,
+                         settings.CELERY_TASK_ROUTES)
+
+    def test_invalid(self):
+        b, c = self._queue_upload(b"} not { valid } yaml {{")
+
+        with self.assertRaises(Exception):
+            tasks.ingest_blueprint(c.cfy_id)
+
+    @override_settings(BLUEPRINT_MAX_MEMBERS=1)
+    def test_rejected_archive(self):
+        self.wd.write(("toplevel", "blueprint.yaml"), b"valid: yaml")
+        self.wd.write(("toplevel", "other.yaml"), b"valid: yaml")
+        with tarfile.open(self.wd.getpath("upload.tar.gz"), "w:gz") as tar:
+            tar.add(self.wd.getpath("toplevel"), arcname="toplevel")
+        b, c = self._queue_upload(self.wd.read("upload.tar.gz"))
+
+        with self.assertRaises(Exception) as cm:
+            tasks.ingest_blueprint(c.cfy_id)
+        tasks.ingest_blueprint.on_failure(cm.exception, "task_id",
+                                          (c.cfy_id,), {}, None)
+
+        b.refresh_from_db()
+        self.assertEqual(Blueprint.Validation.invalid, b.validation)
+        self.assertEqual("Too many members in tarball", b.errors.get().message)
+        self.assertFalse(os.path.exists(b.content_folder))
+
+    def test_copy_waits_for_source(self):
+        source, _ = self._queue_upload(b"valid: yaml")
+        b = source.copy()
+        c = Container.objects.create(queue=b, busy=True)
+
+        with self.assertRaises(Retry):
+            tasks.ingest_blueprint(c.cfy_id)
+
+        source.ingest()
+        tasks.ingest_blueprint(c.cfy_id)
+
+        b.refresh_from_db()
+        self.assertEqual(Blueprint.Validation.valid, b.validation)
+        self.assertEqual(source.content_folder, b.content_folder)
+
+    def test_on_failure(self):
+        deployed = Blueprint.objects.create(state=Blueprint.State.deployed)
+        b, c = self._queue_upload(b"", blueprint=deployed)
+
+        tasks.ingest_blueprint.on_failure(Exception("test"), "task_id",
+                                          (c.cfy_id,), {}, None)
+
+        b.refresh_from_db()
+        self.assertEqual(Blueprint.Validation.invalid, b.validation)
+        self.assertEqual("test", b.errors.get().message)
+        deployed.refresh_from_db()
+        self.assertEqual(Blueprint.State.deployed, deployed.state)
+        self.assertEqual(0, deployed.errors.count())
+        c.refresh_from_db()
+        self.assertFalse(c.busy)
+
+
 class GetDeployPipe(BaseCeleryTest):
 
     def test_nonempty_queue_no_register(self):
@@ -519,4 +988,194 @@ class GetDeployPipe(BaseCeleryTest):
         self.assertEqual(7, len(pipe))
 
 
-# TODO: Add missing tests for sync_container
+@mock.patch("cfy_wrapper.tasks.chain")
+class SyncContainerTest(BaseCeleryTest):
+
+    def _tasks(self, mock_chain):
+        return [sig.task for sig in mock_chain.call_args[0]]
+
+    def test_ingest_pending(self, mock_chain):
+        b = Blueprint.objects.create(
+            validation=Blueprint.Validation.pending.value
+        )
+        c = Container.objects.create()
+
+        success, _ = tasks.sync_container(c, b, False)
+
+        self.assertTrue(success)
+        self.assertEqual([tasks.ingest_blueprint.name,
+                          tasks.pack_blueprint.name],
+                         self._tasks(mock_chain)[:2])
+
+    def test_no_ingest_valid(self, mock_chain):
+        b = Blueprint.objects.create()
+        c = Container.objects.create()
+
+        tasks.sync_container(c, b, False)
+
+        self.assertNotIn(tasks.ingest_blueprint.name, self._tasks(mock_chain))
+        self.assertNotIn(tasks.pack_blueprint.name, self._tasks(mock_chain))
+
+    def test_sets_owner(self, mock_chain):
+        b = Blueprint.objects.create()
+        c = Container.objects.create()
+
+        tasks.sync_container(c, b, False)
+
+        b.refresh_from_db()
+        self.assertEqual(c, b.owner)
+
+    def test_acquire(self, mock_chain):
+        b = Blueprint.objects.create()
+        c = Container.objects.create()
+
+        success, _ = tasks.sync_container(c, b, False)
+
+        self.assertTrue(success)
+        self.assertTrue(c.busy)
+        self.assertEqual(c, Container.objects.get(
+            id=c.id, busy=True, queue=b, version=c.version
+        ))
+        mock_chain.return_value.apply_async.assert_called_once_with()
+
+    def test_busy(self, mock_chain):
+        c = Container.objects.create(busy=True)
+
+        success, _ = tasks.sync_container(c, Blueprint.objects.create(),
+                                          False)
+
+        self.assertFalse(success)
+        mock_chain.assert_not_called()
+
+    def test_busy_in_database(self, mock_chain):
+        c = Container.objects.create()
+        Container.objects.filter(id=c.id).update(busy=True)
+
+        success, _ = tasks.sync_container(c, None, False)
+
+        self.assertFalse(success)
+        mock_chain.assert_not_called()
+
+    def test_modified_concurrently(self, mock_chain):
+        c = Container.objects.create()
+        stale = Container.objects.get(id=c.id)
+        c.description = "changed"
+        c.save()
+        b = Blueprint.objects.create()
+
+        success, _ = tasks.sync_container(stale, b, False)
+
+        self.assertFalse(success)
+        c.refresh_from_db()
+        self.assertFalse(c.busy)
+        self.assertIsNone(c.queue)
+        mock_chain.assert_not_called()
+
+    def test_single_winner(self, mock_chain):
+        c = Container.objects.create()
+        # Instances loaded by concurrent requests before any of them acquires
+        instances = [Container.objects.get(id=c.id) for _ in range(200)]
+
+        results = [
+            tasks.sync_container(i, Blueprint.objects.create(), False)[0]
+            for i in instances
+        ]
+
+        self.assertEqual(1, results.count(True))
+        self.assertEqual(1, mock_chain.call_count)
+
+    def test_removes_queue_remnant(self, mock_chain):
+        remnant = Blueprint.objects.create()
+        c = Container.objects.create(queue=remnant)
+        b = Blueprint.objects.create()
+
+        tasks.sync_container(c, b, False)
+
+        self.assertFalse(Blueprint.objects.filter(id=remnant.id).exists())
+        c.refresh_from_db()
+        self.assertEqual(b, c.queue)
+
+    def test_keeps_requeued_blueprint(self, mock_chain):
+        b = Blueprint.objects.create()
+        c = Container.objects.create(queue=b)
+
+        tasks.sync_container(c, b, False)
+
+        self.assertTrue(Blueprint.objects.filter(id=b.id).exists())
+        c.refresh_from_db()
+        self.assertEqual(b, c.queue)
+
+
+class SyncContainerStressTest(TransactionTestCase):
+    """
+    Concurrent sync_container calls on the same container. Threads need
+    a database they can share, which is why SQLite profile (see
+    dice_deploy.databases) sets TEST NAME to a file. Test is skipped if
+    local settings switch SQLite tests back to in-memory database.
+    """
+
+    THREADS = 25
+    CALLS = 8  # Per thread
+
+    def setUp(self):
+        if (connection.vendor == "sqlite" and
+                connection.is_in_memory_db(connection.settings_dict["NAME"])):
+            self.skipTest("In-memory database cannot be used from threads")
+
+        self.wd = TempDirectory()
+        self.addCleanup(self.wd.cleanup)
+        mock.patch.object(settings, "MEDIA_ROOT", self.wd.path).start()
+        mock.patch.object(tasks, "logger").start()
+        self.chain = mock.patch.object(tasks, "chain").start()
+        self.addCleanup(mock.patch.stopall)
+
+    def _sync(self, id, blueprints, start, results):
+        try:
+            # Load all instances first, so that every call races for the
+            # same version of the container
+            containers = [Container.get(id) for _ in blueprints]
+            start.wait()
+            for container, blueprint in zip(containers, blueprints):
+                success, _ = tasks.sync_container(container, blueprint, False)
+                results.append((success, blueprint))
+        except Exception as e:
+            results.append((e, None))
+        finally:
+            connection.close()
+
+    def test_single_winner(self):
+        c = Container.objects.create()
+        start = threading.Event()
+        results = []
+        threads = []
+        for _ in range(self.THREADS):
+            blueprints = [Blueprint.objects.create()
+                          for _ in range(self.CALLS)]
+            threads.append(threading.Thread(
+                target=self._sync, args=(c.cfy_id, blueprints, start, results)
+            ))
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.THREADS * self.CALLS, len(results))
+        self.assertEqual([], [r for r, _ in results if r not in (True, False)])
+        winners = [b for success, b in results if success is True]
+        self.assertEqual(1, len(winners))
+        self.assertEqual(1, self.chain.call_count)
+        c.refresh_from_db()
+        self.assertTrue(c.busy)
+        self.assertEqual(winners[0], c.queue)
+
+
+@override_settings(RETENTION_KEEP_BLUEPRINTS=3, RETENTION_MAX_AGE=None,
+                   RETENTION_KEEP_ERRORS=5, RETENTION_BATCH_SIZE=7)
+@mock.patch("cfy_wrapper.retention.apply_retention")
+class PruneHistoryTest(BaseCeleryTest):
+
+    def test_uses_settings(self, mock_apply):
+        tasks.prune_history()
+
+        mock_apply.assert_called_once_with(3, None, 5, 7)
@@ -0,0 +1,102 @@
+from .base import BaseTest
+
+from cfy_wrapper import topology
+
+import mock
+
+
+def instance(id, node_id, host_id, ip=None):
+    return mock.Mock(id=id, node_id=node_id, host_id=host_id,
+                     runtime_properties={} if ip is None else dict(ip=ip))
+
+
+class IterPagesTest(BaseTest):
+
+    def test_single_page(self):
+        list_func = mock.Mock(return_value=[1, 2])
+
+        items = list(topology.iter_pages(list_func, 3, deployment_id="d"))
+
+        self.assertEqual([1, 2], items)
+        list_func.assert_called_once_with(_offset=0, _size=3,
+                                          deployment_id="d")
+
+    def test_multiple_pages(self):
+        list_func = mock.Mock(side_effect=[[1, 2], [3, 4], []])
+
+        items = list(topology.iter_pages(list_func, 2))
+
+        self.assertEqual([1, 2, 3, 4], items)
+        self.assertEqual([
+            mock.call(_offset=0, _size=2),
+            mock.call(_offset=2, _size=2),
+            mock.call(_offset=4, _size=2),
+        ], list_func.mock_calls)
+
+    def test_lazy(self):
+        list_func = mock.Mock(side_effect=[[1, 2], [3]])
+
+        items = topology.iter_pages(list_func, 2)
+        next(items)
+
+        list_func.assert_called_once()
+
+
+class TopologyBuilderTest(BaseTest):
+
+    def test_build(self):
+        builder = topology.TopologyBuilder({"vm": "t.VM", "app": "t.App"})
+        for i in [instance("vm1", "vm", "vm1", "1.1.1.1"),
+                  instance("app1", "app", "vm1"),
+                  instance("net1", "net", None)]:
+            builder.add(i)
+
+        self.assertEqual([{
+            "id": "vm1", "node_id": "vm", "ip": "1.1.1.1",
+            "components": ["t.VM", "t.App"],
+        }], builder.vms)
+
+    def test_component_before_host(self):
+        builder = topology.TopologyBuilder({"vm": "t.VM", "app": "t.App"})
+        builder.add(instance("app1", "app", "vm1"))
+        builder.add(instance("vm1", "vm", "vm1", "1.1.1.1"))
+
+        self.assertEqual(["t.App", "t.VM"], builder.vms[0]["components"])
+
+    def test_missing_host(self):
+        builder = topology.TopologyBuilder({"app": "t.App"})
+        builder.add(instance("app1", "app", "vm1"))
+
+        self.assertEqual([], builder.vms)
+
+    def test_missing_ip(self):
+        builder = topology.TopologyBuilder({"vm": "t.VM"})
+        builder.add(instance("vm1", "vm", "vm1"))
+
+        self.assertIsNone(builder.vms[0]["ip"])
+
+
+class BuildTest(BaseTest):
+
+    def test_build(self):
+        client = mock.Mock()
+        client.nodes.list.side_effect = [
+            [mock.Mock(id="vm", type="t.VM"),
+             mock.Mock(id="app", type="t.App")],
+            [],
+        ]
+        client.node_instances.list.side_effect = [
+            [instance("app1", "app", "vm2"), instance("vm1", "vm", "vm1")],
+            [instance("vm2", "vm", "vm2")],
+        ]
+
+        vms = topology.build(client, "dep", page_size=2)
+
+        self.assertEqual({
+            "vm1": ["t.VM"],
+            "vm2": ["t.App", "t.VM"],
+        }, {vm["id"]: vm["components"] for vm in vms})
+        client.node_instances.list.assert_called_with(
+            _offset=2, _size=2, deployment_id="dep",
+            _include=["id", "node_id", "host_id", "runtime_properties"]
+        )
@@ -0,0 +1,51 @@
+from .base import BaseTest
+
+from cfy_wrapper.uploadhandlers import MaxSizeUploadHandler
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.http import HttpRequest
+from django.http.multipartparser import MultiPartParser
+from django.test import override_settings
+from django.test.client import encode_multipart, BOUNDARY
+
+import io
+
+
+class MaxSizeUploadHandlerTest(BaseTest):
+
+    def _parse(self, content):
+        request = HttpRequest()
+        body = encode_multipart(BOUNDARY, {
+            "file": SimpleUploadedFile("blueprint.yaml", content),
+        })
+        meta = {
+            "CONTENT_TYPE": "multipart/form-data; boundary=" + BOUNDARY,
+            "CONTENT_LENGTH": len(body),
+        }
+        handlers = [MaxSizeUploadHandler(request),
+                    TemporaryFileUploadHandler(request)]
+        for handler in handlers:
+            handler.chunk_size = 16
+        _, files = MultiPartParser(meta, io.BytesIO(body), handlers).parse()
+        return request, files
+
+    @override_settings(BLUEPRINT_MAX_UPLOAD_SIZE=100)
+    def test_within_limit(self):
+        request, files = self._parse(b"a" * 100)
+
+        self.assertEqual(b"a" * 100, files["file"].read())
+        self.assertFalse(hasattr(request, "upload_too_large"))
+
+    @override_settings(BLUEPRINT_MAX_UPLOAD_SIZE=100)
+    def test_over_limit(self):
+        request, files = self._parse(b"a" * 101)
+
+        self.assertNotIn("file", files)
+        self.assertTrue(request.upload_too_large)
+
+    @override_settings(BLUEPRINT_MAX_UPLOAD_SIZE=None)
+    def test_no_limit(self):
+        _, files = self._parse(b"a" * 1000)
+
+        self.assertEqual(1000, files["file"].size)
@@ -45,5 +45,20 @@ class UrlTest(BaseTest):
     def test_errors_bad(self):
         self._test_bad_path("/containers/bad-path/errors/")
 
+    def test_container_events(self):
+        self._test_path("/containers/1234-abcd/events", "container_events")
+
+    def test_container_events_bad(self):
+        self._test_bad_path("/containers/bad-path/events/")
+
+    def test_batch_deploy(self):
+        self._test_path("/batch/deploy", "batch_deploy")
+
+    def test_batch_teardown(self):
+        self._test_path("/batch/teardown", "batch_teardown")
+
+    def test_events(self):
+        self._test_path("/events", "events")
+
     def test_inputs(self):
         self._test_path("/inputs", "inputs")
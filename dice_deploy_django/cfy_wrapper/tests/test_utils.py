@@ -2,7 +2,11 @@ from .base import BaseTest
 
 from cfy_wrapper import utils
 
+from django.test import override_settings
+
 import tarfile
+import fcntl
+import mock
 import stat
 import os
 
@@ -40,7 +44,9 @@ class ExtractArchiveTest(BaseTest):
         self.wd.write(file, b"test_content")
         # Test invalidness
         with open(self.wd.getpath(file), "rb") as tar:
-            self.assertFalse(utils.extract_archive(tar, self.wd.path)[0])
+            success, msg = utils.extract_archive(tar, self.wd.path)
+        self.assertIsNone(success)
+        self.assertEqual("Not a tarball", msg)
 
     def test_no_toplevel(self):
         # Prepare files
@@ -52,7 +58,7 @@ class ExtractArchiveTest(BaseTest):
             tar.add(self.wd.getpath(file), arcname=file)
         # Test invalidness
         with open(archive, "rb") as tar:
-            self.assertFalse(utils.extract_archive(tar, self.wd.path)[0])
+            self.assertIs(False, utils.extract_archive(tar, self.wd.path)[0])
 
     def test_multiple_toplevels(self):
         # Prepare files
@@ -66,7 +72,7 @@ class ExtractArchiveTest(BaseTest):
                 tar.add(self.wd.getpath(file), arcname=file)
         # Test invalidness
         with open(archive, "rb") as tar:
-            self.assertFalse(utils.extract_archive(tar, self.wd.path)[0])
+            self.assertIs(False, utils.extract_archive(tar, self.wd.path)[0])
 
     def test_absolute_path(self):
         # This filter is needed to force absolute names in archive
@@ -83,122 +89,101 @@ class ExtractArchiveTest(BaseTest):
             tar.add(file, filter=filter)
         # Test invalidness
         with open(archive, "rb") as tar:
-            self.assertFalse(utils.extract_archive(tar, self.wd.path)[0])
+            self.assertIs(False, utils.extract_archive(tar, self.wd.path)[0])
 
-    def test_missing_destination(self):
-        # Prepare files
-        self.wd.write(("toplevel", "file1.txt"), b"content")
-        toplevel = self.wd.getpath("toplevel")
-        # Setup archive
+    def _create_archive(self, arcname="toplevel"):
+        self.wd.write(("toplevel", "a", "file1.txt"), b"content")
+        self.wd.write(("toplevel", "b", "file2.txt"), b"content")
         archive = self.wd.getpath("test.tar.gz")
         with tarfile.open(archive, "w:gz") as tar:
-            tar.add(toplevel, arcname="toplevel")
-        # Test validness
+            tar.add(self.wd.getpath("toplevel"), arcname=arcname)
+        self.wd.makedir("result")
+        return archive
+
+    def test_permissions(self):
+        archive = self._create_archive()
         result = self.wd.getpath("result")
-        with open(archive, "rb") as tar:
-            with self.assertRaises(AssertionError):
-                utils.extract_archive(tar, result)
+        os.chmod(self.wd.getpath(("toplevel", "a", "file1.txt")),
+                 stat.S_IRWXU)
 
+        with open(archive, "rb") as tar:
+            self.assertTrue(utils.extract_archive(tar, result)[0])
 
-class ChangePermissionsTest(BaseTest):
-
-    # Test tree:
-    #
-    #   a/
-    #   +-- b/
-    #   |   `-- 1.txt
-    #   +-- c/
-    #   |   +-- d/
-    #   |   |   +-- 4.txt
-    #   |   `-- 3.txt
-    #   +-- e/
-    #   +-- f/
-    #   `-- 2.txt
-    FOLDERS = ['a', 'a/b', 'a/c', 'a/c/d', 'a/e', 'a/f']
-    FILES = ['a/b/1.txt', 'a/2.txt', 'a/c/3.txt', 'a/c/d/4.txt']
-
-    # Permissions tha we are setting during test
-    FOLDER_PERMISSIONS = stat.S_IRWXU | stat.S_IROTH
-    FILE_PERMISSIONS = stat.S_IRWXU | stat.S_IWOTH
-
-    def setUp(self):
-        super(ChangePermissionsTest, self).setUp()
-
-        # Create test folder tree
-        for d in self.FOLDERS:
-            self.wd.makedir(d)
-            os.chmod(self.wd.getpath(d), stat.S_IRWXU)
-        for f in self.FILES:
-            self.wd.write(f, 'MOCK')
-            os.chmod(self.wd.getpath(d), stat.S_IRWXU)
-
-    def _get_permission_snapshot(self):
-        def get_perms(path):
-            full_path = self.wd.getpath(path)
+        def get_perms(*path):
+            full_path = os.path.join(result, *path)
             return stat.S_IMODE(os.stat(full_path).st_mode)
 
-        return (
-            {d: get_perms(d) for d in self.FOLDERS},
-            {f: get_perms(f) for f in self.FILES}
-        )
-
-    def _run(self, path):
-        utils.change_permissions(self.wd.getpath(path),
-                                 self.FOLDER_PERMISSIONS,
-                                 self.FILE_PERMISSIONS)
+        self.assertEqual(utils.FOLDER_PERMISSIONS, get_perms())
+        self.assertEqual(utils.FOLDER_PERMISSIONS, get_perms("a"))
+        self.assertEqual(utils.FILE_PERMISSIONS, get_perms("a", "file1.txt"))
 
-    # Actual tests
-    def test_missing_path(self):
-        with self.assertRaises(AssertionError):
-            self._run(self.wd.getpath('NON_EXISTENT'))
+    def test_parent_reference(self):
+        def filter(info):
+            info.name = info.name.replace("toplevel/a", "toplevel/../../a")
+            return info
 
-    def test_file(self):
-        with self.assertRaises(AssertionError):
-            self._run(self.wd.getpath('a/2.txt'))
+        self.wd.write(("toplevel", "a", "file1.txt"), b"content")
+        archive = self.wd.getpath("test.tar.gz")
+        with tarfile.open(archive, "w:gz") as tar:
+            tar.add(self.wd.getpath("toplevel"), arcname="toplevel",
+                    filter=filter)
+        self.wd.makedir("result")
 
-    def test_empty_dir(self):
-        old_folder_perms, old_file_perms = self._get_permission_snapshot()
-        old_folder_perms['a/e'] = self.FOLDER_PERMISSIONS
+        with open(archive, "rb") as tar:
+            success, _ = utils.extract_archive(tar, self.wd.getpath("result"))
 
-        self._run('a/e')
+        self.assertFalse(success)
+        self.wd.compare([], path="result")
 
-        new_folder_perms, new_file_perms = self._get_permission_snapshot()
-        self.assertEqual(old_folder_perms, new_folder_perms)
-        self.assertEqual(old_file_perms, new_file_perms)
+    def test_size_limit(self):
+        archive = self._create_archive()
 
-    def test_dir_with_files_only(self):
-        old_folder_perms, old_file_perms = self._get_permission_snapshot()
-        old_folder_perms['a/b'] = self.FOLDER_PERMISSIONS
-        old_file_perms['a/b/1.txt'] = self.FILE_PERMISSIONS
+        with open(archive, "rb") as tar:
+            success, msg = utils.extract_archive(
+                tar, self.wd.getpath("result"), max_size=10
+            )
 
-        self._run('a/b')
+        self.assertIs(False, success)
+        self.assertEqual("Tarball content is too large", msg)
+        self.wd.compare([], path="result")
 
-        new_folder_perms, new_file_perms = self._get_permission_snapshot()
-        self.assertEqual(old_folder_perms, new_folder_perms)
-        self.assertEqual(old_file_perms, new_file_perms)
+    def test_member_limit(self):
+        archive = self._create_archive()
 
-    def test_subtree(self):
-        old_folder_perms, old_file_perms = self._get_permission_snapshot()
-        old_folder_perms['a/c'] = self.FOLDER_PERMISSIONS
-        old_folder_perms['a/c/d'] = self.FOLDER_PERMISSIONS
-        old_file_perms['a/c/3.txt'] = self.FILE_PERMISSIONS
-        old_file_perms['a/c/d/4.txt'] = self.FILE_PERMISSIONS
+        with open(archive, "rb") as tar:
+            success, msg = utils.extract_archive(
+                tar, self.wd.getpath("result"), max_members=3
+            )
 
-        self._run('a/c')
+        self.assertFalse(success)
+        self.assertEqual("Too many members in tarball", msg)
+        self.wd.compare([], path="result")
 
-        new_folder_perms, new_file_perms = self._get_permission_snapshot()
-        self.assertEqual(old_folder_perms, new_folder_perms)
-        self.assertEqual(old_file_perms, new_file_perms)
+    def test_within_limits(self):
+        archive = self._create_archive()
 
-    def test_complete_tree(self):
-        old_folder_perms = {k: self.FOLDER_PERMISSIONS for k in self.FOLDERS}
-        old_file_perms = {k: self.FILE_PERMISSIONS for k in self.FILES}
+        with open(archive, "rb") as tar:
+            success, _ = utils.extract_archive(
+                tar, self.wd.getpath("result"), max_size=14, max_members=5
+            )
 
-        self._run('a')
+        self.assertTrue(success)
+        self.wd.compare(["a/", "a/file1.txt", "b/", "b/file2.txt"],
+                        path="result")
 
-        new_folder_perms, new_file_perms = self._get_permission_snapshot()
-        self.assertEqual(old_folder_perms, new_folder_perms)
-        self.assertEqual(old_file_perms, new_file_perms)
+    def test_missing_destination(self):
+        # Prepare files
+        self.wd.write(("toplevel", "file1.txt"), b"content")
+        toplevel = self.wd.getpath("toplevel")
+        # Setup archive
+        archive = self.wd.getpath("test.tar.gz")
+        with tarfile.open(archive, "w:gz") as tar:
+            tar.add(toplevel, arcname="toplevel")
+        # Test validness
+        result = self.wd.getpath("result")
+        with open(archive, "rb") as tar:
+            with self.assertRaises(AssertionError):
+                utils.extract_archive(tar, result)
 
 
 class CreateArchiveTest(BaseTest):
@@ -243,3 +228,139 @@ class CreateArchiveTest(BaseTest):
             "toplevel/a",
             "toplevel/a/file1.txt",
         }, members)
+
+    def _read_archive(self, archive):
+        with tarfile.open(archive, "r:gz") as tar:
+            return {info.name: tar.extractfile(info).read()
+                    for info in tar.getmembers() if info.isfile()}
+
+    @mock.patch.object(utils, "ARCHIVE_BLOCK_SIZE", 1000)
+    def test_parallel_creation(self):
+        for i in range(20):
+            self.wd.write(("toplevel", "{}.txt".format(i)), b"x" * 3000 * i)
+        toplevel = self.wd.getpath("toplevel")
+        serial = self.wd.getpath("serial.tar.gz")
+        parallel = self.wd.getpath("parallel.tar.gz")
+
+        utils.create_archive(serial, toplevel)
+        utils.create_archive(parallel, toplevel, threads=4)
+
+        self.assertEqual(self._read_archive(serial),
+                         self._read_archive(parallel))
+        self.wd.compare(["parallel.tar.gz", "serial.tar.gz", "toplevel"],
+                        recursive=False)
+
+    def test_no_compression(self):
+        self.wd.write(("toplevel", "a.txt"), b"a" * 100000)
+        toplevel = self.wd.getpath("toplevel")
+        archive = self.wd.getpath("test.tar.gz")
+
+        utils.create_archive(archive, toplevel, level=0)
+
+        self.assertGreater(os.path.getsize(archive), 100000)
+        self.assertEqual({"toplevel/a.txt": b"a" * 100000},
+                         self._read_archive(archive))
+
+    def test_missing_folder_parallel(self):
+        archive = self.wd.getpath("test.tar.gz")
+        toplevel = self.wd.getpath("non-existing-folder")
+        with self.assertRaises(OSError):
+            utils.create_archive(archive, toplevel, threads=2)
+        self.wd.compare([])
+
+
+class ContentLockTest(BaseTest):
+
+    def _is_locked(self):
+        with open(self.wd.getpath("content.lock"), "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return True
+            fcntl.flock(f, fcntl.LOCK_UN)
+            return False
+
+    def test_exclusive(self):
+        with utils.content_lock():
+            self.assertTrue(self._is_locked())
+        self.assertFalse(self._is_locked())
+
+    def test_released_on_error(self):
+        with self.assertRaises(ValueError):
+            with utils.content_lock():
+                raise ValueError()
+        self.assertFalse(self._is_locked())
+
+
+class HashFolderTest(BaseTest):
+
+    def test_same_content(self):
+        self.wd.write(("a", "x", "file1.txt"), b"content")
+        self.wd.write(("a", "file2.txt"), b"content")
+        self.wd.write(("b", "x", "file1.txt"), b"content")
+        self.wd.write(("b", "file2.txt"), b"content")
+        self.assertEqual(utils.hash_folder(self.wd.getpath("a")),
+                         utils.hash_folder(self.wd.getpath("b")))
+
+    def test_different_content(self):
+        self.wd.write(("a", "file.txt"), b"content")
+        self.wd.write(("b", "file.txt"), b"other content")
+        self.assertNotEqual(utils.hash_folder(self.wd.getpath("a")),
+                            utils.hash_folder(self.wd.getpath("b")))
+
+    def test_different_names(self):
+        self.wd.write(("a", "file1.txt"), b"content")
+        self.wd.write(("b", "file2.txt"), b"content")
+        self.assertNotEqual(utils.hash_folder(self.wd.getpath("a")),
+                            utils.hash_folder(self.wd.getpath("b")))
+
+    def test_missing_folder(self):
+        self.wd.makedir("empty")
+        self.assertEqual(utils.hash_folder(self.wd.getpath("empty")),
+                         utils.hash_folder(self.wd.getpath("missing")))
+
+
+class GetCfyClientTest(BaseTest):
+
+    def test_client_reused(self):
+        client = utils.get_cfy_client()
+        self.assertIs(client, utils.get_cfy_client())
+
+    @mock.patch("cfy_wrapper.utils.os.getpid")
+    def test_new_client_after_fork(self, mock_getpid):
+        mock_getpid.return_value = 1
+        parent = utils.get_cfy_client()
+        mock_getpid.return_value = 2
+        child = utils.get_cfy_client()
+
+        self.assertIsNot(parent, child)
+        self.assertIsNot(parent._client.session, child._client.session)
+        self.assertEqual([2], list(utils._cfy_clients))
+
+    @override_settings(CFY_MANAGER_CONNECT_TIMEOUT=3,
+                       CFY_MANAGER_READ_TIMEOUT=7)
+    def test_requests_use_session(self):
+        client = utils.get_cfy_client()
+        session = mock.Mock()
+        session.get.return_value.status_code = 200
+        session.get.return_value.json.return_value = {"id": "e1"}
+        client._client.session = session
+
+        client.executions.get("e1")
+
+        session.get.assert_called_once()
+        self.assertEqual((3, 7), session.get.mock_calls[0][2]["timeout"])
+        headers = session.get.mock_calls[0][2]["headers"]
+        self.assertTrue(headers["Authorization"].startswith("Basic "))
+
+    @override_settings(CFY_MANAGER_PROTOCOL="https")
+    def test_sub_clients_share_session_client(self):
+        client = utils.get_cfy_client()
+
+        self.assertIsInstance(client._client, utils._SessionHTTPClient)
+        self.assertTrue(client._client.url.startswith("https://"))
+        for sub_client in (client.blueprints, client.deployments,
+                           client.executions, client.nodes,
+                           client.deployments.outputs,
+                           client.node_instances):
+            self.assertIs(client._client, sub_client.api)
@@ -1,6 +1,6 @@
 from .base import BaseViewTest, date2str, identity, Field
 
-from cfy_wrapper.models import Blueprint, Container, Input, Error
+from cfy_wrapper.models import Blueprint, Container, Event, Input, Error
 from cfy_wrapper.views import (
     HeartBeatView,
     ContainersView,
@@ -8,17 +8,26 @@ from cfy_wrapper.views import (
     ContainerBlueprintView,
     ContainerNodesView,
     ContainerErrorsView,
+    ContainerEventsView,
+    BatchDeployView,
+    BatchTeardownView,
+    EventsView,
     InputsView,
+    BlueprintsView,
     BlueprintIdView
 )
 
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from rest_framework.response import Response
 from rest_framework import status
 
 import mock
 import json
 import io
+import os
 
 CONTAINER_FIELDS = (
     Field("id", str, "id"),
@@ -30,6 +39,7 @@ CONTAINER_FIELDS = (
 BLUEPRINT_FIELDS = (
     Field("cfy_id", identity, "id"),
     Field("state_name", identity, "state_name"),
+    Field("validation_name", identity, "validation_name"),
     Field("modified_date", date2str, "modified_date"),
     Field("outputs", identity, "outputs")
 )
@@ -119,6 +129,164 @@ class ContainersTest(BaseViewTest):
         self.compare(CONTAINER_FIELDS, data, c)
         self.compare(BLUEPRINT_FIELDS, data[0]["blueprint"], b)
 
+    def _assert_list_queries(self, containers):
+        for _ in range(containers):
+            b = Blueprint.objects.create()
+            b.log_error("message 1")
+            b.log_error("message 2")
+            Container.objects.create(blueprint=b)
+        req = self.get(reverse("containers"), auth=True)
+
+        # One query for validator, one for containers with blueprints and
+        # one for errors
+        with self.assertNumQueries(3):
+            resp = ContainersView.as_view()(req)
+
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertEqual(containers, len(resp.data))
+        for item in resp.data:
+            self.assertEqual(2, len(item["blueprint"]["errors"]))
+
+    def test_get_constant_queries_single(self):
+        self._assert_list_queries(1)
+
+    def test_get_constant_queries_many(self):
+        self._assert_list_queries(10)
+
+    def test_get_paginated(self):
+        cs = [Container.objects.create() for _ in range(5)]
+        url = reverse("containers") + "?limit=2"
+        ids = []
+
+        while url is not None:
+            resp = ContainersView.as_view()(self.get(url, auth=True))
+            self.assertEqual(status.HTTP_200_OK, resp.status_code)
+            self.assertTrue(len(resp.data) <= 2)
+            ids.extend(item["id"] for item in resp.data)
+            url = None
+            for link in resp.get("Link", "").split(", "):
+                if link.endswith('rel="next"'):
+                    url = link[1:link.index(">")]
+
+        self.assertEqual([c.cfy_id for c in cs], ids)
+
+    def test_get_not_paginated(self):
+        for _ in range(3):
+            Container.objects.create()
+        req = self.get(reverse("containers"), auth=True)
+
+        resp = ContainersView.as_view()(req)
+
+        self.assertEqual(3, len(resp.data))
+        self.assertFalse(resp.has_header("Link"))
+
+    def test_get_fields(self):
+        b = Blueprint.objects.create()
+        b.log_error("message")
+        Container.objects.create(blueprint=b)
+        url = reverse("containers") + "?fields=id,busy"
+        req = self.get(url, auth=True)
+
+        # Validator and containers (no error prefetching)
+        with self.assertNumQueries(2):
+            resp = ContainersView.as_view()(req)
+
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertEqual({"id", "busy"}, set(resp.data[0]))
+
+    def test_get_large_blueprint_fields_not_loaded(self):
+        b = Blueprint.objects.create(topology=[], declared_inputs={})
+        Container.objects.create(blueprint=b)
+
+        for query in ("", "?fields=id,blueprint"):
+            req = self.get(reverse("containers") + query, auth=True)
+            with CaptureQueriesContext(connection) as queries:
+                resp = ContainersView.as_view()(req)
+
+            self.assertEqual(b.cfy_id, resp.data[0]["blueprint"]["id"])
+            for executed in queries:
+                self.assertNotIn('."topology"', executed["sql"])
+                self.assertNotIn('."declared_inputs"', executed["sql"])
+
+    def test_get_unknown_field(self):
+        url = reverse("containers") + "?fields=id,bad"
+        req = self.get(url, auth=True)
+
+        resp = ContainersView.as_view()(req)
+
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, resp.status_code)
+
+    def _get_filtered(self, query):
+        states = [Blueprint.State.deployed, -Blueprint.State.deployed,
+                  Blueprint.State.installing, -Blueprint.State.installing]
+        for state in states:
+            b = Blueprint.objects.create(state=state)
+            Container.objects.create(blueprint=b)
+        Container.objects.create()
+        req = self.get(reverse("containers") + query, auth=True)
+        resp = ContainersView.as_view()(req)
+        return resp.status_code, [
+            (c["blueprint"]["state_name"], c["blueprint"]["in_error"])
+            for c in resp.data
+        ] if resp.status_code == status.HTTP_200_OK else None
+
+    def test_get_state_filter(self):
+        code, data = self._get_filtered("?state=deployed")
+        self.assertEqual(status.HTTP_200_OK, code)
+        self.assertEqual({("deployed", False), ("deployed", True)}, set(data))
+
+    def test_get_in_error_filter(self):
+        code, data = self._get_filtered("?state=installing&in_error=false")
+        self.assertEqual(status.HTTP_200_OK, code)
+        self.assertEqual([("installing", False)], data)
+
+    def test_get_invalid_filter(self):
+        code, _ = self._get_filtered("?state=bad")
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, code)
+        code, _ = self._get_filtered("?in_error=maybe")
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, code)
+
+    def test_get_not_modified(self):
+        b = Blueprint.objects.create()
+        Container.objects.create(blueprint=b)
+        url = reverse("containers")
+        etag = self.client.get(url)["ETag"]
+
+        # Token lookup and validator
+        with self.assertNumQueries(2):
+            resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, resp.status_code)
+        self.assertEqual(b"", resp.content)
+
+    def test_get_modified(self):
+        b = Blueprint.objects.create()
+        Container.objects.create(blueprint=b)
+        url = reverse("containers")
+        etags = [self.client.get(url)["ETag"]]
+
+        b.state = Blueprint.State.installing
+        b.save()
+        etags.append(self.client.get(url)["ETag"])
+        b.log_error("message")
+        etags.append(self.client.get(url)["ETag"])
+        Container.objects.create()
+        etags.append(self.client.get(url)["ETag"])
+
+        self.assertEqual(len(etags), len(set(etags)))
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etags[0])
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+
+    def test_get_realistic_versions(self):
+        Container.objects.bulk_create(Container() for _ in range(6000))
+        # Versions are timestamps in microseconds
+        Container.objects.update(version=1800000000000000)
+
+        resp = self.client.get(reverse("containers"))
+
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertIn("ETag", resp)
+
     def test_get_no_containers(self):
         req = self.get(reverse("containers"), auth=True)
 
@@ -168,6 +336,29 @@ class ContainersTest(BaseViewTest):
 
 class ContainerIdTest(BaseViewTest):
 
+    def test_get_not_modified(self):
+        c = Container.objects.create()
+        url = reverse("container_id", kwargs=dict(id=c.cfy_id))
+        etag = self.client.get(url)["ETag"]
+
+        # Token lookup and validator
+        with self.assertNumQueries(2):
+            resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, resp.status_code)
+
+    def test_get_modified(self):
+        c = Container.objects.create()
+        url = reverse("container_id", kwargs=dict(id=c.cfy_id))
+        etag = self.client.get(url)["ETag"]
+
+        c.blueprint = Blueprint.objects.create()
+        c.save()
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertNotEqual(etag, resp["ETag"])
+
     def test_not_auth(self):
         kw = dict(id="abc")
         req = self.get(reverse("container_id", kwargs=kw), auth=False)
@@ -386,12 +577,12 @@ class ContainerBlueprintTest(BaseViewTest):
 
         resp = ContainerBlueprintView.as_view()(req, **kw)
 
-        self.assertEqual(status.HTTP_400_BAD_REQUEST, resp.status_code)
-        self.assertIn("detail", resp.data)
-        c.refresh_from_db()
-        self.assertIsNone(c.blueprint)
-        self.assertEqual(0, Blueprint.objects.all().count())
-        mock_sync.assert_not_called()
+        # Validation is done by ingest task
+        self.assertEqual(status.HTTP_202_ACCEPTED, resp.status_code)
+        self.assertEqual("pending", resp.data["validation_name"])
+        blueprint = Blueprint.objects.get()
+        self.assertTrue(blueprint.is_pending)
+        mock_sync.assert_called_once()
 
     @mock.patch("cfy_wrapper.tasks.sync_container", return_value=(True, "OK"))
     def test_post_valid_empty_success(self, mock_sync):
@@ -477,6 +668,58 @@ class ContainerBlueprintTest(BaseViewTest):
         mock_sync.assert_called_once()
         self.assertEqual(mock_sync.mock_calls[0][1][0], c)
         self.assertEqual(mock_sync.mock_calls[0][1][2], False)
+        blueprint = mock_sync.mock_calls[0][1][1]
+        self.assertEqual(0, Blueprint.objects.all().count())
+        self.assertFalse(os.path.exists(blueprint.upload_path))
+
+    @override_settings(BLUEPRINT_MAX_UPLOAD_SIZE=5)
+    @mock.patch("cfy_wrapper.tasks.sync_container", return_value=(True, "OK"))
+    def test_post_too_large(self, mock_sync):
+        c = Container.objects.create()
+        b = io.StringIO(u"valid: yaml")
+        kw = dict(id=str(c.id))
+        req = self.post(reverse("container_blueprint", kwargs=kw),
+                        data={"file": b}, auth=True, format="multipart")
+
+        resp = ContainerBlueprintView.as_view()(req, **kw)
+
+        self.assertEqual(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                         resp.status_code)
+        self.assertEqual(0, Blueprint.objects.all().count())
+        mock_sync.assert_not_called()
+
+    @override_settings(BLUEPRINT_MAX_UPLOAD_SIZE=5)
+    @mock.patch("cfy_wrapper.tasks.sync_container", return_value=(True, "OK"))
+    @mock.patch("django.core.files.uploadhandler."
+                "TemporaryFileUploadHandler.new_file")
+    def test_post_too_large_not_stored(self, mock_new_file, mock_sync):
+        c = Container.objects.create()
+        b = io.StringIO(u"valid: yaml")
+        kw = dict(id=str(c.id))
+        req = self.post(reverse("container_blueprint", kwargs=kw),
+                        data={"file": b}, auth=True, format="multipart")
+
+        resp = ContainerBlueprintView.as_view()(req, **kw)
+
+        self.assertEqual(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                         resp.status_code)
+        mock_new_file.assert_not_called()
+
+    @mock.patch("cfy_wrapper.tasks.sync_container", return_value=(True, "OK"))
+    @mock.patch.object(Blueprint, "store_content")
+    def test_post_upload_on_disk(self, mock_store, mock_sync):
+        c = Container.objects.create()
+        b = io.StringIO(u"valid: yaml")
+        kw = dict(id=str(c.id))
+        req = self.post(reverse("container_blueprint", kwargs=kw),
+                        data={"file": b}, auth=True, format="multipart")
+
+        ContainerBlueprintView.as_view()(req, **kw)
+
+        mock_store.assert_not_called()
+        blueprint = Blueprint.objects.get()
+        with open(blueprint.upload_path) as f:
+            self.assertEqual("valid: yaml", f.read())
 
     def test_post_no_container(self):
         kw = dict(id="abc")
@@ -582,6 +825,18 @@ class InputsTest(BaseViewTest):
         self.assertEqual(status.HTTP_200_OK, resp.status_code)
         self.compare(INPUT_FIELDS, resp.data, ins)
 
+    def test_get_fields_paginated(self):
+        for n in range(4):
+            Input.objects.create(key=str(n), value="v")
+        url = reverse("inputs") + "?fields=key&limit=3"
+        req = self.get(url, auth=True)
+
+        resp = InputsView.as_view()(req)
+
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertEqual([{"key": "0"}, {"key": "1"}, {"key": "2"}],
+                         resp.data)
+
     def test_get_render(self):
         ins = [Input.objects.create(key=str(n), value="v") for n in range(4)]
         url = reverse("inputs")
@@ -703,9 +958,9 @@ class ContainerNodesTest(BaseViewTest):
         self.assertEqual(status.HTTP_200_OK, resp.status_code)
         self.assertEqual(len(resp.data), 0)
 
-    @mock.patch("cfy_wrapper.utils.CloudifyClient")
+    @mock.patch("cfy_wrapper.utils.PooledCloudifyClient")
     def test_get_non_empty(self, mock_cfy):
-        b = Blueprint.objects.create()
+        b = Blueprint.objects.create(state=Blueprint.State.deployed)
         c = Container.objects.create(blueprint=b)
         kw = dict(id=c.cfy_id)
         req = self.get(reverse("container_nodes", kwargs=kw), auth=True)
@@ -734,10 +989,156 @@ class ContainerNodesTest(BaseViewTest):
         del resp.data[0]["components"]
         self.assertEqual({"id": "id1", "node_id": "nid1", "ip": "127.0.0.1"},
                          resp.data[0])
+        b.refresh_from_db()
+        self.assertEqual(1, len(b.topology))
+
+    @mock.patch("cfy_wrapper.utils.PooledCloudifyClient")
+    def test_get_stored(self, mock_cfy):
+        vm = {"id": "id1", "node_id": "nid1", "ip": "127.0.0.1",
+              "components": ["node.Type1"]}
+        b = Blueprint.objects.create(state=Blueprint.State.deployed,
+                                     topology=[vm])
+        c = Container.objects.create(blueprint=b)
+        kw = dict(id=c.cfy_id)
+        req = self.get(reverse("container_nodes", kwargs=kw), auth=True)
+
+        resp = ContainerNodesView.as_view()(req, c.cfy_id)
+
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertEqual([vm], resp.data)
+        mock_cfy.assert_not_called()
+
+    @mock.patch("cfy_wrapper.utils.PooledCloudifyClient")
+    def test_get_not_deployed(self, mock_cfy):
+        b = Blueprint.objects.create(state=Blueprint.State.installing)
+        c = Container.objects.create(blueprint=b)
+        kw = dict(id=c.cfy_id)
+        req = self.get(reverse("container_nodes", kwargs=kw), auth=True)
+
+        resp = ContainerNodesView.as_view()(req, c.cfy_id)
+
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertEqual([], resp.data)
+        mock_cfy.assert_not_called()
+
+    @mock.patch("cfy_wrapper.utils.PooledCloudifyClient")
+    def test_get_refresh(self, mock_cfy):
+        b = Blueprint.objects.create(state=Blueprint.State.deployed,
+                                     topology=[])
+        c = Container.objects.create(blueprint=b)
+        kw = dict(id=c.cfy_id)
+        url = reverse("container_nodes", kwargs=kw) + "?refresh=true"
+        req = self.get(url, auth=True)
+        mock_cfy.return_value.nodes.list.return_value = [
+            mock.Mock(id="nid1", type="node.Type1"),
+        ]
+        mock_cfy.return_value.node_instances.list.return_value = [
+            mock.Mock(id="id1", node_id="nid1", host_id="id1",
+                      runtime_properties=dict(ip="127.0.0.1")),
+        ]
+
+        resp = ContainerNodesView.as_view()(req, c.cfy_id)
+
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertEqual(1, len(resp.data))
+        b.refresh_from_db()
+        self.assertEqual(resp.data, b.topology)
+
+
+class BlueprintsTest(BaseViewTest):
+
+    def test_get(self):
+        bs = [Blueprint.objects.create() for _ in range(3)]
+        req = self.get(reverse("blueprints"), auth=True)
+
+        resp = BlueprintsView.as_view()(req)
+
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.compare(BLUEPRINT_FIELDS, resp.data, bs)
+
+    def _assert_list_queries(self, blueprints):
+        for _ in range(blueprints):
+            b = Blueprint.objects.create()
+            b.log_error("message")
+        req = self.get(reverse("blueprints"), auth=True)
+
+        # One query for validator, one for blueprints and one for errors
+        with self.assertNumQueries(3):
+            resp = BlueprintsView.as_view()(req)
+
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertEqual(blueprints, len(resp.data))
+
+    def test_get_constant_queries_single(self):
+        self._assert_list_queries(1)
+
+    def test_get_constant_queries_many(self):
+        self._assert_list_queries(10)
+
+    def test_get_fields(self):
+        b = Blueprint.objects.create(outputs={"key": "value"})
+        b.log_error("message")
+        url = reverse("blueprints") + "?fields=id,state_name"
+        req = self.get(url, auth=True)
+
+        with self.assertNumQueries(2):
+            resp = BlueprintsView.as_view()(req)
+
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertEqual([{"id": b.cfy_id, "state_name": "present"}],
+                         resp.data)
+
+    def test_get_not_modified(self):
+        Blueprint.objects.create()
+        url = reverse("blueprints")
+        etag = self.client.get(url)["ETag"]
+
+        # Token lookup and validator
+        with self.assertNumQueries(2):
+            resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, resp.status_code)
+
+        Blueprint.objects.create()
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+
+    def test_get_in_error_filter(self):
+        Blueprint.objects.create()
+        b = Blueprint.objects.create(state=-Blueprint.State.installing)
+        req = self.get(reverse("blueprints") + "?in_error=true", auth=True)
+
+        resp = BlueprintsView.as_view()(req)
+
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertEqual([b.cfy_id], [item["id"] for item in resp.data])
+
+    def test_get_paginated(self):
+        bs = [Blueprint.objects.create() for _ in range(3)]
+        req = self.get(reverse("blueprints") + "?limit=2", auth=True)
+
+        resp = BlueprintsView.as_view()(req)
+
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertEqual([b.cfy_id for b in bs[:2]],
+                         [item["id"] for item in resp.data])
+        self.assertTrue(resp["Link"].endswith('rel="next"'))
 
 
 class BlueprintIdTest(BaseViewTest):
 
+    def test_get_not_modified(self):
+        b = Blueprint.objects.create()
+        url = reverse("blueprint_id", kwargs=dict(blueprint_id=b.cfy_id))
+        etag = self.client.get(url)["ETag"]
+
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, resp.status_code)
+
+        b.state = Blueprint.State.installing
+        b.save()
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+
     @mock.patch("cfy_wrapper.tasks.sync_container", return_value=(True, "OK"))
     def test_delete_sync_success(self, mock_sync):
         b = Blueprint.objects.create()
@@ -844,3 +1245,300 @@ class ContainerErrorsTest(BaseViewTest):
         self.assertEqual(status.HTTP_200_OK, resp.status_code)
         data = json.loads(resp.content)
         self.compare(ERROR_FIELDS, data, list(Error.objects.all()))
+
+    def test_get_paginated(self):
+        b = Blueprint.objects.create()
+        for i in range(3):
+            b.log_error("message {}".format(i))
+        c = Container.objects.create(blueprint=b)
+        kw = dict(id=c.cfy_id)
+        url = reverse("container_errors", kwargs=kw) + "?limit=2"
+        req = self.get(url, auth=True)
+
+        resp = ContainerErrorsView.as_view()(req, **kw)
+
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertEqual(["message 0", "message 1"],
+                         [e["message"] for e in resp.data])
+        self.assertTrue(resp["Link"].endswith('rel="next"'))
+
+
+@override_settings(EVENT_MAX_WAIT=0)
+class ContainerEventsTest(BaseViewTest):
+
+    def setUp(self):
+        super(ContainerEventsTest, self).setUp()
+        self.b = Blueprint.objects.create()
+        self.c = Container.objects.create(blueprint=self.b, busy=True)
+        self.url = reverse("container_events", kwargs=dict(id=self.c.cfy_id))
+
+    def _event(self, state, container=None):
+        return Event.objects.create(container=container or self.c,
+                                    blueprint=self.b, state=state, busy=True)
+
+    def test_not_auth(self):
+        kw = dict(id=self.c.cfy_id)
+        req = self.get(self.url, auth=False)
+        resp = ContainerEventsView.as_view()(req, **kw)
+        self.assertEqual(status.HTTP_401_UNAUTHORIZED, resp.status_code)
+
+    def test_get_since_version(self):
+        e1 = self._event(Blueprint.State.uploading_to_cloudify)
+        e2 = self._event(-Blueprint.State.preparing_deployment)
+        self._event(Blueprint.State.present, Container.objects.create())
+
+        resp = self.client.get(self.url, dict(since_version=e1.id))
+
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertEqual([{
+            "version": e2.id,
+            "container": self.c.cfy_id,
+            "blueprint": self.b.cfy_id,
+            "state_name": "preparing_deployment",
+            "in_error": True,
+            "busy": True,
+            "created": date2str(e2.created),
+        }], json.loads(resp.content))
+        self.assertEqual(str(e2.id), resp["X-Events-Version"])
+
+    def test_get_from_now(self):
+        e = self._event(Blueprint.State.uploading_to_cloudify)
+
+        resp = self.client.get(self.url)
+
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertEqual([], json.loads(resp.content))
+        self.assertEqual(str(e.id), resp["X-Events-Version"])
+
+    @override_settings(EVENT_MAX_WAIT=60)
+    @mock.patch("cfy_wrapper.events.time.sleep")
+    def test_get_wait(self, mock_sleep):
+        mock_sleep.side_effect = lambda _: self._event(
+            Blueprint.State.installing
+        )
+
+        resp = self.client.get(self.url, dict(wait=30))
+
+        mock_sleep.assert_called_once()
+        data = json.loads(resp.content)
+        self.assertEqual(["installing"], [e["state_name"] for e in data])
+
+    @mock.patch("cfy_wrapper.events.time.sleep")
+    def test_get_wait_limit(self, mock_sleep):
+        resp = self.client.get(self.url, dict(wait=30))
+
+        self.assertEqual([], json.loads(resp.content))
+        mock_sleep.assert_not_called()
+
+    def test_get_invalid_params(self):
+        for params in (dict(wait="x"), dict(wait=-1),
+                       dict(since_version="x")):
+            resp = self.client.get(self.url, params)
+            self.assertEqual(status.HTTP_400_BAD_REQUEST, resp.status_code)
+
+    def test_get_missing(self):
+        url = reverse("container_events",
+                      kwargs=dict(id="00000000-0000-0000-0000-000000000000"))
+        resp = self.client.get(url)
+        self.assertEqual(status.HTTP_404_NOT_FOUND, resp.status_code)
+
+    def test_stream(self):
+        e1 = self._event(Blueprint.State.uploading_to_cloudify)
+        e2 = self._event(Blueprint.State.preparing_deployment)
+
+        resp = self.client.get(self.url, HTTP_ACCEPT="text/event-stream",
+                               HTTP_LAST_EVENT_ID=str(e1.id))
+
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertTrue(resp["Content-Type"].startswith("text/event-stream"))
+        messages = b"".join(resp.streaming_content).split(b"\n\n")
+        self.assertEqual(b"retry: 500", messages[0])
+        lines = messages[1].split(b"\n")
+        self.assertEqual([b"id: " + str(e2.id).encode("utf-8"),
+                          b"event: state"], lines[:2])
+        data = json.loads(lines[2][len(b"data: "):])
+        self.assertEqual("preparing_deployment", data["state_name"])
+        self.assertEqual([b""], messages[2:])
+
+    def test_stream_missing(self):
+        url = reverse("container_events",
+                      kwargs=dict(id="00000000-0000-0000-0000-000000000000"))
+        resp = self.client.get(url, HTTP_ACCEPT="text/event-stream")
+        self.assertEqual(status.HTTP_404_NOT_FOUND, resp.status_code)
+        self.assertTrue(resp.content.startswith(b"event: error\n"))
+
+
+@override_settings(EVENT_MAX_WAIT=0)
+class EventsTest(BaseViewTest):
+
+    def test_not_auth(self):
+        req = self.get(reverse("events"), auth=False)
+        resp = EventsView.as_view()(req)
+        self.assertEqual(status.HTTP_401_UNAUTHORIZED, resp.status_code)
+
+    def test_get_since_version(self):
+        c1 = Container.objects.create()
+        c2 = Container.objects.create()
+        first = Event.objects.create(container=c1, busy=False)
+        Event.objects.create(container=c1, busy=True)
+        Event.objects.create(container=c2, busy=True)
+
+        resp = self.client.get(reverse("events"),
+                               dict(since_version=first.id))
+
+        data = json.loads(resp.content)
+        self.assertEqual([c1.cfy_id, c2.cfy_id],
+                         [e["container"] for e in data])
+
+    def test_get_continues_from_version(self):
+        c = Container.objects.create()
+        Event.objects.create(container=c, busy=False)
+        resp = self.client.get(reverse("events"))
+        self.assertEqual([], json.loads(resp.content))
+
+        # Recorded between two requests that returned no events
+        e = Event.objects.create(container=c, busy=True)
+        resp = self.client.get(reverse("events"),
+                               dict(since_version=resp["X-Events-Version"]))
+
+        self.assertEqual([e.id], [x["version"] for x in
+                                  json.loads(resp.content)])
+
+
+class BatchDeployTest(BaseViewTest):
+
+    def _post(self, data, query=""):
+        req = self.post(reverse("batch_deploy") + query, data=data,
+                        auth=True, format="multipart")
+        return BatchDeployView.as_view()(req)
+
+    def test_not_auth(self):
+        req = self.post(reverse("batch_deploy"), data={}, auth=False)
+        resp = BatchDeployView.as_view()(req)
+        self.assertEqual(status.HTTP_401_UNAUTHORIZED, resp.status_code)
+
+    @mock.patch("cfy_wrapper.tasks.sync_container", return_value=(True, "OK"))
+    def test_post(self, mock_sync):
+        c1 = Container.objects.create()
+        c2 = Container.objects.create()
+        data = {"file": io.StringIO(u"valid: yaml"), "key": "value",
+                "containers": "{},{}".format(c1.id, c2.id)}
+
+        resp = self._post(data, "?register_app=true")
+
+        self.assertEqual(status.HTTP_202_ACCEPTED, resp.status_code)
+        self.assertEqual([c1.cfy_id, c2.cfy_id],
+                         [r["container"] for r in resp.data])
+        b1, b2 = [c[1][1] for c in mock_sync.mock_calls]
+        self.assertEqual([b1.cfy_id, b2.cfy_id],
+                         [r["blueprint"]["id"] for r in resp.data])
+        self.assertNotEqual(b1.id, b2.id)
+        # Upload is ingested by the first deploy, second one gets a copy
+        self.assertTrue(b1.is_pending)
+        self.assertTrue(os.path.isfile(b1.upload_path))
+        self.assertTrue(b2.is_pending)
+        self.assertEqual(b1, b2.source)
+        for b in (b1, b2):
+            self.assertEqual({"key": "value"},
+                             {m.key: m.value for m in b.metadata.all()})
+        self.assertEqual([True, True],
+                         [c[1][2] for c in mock_sync.mock_calls])
+
+    @mock.patch.object(Blueprint, "store_content")
+    @mock.patch.object(Blueprint, "store_upload",
+                       autospec=True, side_effect=Blueprint.store_upload)
+    @mock.patch("cfy_wrapper.tasks.sync_container", return_value=(True, "OK"))
+    def test_post_stores_upload_once(self, mock_sync, mock_upload,
+                                     mock_store):
+        ids = [Container.objects.create().cfy_id for _ in range(3)]
+        data = {"file": io.StringIO(u"valid: yaml"), "containers": ids}
+
+        self._post(data)
+
+        mock_upload.assert_called_once()
+        mock_store.assert_not_called()
+        self.assertEqual(3, Blueprint.objects.count())
+
+    @mock.patch("cfy_wrapper.tasks.sync_container")
+    def test_post_partial(self, mock_sync):
+        c1 = Container.objects.create()
+        c2 = Container.objects.create()
+        mock_sync.side_effect = [(False, "busy"), (True, "OK")]
+        data = {"file": io.StringIO(u"valid: yaml"),
+                "containers": [c1.cfy_id, "missing", c2.cfy_id]}
+
+        resp = self._post(data)
+
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertEqual([409, 404, 202], [r["status"] for r in resp.data])
+        self.assertEqual("busy", resp.data[0]["detail"])
+        # Blueprint of failed deploy is reused for the next container
+        self.assertEqual(1, Blueprint.objects.count())
+
+    @mock.patch("cfy_wrapper.tasks.sync_container", return_value=(False, ""))
+    def test_post_all_failed(self, mock_sync):
+        c = Container.objects.create()
+        data = {"file": io.StringIO(u"valid: yaml"), "containers": c.cfy_id}
+
+        resp = self._post(data)
+
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertEqual(0, Blueprint.objects.count())
+        self.assertEqual([], os.listdir(os.path.join(self.wd.path,
+                                                     "incoming")))
+
+    @mock.patch("cfy_wrapper.tasks.sync_container", return_value=(True, "OK"))
+    def test_post_invalid(self, mock_sync):
+        c = Container.objects.create()
+        for data in ({"file": io.StringIO(u"valid: yaml")},
+                     {"containers": c.cfy_id}):
+            resp = self._post(data)
+            self.assertEqual(status.HTTP_400_BAD_REQUEST, resp.status_code)
+
+        self.assertEqual(0, Blueprint.objects.count())
+        mock_sync.assert_not_called()
+
+
+class BatchTeardownTest(BaseViewTest):
+
+    def _post(self, data):
+        req = self.post(reverse("batch_teardown"), data=data, auth=True)
+        return BatchTeardownView.as_view()(req)
+
+    def test_not_auth(self):
+        req = self.post(reverse("batch_teardown"), data={}, auth=False)
+        resp = BatchTeardownView.as_view()(req)
+        self.assertEqual(status.HTTP_401_UNAUTHORIZED, resp.status_code)
+
+    @mock.patch("cfy_wrapper.tasks.sync_container", return_value=(True, "OK"))
+    def test_post(self, mock_sync):
+        containers = [Container.objects.create(
+            blueprint=Blueprint.objects.create()
+        ) for _ in range(2)]
+
+        # User, containers with blueprints and their errors
+        with self.assertNumQueries(3):
+            resp = self._post({"containers": [c.cfy_id for c in containers]})
+
+        self.assertEqual(status.HTTP_202_ACCEPTED, resp.status_code)
+        self.assertEqual([c.blueprint.cfy_id for c in containers],
+                         [r["blueprint"]["id"] for r in resp.data])
+        self.assertEqual(containers, [c[1][0] for c in mock_sync.mock_calls])
+        for call in mock_sync.mock_calls:
+            self.assertEqual((None, False), call[1][1:])
+
+    @mock.patch("cfy_wrapper.tasks.sync_container", return_value=(False, "x"))
+    def test_post_partial(self, mock_sync):
+        c1 = Container.objects.create(blueprint=Blueprint.objects.create())
+        c2 = Container.objects.create()
+
+        resp = self._post({"containers": [c1.cfy_id, c2.cfy_id, "bad"]})
+
+        self.assertEqual(status.HTTP_200_OK, resp.status_code)
+        self.assertEqual([409, 400, 404], [r["status"] for r in resp.data])
+
+    def test_post_invalid(self):
+        for data in ({}, {"containers": []}, {"containers": "abc"},
+                     {"containers": [1]}):
+            resp = self._post(data)
+            self.assertEqual(status.HTTP_400_BAD_REQUEST, resp.status_code)
@@ -0,0 +1,85 @@
+import collections
+
+"""
+Assembly of deployment topology: list of VMs, each with a list of types of
+components that are installed onto it.
+
+Node instances are fetched from Cloudify Manager one page at a time and
+processed as they arrive, so large deployments never need to be held in
+memory as a whole. Apart from the Cloudify client that is passed in, this
+module has no dependencies, which makes it usable from command line tools.
+"""
+
+PAGE_SIZE = 1000
+
+
+def iter_pages(list_func, page_size=PAGE_SIZE, **kwargs):
+    """
+    Iterate over all items that paginated Cloudify list call returns. Pages
+    are requested lazily, one by one.
+    """
+    offset = 0
+    while True:
+        page = list_func(_offset=offset, _size=page_size, **kwargs)
+        for item in page:
+            yield item
+        if len(page) < page_size:
+            return
+        offset += len(page)
+
+
+class TopologyBuilder(object):
+    """
+    Incremental topology builder.
+
+    Instances can be added in any order. Components whose host has not been
+    added yet are kept aside until the host arrives and components of hosts
+    that never arrive are ignored.
+
+    :param node_types: mapping from node id to node type
+    """
+
+    def __init__(self, node_types):
+        self.node_types = node_types
+        self.hosts = {}  # Host id -> VM
+        self.pending = collections.defaultdict(list)  # Host id -> components
+
+    def add(self, instance):
+        host_id = instance.host_id
+        if host_id is None:
+            return
+
+        if instance.id == host_id:
+            self.hosts[host_id] = dict(
+                id=instance.id, node_id=instance.node_id,
+                ip=instance.runtime_properties.get("ip"),
+                components=self.pending.pop(host_id, []),
+            )
+
+        component = self.node_types.get(instance.node_id)
+        vm = self.hosts.get(host_id)
+        if vm is None:
+            self.pending[host_id].append(component)
+        else:
+            vm["components"].append(component)
+
+    @property
+    def vms(self):
+        return list(self.hosts.values())
+
+
+def build(client, deployment_id, page_size=PAGE_SIZE):
+    """
+    Build topology of selected deployment using Cloudify client.
+    """
+    nodes = iter_pages(client.nodes.list, page_size,
+                       deployment_id=deployment_id, _include=["id", "type"])
+    builder = TopologyBuilder({n.id: n.type for n in nodes})
+
+    instances = iter_pages(
+        client.node_instances.list, page_size, deployment_id=deployment_id,
+        _include=["id", "node_id", "host_id", "runtime_properties"]
+    )
+    for instance in instances:
+        builder.add(instance)
+    return builder.vms
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+"""
+Upload handlers that are used by the service (see FILE_UPLOAD_HANDLERS).
+"""
+
+
+class MaxSizeUploadHandler(FileUploadHandler):
+    """
+    Upload handler that stops the upload as soon as uploaded file exceeds
+    BLUEPRINT_MAX_UPLOAD_SIZE, before the rest of it reaches the disk.
+
+    Requests that declare too large body are rejected by views before
+    parsing, so this handler only catches uploads of unknown size. It must
+    be listed before handlers that actually store the data. Request is
+    marked with upload_too_large attribute when the upload is stopped.
+    """
+
+    def receive_data_chunk(self, raw_data, start):
+        max_size = settings.BLUEPRINT_MAX_UPLOAD_SIZE
+        if max_size is not None and start + len(raw_data) > max_size:
+            self.request.upload_too_large = True
+            raise StopUpload(connection_reset=False)
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
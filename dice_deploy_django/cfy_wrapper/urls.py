@@ -10,6 +10,12 @@ from .views import (
     ContainerBlueprintView,
     ContainerNodesView,
     ContainerErrorsView,
+    ContainerEventsView,
+
+    BatchDeployView,
+    BatchTeardownView,
+
+    EventsView,
 
     InputsView,
 
@@ -38,6 +44,18 @@ urlpatterns = [
         ContainerNodesView.as_view(), name="container_nodes"),
     url(r"^containers/(?P<id>[0-9a-f-]+)/errors/?$",
         ContainerErrorsView.as_view(), name="container_errors"),
+    url(r"^containers/(?P<id>[0-9a-f-]+)/events/?$",
+        ContainerEventsView.as_view(), name="container_events"),
+
+    # Batch operations
+    url(r"^batch/deploy/?$",
+        BatchDeployView.as_view(), name="batch_deploy"),
+    url(r"^batch/teardown/?$",
+        BatchTeardownView.as_view(), name="batch_teardown"),
+
+    # Events
+    url(r"^events/?$",
+        EventsView.as_view(), name="events"),
 
     # Inputs
     url(r"^inputs/?$",
@@ -1,91 +1,396 @@
-from cloudify_rest_client.client import CloudifyClient
+from cloudify_rest_client.client import (
+    CloudifyClient, HTTPClient, DEFAULT_API_VERSION, DEFAULT_PROTOCOL
+)
 from django.conf import settings
 
+from .import_cache import CachingImportResolver
+
+from multiprocessing.pool import ThreadPool
+
+import collections
+import contextlib
+import threading
+import functools
 import tarfile
+import hashlib
+import tempfile
 import base64
+import shutil
+import gzip
+import io
+import fcntl
 import stat
 import os
 
+import requests
+
 FILE_PERMISSIONS = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
 FOLDER_PERMISSIONS = (FILE_PERMISSIONS |
                       stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+HASH_CHUNK_SIZE = 64 * 1024
+EXTRACT_CHUNK_SIZE = 64 * 1024
+ARCHIVE_BLOCK_SIZE = 1024 ** 2
 
 
-def extract_archive(archive, destination):
+def extract_archive(archive, destination, max_size=None, max_members=None):
     """
-    Extract arhive contents while removing toplevel prefix. If this is not
-    really an archive, return False and Error message, else True.
+    Extract arhive contents while removing toplevel prefix. Returns True and
+    message on success, False and error message if archive is rejected and
+    None and message if this is not really an archive.
+
+    Archive is processed in a single pass: each member is validated and
+    written to disk (with final permissions) before next member is read.
+    If any check fails, content that has already been extracted is removed.
 
     Safety checks:
-     - make sure that no file contains full path
+     - make sure that no file contains full path or parent references
      - make sure there are onyl files and dirs in tarball
      - each component must be in some subfolder
      - there is only one toplevel folder
+     - extracted size and number of members are within limits (if set)
     """
     assert os.path.isdir(destination), "Destination folder is missing"
 
     try:
-        with tarfile.open(fileobj=archive) as tar:
-            members = []
-            toplevel = None
-            for member in tar.getmembers():
-                path = os.path.normpath(member.name).split(os.sep)
-                if path[0] == "":
-                    return False, "Absolute path in tarball"
-                if not (member.isdir() or member.isfile()):
-                    return False, "Tarball can only contain files and folders"
-                if len(path) == 1 and member.isfile():
-                    return False, "Tarbal must have toplevel folder"
-                if toplevel is None and member.isdir():
-                    toplevel = path[0]
-                if toplevel is not None and toplevel != path[0]:
-                    return False, "More than one toplevel folder in tarball"
-                member.name = os.sep.join(path[1:])
-                members.append(member)
-
-            # If we came here, tarball is ready to be extracted
-            for member in members:
-                tar.extract(member, destination)
-            change_permissions(destination, FOLDER_PERMISSIONS,
-                               FILE_PERMISSIONS)
-            return True, "All OK"
+        tar = tarfile.open(fileobj=archive)
+    except tarfile.TarError:
+        return None, "Not a tarball"
+
+    extractor = _StreamingExtractor(destination, max_size, max_members)
+    try:
+        with tar:
+            # Iterating over tar reads member headers on demand, as opposed
+            # to getmembers() that scans complete archive upfront.
+            for member in tar:
+                extractor.extract(tar, member)
+            extractor.finish()
+        os.chmod(destination, FOLDER_PERMISSIONS)
+        return True, "All OK"
+    except _ArchiveError as e:
+        extractor.cleanup()
+        return False, str(e)
     except:
+        extractor.cleanup()
         return False, "Invalid tarball"
 
 
-def change_permissions(root, folder_permissions, file_permissions):
+class _ArchiveError(Exception):
+    pass
+
+
+class _StreamingExtractor(object):
+
+    def __init__(self, destination, max_size, max_members):
+        self.destination = destination
+        self.max_size = max_size
+        self.max_members = max_members
+        self.toplevel = None
+        self.size = 0
+        self.members = 0
+        self.folders = {""}  # Relative paths of folders that already exist
+        self.created = set()  # Toplevel paths that need removal on failure
+
+    def extract(self, tar, member):
+        path = self._validate(member)
+        if len(path) == 0:
+            return  # Toplevel folder maps to destination
+
+        self._ensure_folder(path[:-1])
+        target = os.path.join(self.destination, *path)
+        if member.isdir():
+            self._ensure_folder(path)
+        else:
+            source = tar.extractfile(member)
+            fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         FILE_PERMISSIONS)
+            self.created.add(path[0])
+            with os.fdopen(fd, "wb") as f:
+                os.fchmod(f.fileno(), FILE_PERMISSIONS)
+                shutil.copyfileobj(source, f, EXTRACT_CHUNK_SIZE)
+
+    def finish(self):
+        if self.members == 0:
+            raise _ArchiveError("Tarball is empty")
+
+    def cleanup(self):
+        for name in self.created:
+            path = os.path.join(self.destination, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def _validate(self, member):
+        self.members += 1
+        if self.max_members is not None and self.members > self.max_members:
+            raise _ArchiveError("Too many members in tarball")
+        self.size += member.size
+        if self.max_size is not None and self.size > self.max_size:
+            raise _ArchiveError("Tarball content is too large")
+
+        path = os.path.normpath(member.name).split(os.sep)
+        if path[0] == "":
+            raise _ArchiveError("Absolute path in tarball")
+        if ".." in path:
+            raise _ArchiveError("Parent reference in tarball")
+        if not (member.isdir() or member.isfile()):
+            raise _ArchiveError("Tarball can only contain files and folders")
+        if len(path) == 1 and member.isfile():
+            raise _ArchiveError("Tarbal must have toplevel folder")
+        if self.toplevel is None:
+            self.toplevel = path[0]
+        if self.toplevel != path[0]:
+            raise _ArchiveError("More than one toplevel folder in tarball")
+        return path[1:]
+
+    def _ensure_folder(self, path):
+        for i in range(1, len(path) + 1):
+            rel = os.sep.join(path[:i])
+            if rel in self.folders:
+                continue
+            folder = os.path.join(self.destination, rel)
+            if not os.path.isdir(folder):
+                os.mkdir(folder, FOLDER_PERMISSIONS)
+                self.created.add(path[0])
+            os.chmod(folder, FOLDER_PERMISSIONS)
+            self.folders.add(rel)
+
+
+def _gzip_block(data, level):
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=level,
+                       mtime=0) as gz:
+        gz.write(data)
+    return buffer.getvalue()
+
+
+class _ParallelGzipWriter(object):
     """
-    Recursively change root's permissions. This also changes the permissions
-    of folder that has been passed in.
+    File-like object that compresses data in blocks using a pool of threads
+    (zlib releases GIL while compressing). Each block is written as separate
+    gzip member. Concatenated members form a valid gzip stream that standard
+    tools (and tarfile) read as a single file.
+    """
+
+    def __init__(self, fileobj, level, threads):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = threads
+        self.pool = ThreadPool(threads)
+        self.pending = collections.deque()
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= ARCHIVE_BLOCK_SIZE:
+            self._submit()
+
+    def _submit(self):
+        data = b"".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.pending.append(
+            self.pool.apply_async(_gzip_block, (data, self.level))
+        )
+        # Limit number of blocks that are kept in memory
+        while len(self.pending) > 2 * self.threads:
+            self.fileobj.write(self.pending.popleft().get())
 
-    :param root: full path to folder
-    :param file_permissions: permissions that will be set on files
-    :param folder_permissions: permissions that will be set on folders
+    def finish(self):
+        if self.buffered > 0:
+            self._submit()
+        while len(self.pending) > 0:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def close(self):
+        self.pool.terminate()
+
+
+def create_archive(archive, folder, level=9, threads=1):
     """
-    assert os.path.isdir(root)
+    Create tar.gz archive of selected folder. Archive is created under
+    temporary name and renamed when complete, so readers never see partially
+    written archive.
 
-    for prefix, folders, files in os.walk(root, topdown=False):
-        for file in files:
-            os.chmod(os.path.join(prefix, file), file_permissions)
-        for folder in folders:
-            os.chmod(os.path.join(prefix, folder), folder_permissions)
-    os.chmod(root, folder_permissions)
+    Compression level 0 produces uncompressed gzip stream, which is useful
+    when network is faster than compression. If more than one thread is
+    requested, data is compressed in parallel.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(archive))
+    os.close(fd)
+    try:
+        if threads > 1:
+            with open(tmp, "wb") as f:
+                gz = _ParallelGzipWriter(f, level, threads)
+                try:
+                    with tarfile.open(fileobj=gz, mode="w|") as tar:
+                        tar.add(folder, arcname=os.path.basename(folder))
+                    gz.finish()
+                finally:
+                    gz.close()
+        else:
+            with tarfile.open(tmp, "w:gz", compresslevel=level) as tar:
+                tar.add(folder, arcname=os.path.basename(folder))
+        os.chmod(tmp, FILE_PERMISSIONS)
+        os.rename(tmp, archive)
+    except Exception:
+        os.unlink(tmp)
+        raise
 
 
-def create_archive(archive, folder):
+def create_folder(folder):
     """
-    Create tar.gz archive of selected folder.
+    Create folder (and any missing parents) if it does not exist yet.
     """
-    with tarfile.open(archive, "w:gz") as tar:
-        tar.add(folder, arcname=os.path.basename(folder))
+    try:
+        os.makedirs(folder)
+    except OSError:
+        if not os.path.isdir(folder):
+            raise
+
+
+@contextlib.contextmanager
+def content_lock():
+    """
+    Exclusive lock that serializes storing and removal of shared content
+    across threads and processes (web and celery workers) that use the same
+    MEDIA_ROOT.
+    """
+    create_folder(settings.MEDIA_ROOT)
+    path = os.path.join(settings.MEDIA_ROOT, "content.lock")
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def hash_folder(folder):
+    """
+    Compute sha256 digest of folder contents. Digest covers relative paths
+    and contents of all files in folder, so renaming a file also changes it.
+    Missing folder is treated as an empty one.
+    """
+    digest = hashlib.sha256()
+    for prefix, folders, files in os.walk(folder):
+        folders.sort()
+        for name in sorted(files):
+            path = os.path.join(prefix, name)
+            digest.update(os.path.relpath(path, folder).encode("utf-8"))
+            digest.update(b"\0")
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+            digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class _SessionHTTPClient(HTTPClient):
+    """
+    HTTP client that sends all requests through requests session.
+    """
+
+    def __init__(self, session, timeout, *args, **kwargs):
+        super(_SessionHTTPClient, self).__init__(*args, **kwargs)
+        self.session = session
+        self.timeout = timeout
+
+    def _do_request(self, requests_method, **kwargs):
+        method = getattr(self.session, requests_method.__name__)
+        return super(_SessionHTTPClient, self)._do_request(
+            requests_method=functools.partial(method, timeout=self.timeout),
+            **kwargs
+        )
+
+
+class PooledCloudifyClient(CloudifyClient):
+    """
+    Cloudify client that keeps connections to manager alive in session's
+    connection pool.
+    """
+
+    def __init__(self, session, timeout=None, protocol=DEFAULT_PROTOCOL,
+                 api_version=DEFAULT_API_VERSION, **kwargs):
+        super(PooledCloudifyClient, self).__init__(
+            protocol=protocol, api_version=api_version, **kwargs
+        )
+        # Base class creates plain HTTP client and hands it to all sub-clients
+        # (blueprints, deployments, deployments.outputs, ...), so we replace
+        # it everywhere with session aware client that uses the same
+        # connection settings.
+        plain = self._client
+        self._client = _SessionHTTPClient(
+            session, timeout, plain.host, plain.port, protocol, api_version,
+            plain.headers, plain.query_params, plain.cert, plain.trust_all
+        )
+        self._replace_http_client(self, plain)
+
+    def _replace_http_client(self, obj, plain):
+        for name, value in vars(obj).items():
+            if value is plain:
+                setattr(obj, name, self._client)
+            elif type(value).__module__.startswith("cloudify_rest_client."):
+                self._replace_http_client(value, plain)
+
+
+_cfy_clients = {}  # Process id -> client
+_cfy_clients_lock = threading.Lock()
 
 
 def get_cfy_client():
+    """
+    Get Cloudify client that is shared by all code in current process.
+
+    Pooled connections must not be shared between processes, so each process
+    (celery prefork children included) lazily creates its own client and
+    ignores the one it inherited from its parent.
+    """
+    pid = os.getpid()
+    client = _cfy_clients.get(pid)
+    if client is None:
+        with _cfy_clients_lock:
+            client = _cfy_clients.get(pid)
+            if client is None:
+                _cfy_clients.clear()
+                client = _cfy_clients[pid] = _create_cfy_client()
+    return client
+
+
+def _create_cfy_client():
     creds = "{}:{}".format(settings.CFY_MANAGER_USERNAME,
                            settings.CFY_MANAGER_PASSWORD)
     creds_enc = base64.urlsafe_b64encode(creds.encode("utf-8"))
     headers = {"Authorization": "Basic {}".format(creds_enc)}
-    return CloudifyClient(host=settings.CFY_MANAGER_URL,
-                          protocol=settings.CFY_MANAGER_PROTOCOL,
-                          cert=settings.CFY_MANAGER_CACERT,
-                          headers=headers)
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=settings.CFY_MANAGER_POOL_SIZE
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    timeout = (settings.CFY_MANAGER_CONNECT_TIMEOUT,
+               settings.CFY_MANAGER_READ_TIMEOUT)
+
+    return PooledCloudifyClient(session, timeout,
+                                host=settings.CFY_MANAGER_URL,
+                                protocol=settings.CFY_MANAGER_PROTOCOL,
+                                cert=settings.CFY_MANAGER_CACERT,
+                                headers=headers)
+
+
+def get_import_resolver(ttl=None):
+    """
+    Create DSL parser import resolver that uses service's import cache.
+    Pass ttl to override configured time-to-live of cached imports.
+    """
+    return CachingImportResolver(
+        settings.IMPORT_CACHE_ROOT,
+        ttl=settings.IMPORT_CACHE_TTL if ttl is None else ttl,
+        offline=settings.IMPORT_CACHE_OFFLINE,
+    )
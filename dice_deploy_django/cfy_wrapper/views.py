@@ -1,4 +1,7 @@
+import collections
+import hashlib
 import logging
+import uuid
 
 from rest_framework_swagger.renderers import SwaggerUIRenderer
 
@@ -7,25 +10,267 @@ from rest_framework.authtoken.serializers import AuthTokenSerializer
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny
+from rest_framework.renderers import JSONRenderer
+from rest_framework.exceptions import ParseError
 from rest_framework import status
 
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db import IntegrityError, transaction
+from django.db.models import Count, Max
+from django.http import StreamingHttpResponse
+from django.utils import six
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 
+from . import events
 from . import tasks
+from . import topology
 from . import utils
-from .models import Blueprint, Container, Input, Metadata
+from .models import Blueprint, Container, Event, Input, Metadata
 from .serializers import (
     BlueprintSerializer,
     ContainerSerializer,
+    EventSerializer,
     InputSerializer,
     VMSerializer,
     ErrorSerializer,
 )
 from .api_docs import OpenAPIRenderer, get_api_reference
+from .pagination import LinkHeaderCursorPagination
 
 logger = logging.getLogger("views")
 
 
+def _get_fields(request, serializer_class):
+    """
+    Parse fields query parameter (comma separated list of field names).
+    Returns None if all fields should be serialized.
+    """
+    fields = request.query_params.get("fields")
+    if fields is None:
+        return None
+
+    fields = [f for f in fields.split(",") if f]
+    unknown = set(fields) - set(serializer_class.Meta.fields)
+    if len(unknown) > 0:
+        msg = "Unknown field(s): {}".format(", ".join(sorted(unknown)))
+        raise ParseError(msg)
+    return fields
+
+
+def _filter_state(queryset, request, prefix=""):
+    """
+    Filter queryset using state and in_error query parameters. Use prefix to
+    filter over blueprint relation.
+    """
+    state = request.query_params.get("state")
+    if state is not None:
+        try:
+            value = Blueprint.State[state].value
+        except KeyError:
+            raise ParseError("Invalid state: {}".format(state))
+        queryset = queryset.filter(**{prefix + "state__in": (value, -value)})
+
+    in_error = request.query_params.get("in_error")
+    if in_error is not None:
+        if in_error not in ("true", "false"):
+            raise ParseError("Invalid in_error value: {}".format(in_error))
+        lookup = "state__lt" if in_error == "true" else "state__gt"
+        queryset = queryset.filter(**{prefix + lookup: 0})
+
+    return queryset
+
+
+def _etag(*parts):
+    """
+    Create entity tag from parts that identify the version of the resource.
+    """
+    data = ":".join(str(p) for p in parts).encode("utf-8")
+    return hashlib.sha1(data).hexdigest()
+
+
+def _get_containers(request):
+    containers = Container.objects.all()
+    container_id = request.query_params.get('id', None)
+    if container_id is not None:
+        containers = containers.filter(id=container_id)
+    return _filter_state(containers, request, "blueprint__")
+
+
+def _containers_etag(request):
+    """
+    Aggregate validator for container list. Any change to container bumps
+    its version and modification date, while any change to blueprint
+    (including new errors) bumps blueprint's modification date.
+
+    Versions are timestamps in microseconds, so they cannot be summed without
+    overflowing 64-bit integers once there are a few thousand containers.
+    """
+    aggregate = _get_containers(request).aggregate(
+        Count("id"), Max("version"), Max("modified_date"),
+        Max("blueprint__modified_date"),
+    )
+    return _etag(*sorted(aggregate.items()))
+
+
+def _container_etag(request, id):
+    try:
+        container = Container.objects.select_related("blueprint").only(
+            "version", "blueprint__modified_date"
+        ).get(id=id)
+    except (ValueError, ValidationError, Container.DoesNotExist):
+        return None  # View will report the error
+    blueprint = container.blueprint
+    return _etag(container.id, container.version,
+                 blueprint and blueprint.modified_date)
+
+
+def _blueprints_etag(request):
+    aggregate = _filter_state(Blueprint.objects.all(), request).aggregate(
+        Count("id"), Max("modified_date"),
+    )
+    return _etag(*sorted(aggregate.items()))
+
+
+def _blueprint_etag(request, blueprint_id):
+    try:
+        blueprint = Blueprint.objects.only("modified_date").get(
+            id=blueprint_id
+        )
+    except (ValueError, ValidationError, Blueprint.DoesNotExist):
+        return None  # View will report the error
+    return _etag(blueprint.id, blueprint.modified_date)
+
+
+def _get_upload(request):
+    """
+    Get uploaded file or response that describes the problem with upload.
+    """
+    too_large = Response({"detail": "Uploaded file is too large"},
+                         status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    # Check declared size before request body is parsed and stored, uploads
+    # of unknown size are stopped by MaxSizeUploadHandler.
+    max_size = settings.BLUEPRINT_MAX_UPLOAD_SIZE
+    try:
+        content_length = int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        content_length = 0
+    if max_size is not None and content_length > max_size:
+        return too_large
+
+    try:
+        upload = request.data["file"]
+    except KeyError:
+        if getattr(request, "upload_too_large", False):
+            return too_large
+        return Response({"detail": "No file uploaded"},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    if max_size is not None and upload.size > max_size:
+        return too_large
+    return upload
+
+
+def _store_metadata(blueprint, request, exclude):
+    metadata = [Metadata(key=k, value=v, blueprint=blueprint)
+                for k, v in request.data.items() if k not in exclude]
+    Metadata.objects.bulk_create(metadata)
+
+
+def _get_register_app(request):
+    register_param = request.query_params.get("register_app", "")
+    return register_param.lower() == "true"
+
+
+def _get_batch_containers(request):
+    """
+    Parse list of container ids from request (repeated or comma separated
+    containers field). Returns ordered mapping from id to container, where
+    missing containers are mapped to None.
+    """
+    if hasattr(request.data, "getlist"):
+        values = request.data.getlist("containers")
+    else:
+        values = request.data.get("containers", [])
+    if not (isinstance(values, list) and
+            all(isinstance(v, six.string_types) for v in values)):
+        raise ParseError("Containers should be a list of ids")
+
+    containers = collections.OrderedDict(
+        (i.strip(), None) for v in values for i in v.split(",") if i.strip()
+    )
+    if len(containers) == 0:
+        raise ParseError("No containers listed")
+
+    ids = {}
+    for id in containers:
+        try:
+            ids[uuid.UUID(id)] = id
+        except ValueError:
+            pass  # Reported as missing container
+    for container in Container.objects.filter(id__in=ids).with_blueprint():
+        containers[ids[container.id]] = container
+    return containers
+
+
+def _batch_result(id, code, **kwargs):
+    return dict(container=id, status=code, **kwargs)
+
+
+def _batch_response(results):
+    """
+    Batch request is accepted only if all containers accepted it. Otherwise,
+    results should be inspected by client.
+    """
+    if all(r["status"] == status.HTTP_202_ACCEPTED for r in results):
+        return Response(results, status=status.HTTP_202_ACCEPTED)
+    return Response(results, status=status.HTTP_200_OK)
+
+
+def _list_response(view, queryset, serializer_class, ordering, fields):
+    """
+    Create response with serialized queryset items. If client requested
+    selected fields only, only model fields that are needed are loaded. If
+    client requested pagination, only current page is loaded.
+    """
+    if fields is not None:
+        model_fields = serializer_class.get_model_fields(fields)
+        model_fields.update(("pk", ordering.lstrip("-")))
+        queryset = queryset.only(*model_fields)
+
+    paginator = LinkHeaderCursorPagination(ordering)
+    page = paginator.paginate_queryset(queryset, view.request, view=view)
+    if page is None:
+        s = serializer_class(queryset, many=True, fields=fields)
+        return Response(s.data)
+
+    s = serializer_class(page, many=True, fields=fields)
+    return paginator.get_paginated_response(s.data)
+
+
+def _events_response(request, queryset):
+    """
+    Create response with events that are newer than the version client
+    knows about. Events are streamed if client requested event stream.
+    """
+    since = events.get_since_version(request)
+    if request.accepted_renderer.format == events.EventStreamRenderer.format:
+        response = StreamingHttpResponse(
+            events.stream_events(queryset, since),
+            content_type=events.EventStreamRenderer.media_type,
+        )
+        response["Cache-Control"] = "no-cache"
+        return response
+
+    found, version = events.wait_for_events(queryset, since,
+                                            events.get_wait(request))
+    response = Response(EventSerializer(found, many=True).data)
+    response[events.VERSION_HEADER] = version
+    return response
+
+
 class APIDocView(APIView):
 
     permission_classes = (AllowAny,)
@@ -49,13 +294,14 @@ class HeartBeatView(APIView):
 
 class ContainersView(APIView):
 
+    @method_decorator(condition(etag_func=_containers_etag))
     def get(self, request):
-        containers = Container.objects.all()
-        container_id = self.request.query_params.get('id', None)
-        if container_id is not None:
-            containers = containers.filter(id=container_id)
-        s = ContainerSerializer(containers, many=True)
-        return Response(data=s.data)
+        fields = _get_fields(request, ContainerSerializer)
+        containers = _get_containers(request)
+        if fields is None or "blueprint" in fields:
+            containers = containers.with_blueprint()
+        return _list_response(self, containers, ContainerSerializer,
+                              "created_date", fields)
 
     def post(self, request):
         """
@@ -69,6 +315,7 @@ class ContainersView(APIView):
 
 class ContainerIdView(APIView):
 
+    @method_decorator(condition(etag_func=_container_etag))
     def get(self, request, id):
         """
         Get container details.
@@ -92,6 +339,7 @@ class ContainerIdView(APIView):
 
 class ContainerBlueprintView(APIView):
 
+    @method_decorator(condition(etag_func=_container_etag))
     def get(self, request, id):
         """
         Show information about blueprint that is uploaded to container
@@ -104,31 +352,19 @@ class ContainerBlueprintView(APIView):
 
     def post(self, request, id):
         """
-        Upload blueprint to container and begin deployment flow.
+        Upload blueprint to container and begin deployment flow. Upload is
+        only stored here, it is extracted and validated by ingest task.
         """
         container = Container.get(id)
 
-        try:
-            upload = request.data["file"]
-        except KeyError:
-            return Response({"detail": "No file uploaded"},
-                            status=status.HTTP_400_BAD_REQUEST)
-
+        upload = _get_upload(request)
+        if isinstance(upload, Response):
+            return upload
         blueprint = Blueprint.objects.create()
-        blueprint.store_content(upload)
+        blueprint.store_upload(upload)
+        _store_metadata(blueprint, request, ("file",))
 
-        success, msg = blueprint.is_valid()
-        if not success:
-            blueprint.delete()
-            return Response({"detail": msg},
-                            status=status.HTTP_400_BAD_REQUEST)
-
-        metadata = [Metadata(key=k, value=v, blueprint=blueprint)
-                    for k, v in request.data.items() if k != "file"]
-        Metadata.objects.bulk_create(metadata)
-
-        register_param = request.query_params.get("register_app", "")
-        register_app = register_param.lower() == "true"
+        register_app = _get_register_app(request)
         success, msg = tasks.sync_container(container, blueprint, register_app)
 
         if not success:
@@ -163,36 +399,36 @@ class ContainerBlueprintView(APIView):
 
 class ContainerNodesView(APIView):
 
-    @staticmethod
-    def _gen_node(data):
-        return dict(id=data.id, node_id=data.node_id, components=[],
-                    ip=data.runtime_properties["ip"])
-
     def get(self, request, id):
         """
         List VMs that are running inside selected container. Each node also
         contains set of components that are installed onto it.
+
+        VMs are collected from Cloudify when deployment finishes. Pass
+        refresh=true query parameter to collect them again.
         """
         container = Container.get(id)
-        if container.blueprint is None:
+        blueprint = container.blueprint
+        if blueprint is None:
             return Response([])
 
-        client = utils.get_cfy_client()
-        nodes = client.nodes.list(container.blueprint.cfy_id)
-        instances = client.node_instances.list(container.blueprint.cfy_id)
-
-        node_types = {n.id: n.type for n in nodes}
-        vms = {i.id: self._gen_node(i) for i in instances if i.id == i.host_id}
-        for i in instances:
-            if i.host_id is not None:
-                vms[i.host_id]["components"].append(node_types[i.node_id])
-
-        s = VMSerializer(vms.values(), many=True)
+        refresh = request.query_params.get("refresh") == "true"
+        # Blueprints deployed before topology has been stored have none
+        missing = (blueprint.topology is None and
+                   blueprint.state == Blueprint.State.deployed)
+        if refresh or missing:
+            blueprint.topology = topology.build(
+                utils.get_cfy_client(), blueprint.cfy_id
+            )
+            blueprint.save(update_fields=["topology"])
+
+        s = VMSerializer(blueprint.topology or [], many=True)
         return Response(s.data)
 
 
 class ContainerErrorsView(APIView):
 
+    @method_decorator(condition(etag_func=_container_etag))
     def get(self, request, id):
         """
         Return errors for selected container.
@@ -200,8 +436,118 @@ class ContainerErrorsView(APIView):
         container = Container.get(id)
         if container.blueprint is None:
             return Response([])
-        errors = ErrorSerializer(container.blueprint.errors, many=True)
-        return Response(errors.data)
+        return _list_response(self, container.blueprint.errors.all(),
+                              ErrorSerializer, "created",
+                              _get_fields(request, ErrorSerializer))
+
+
+class ContainerEventsView(APIView):
+
+    renderer_classes = (JSONRenderer, events.EventStreamRenderer)
+
+    def get(self, request, id):
+        """
+        Wait for state events of selected container.
+        """
+        container = Container.get(id)
+        return _events_response(request, container.events.all())
+
+
+class EventsView(APIView):
+
+    renderer_classes = (JSONRenderer, events.EventStreamRenderer)
+
+    def get(self, request):
+        """
+        Wait for state events of all containers.
+        """
+        return _events_response(request, Event.objects.all())
+
+
+class BatchDeployView(APIView):
+
+    def post(self, request):
+        """
+        Upload blueprint once and deploy it to all listed containers. Upload
+        is only stored here, it is ingested once by the first container's
+        ingest task, other containers get copies of ingested blueprint.
+        """
+        containers = _get_batch_containers(request)
+
+        upload = _get_upload(request)
+        if isinstance(upload, Response):
+            return upload
+        blueprint = Blueprint.objects.create()
+        blueprint.store_upload(upload)
+
+        exclude = ("file", "containers")
+        _store_metadata(blueprint, request, exclude)
+
+        register_app = _get_register_app(request)
+        results = []
+        # First deploy uses uploaded blueprint, others use its copies
+        pending = blueprint
+        for id, container in containers.items():
+            if container is None:
+                results.append(_batch_result(
+                    id, status.HTTP_404_NOT_FOUND,
+                    detail="Container '{}' does not exist".format(id),
+                ))
+                continue
+
+            if pending is None:
+                pending = blueprint.copy()
+                _store_metadata(pending, request, exclude)
+            success, msg = tasks.sync_container(container, pending,
+                                                register_app)
+            if not success:
+                results.append(_batch_result(
+                    id, status.HTTP_409_CONFLICT, detail=msg
+                ))
+                continue
+
+            results.append(_batch_result(
+                id, status.HTTP_202_ACCEPTED,
+                blueprint=BlueprintSerializer(pending).data,
+            ))
+            pending = None
+
+        # Content is removed with the last blueprint that references it
+        if pending is not None:
+            pending.delete()
+        return _batch_response(results)
+
+
+class BatchTeardownView(APIView):
+
+    def post(self, request):
+        """
+        Undeploy blueprints from all listed containers.
+        """
+        results = []
+        for id, container in _get_batch_containers(request).items():
+            if container is None:
+                results.append(_batch_result(
+                    id, status.HTTP_404_NOT_FOUND,
+                    detail="Container '{}' does not exist".format(id),
+                ))
+            elif container.blueprint is None:
+                results.append(_batch_result(
+                    id, status.HTTP_400_BAD_REQUEST,
+                    detail="No blueprint present",
+                ))
+            else:
+                success, msg = tasks.sync_container(container, None, False)
+                if success:
+                    data = BlueprintSerializer(container.blueprint).data
+                    results.append(_batch_result(
+                        id, status.HTTP_202_ACCEPTED, blueprint=data
+                    ))
+                else:
+                    results.append(_batch_result(
+                        id, status.HTTP_409_CONFLICT, detail=msg
+                    ))
+        return _batch_response(results)
 
 
 class InputsView(APIView):
@@ -210,8 +556,8 @@ class InputsView(APIView):
         """
         List all available inputs.
         """
-        s = InputSerializer(Input.objects.all(), many=True)
-        return Response(s.data)
+        return _list_response(self, Input.objects.all(), InputSerializer,
+                              "key", _get_fields(request, InputSerializer))
 
     def post(self, request):
         """
@@ -254,13 +600,21 @@ class AuthTokenView(APIView):
 # Backwards compatibility API views
 class BlueprintsView(APIView):
 
+    @method_decorator(condition(etag_func=_blueprints_etag))
     def get(self, request):
-        s = BlueprintSerializer(Blueprint.objects.all(), many=True)
-        return Response(s.data)
+        fields = _get_fields(request, BlueprintSerializer)
+        # Large internal fields are never serialized
+        blueprints = Blueprint.objects.defer("declared_inputs", "topology")
+        if fields is None or "errors" in fields:
+            blueprints = blueprints.with_errors()
+        blueprints = _filter_state(blueprints, request)
+        return _list_response(self, blueprints, BlueprintSerializer,
+                              "created_date", fields)
 
 
 class BlueprintIdView(APIView):
 
+    @method_decorator(condition(etag_func=_blueprint_etag))
     def get(self, request, blueprint_id):
         s = BlueprintSerializer(Blueprint.get(blueprint_id))
         return Response(s.data)
@@ -206,13 +206,45 @@ app.controller('ContainersCtrl', function($scope, RestServices, PopupServices, F
     // PERIODIC
     //
     $scope.preventSync = false;
-    $interval(function(){
+    var sync = function(){
         if($rootScope.user && !$scope.preventSync){
             $scope.syncContainers($scope.embeddedMode ? $scope.embeddedMode.containerId : undefined);
         }else{
             console.log('Sync prevented');
         }
-
-    }, 10000);
+    };
+    // wait for container state events instead of polling; sync once more
+    // every minute in case some event was missed
+    var eventsVersion;
+    var eventsStopped = false;
+    var waitForEvents = function(){
+        if(eventsStopped){
+            return;
+        }
+        if(!$rootScope.user){
+            $timeout(waitForEvents, 10000);
+            return;
+        }
+        RestServices.events.query({wait: EVENT_WAIT, since_version: eventsVersion}, function(events, headers){
+            // continue from the version server reports even if no events were
+            // returned, so that events recorded between requests are not lost
+            var version = headers('X-Events-Version');
+            if(version){
+                eventsVersion = version;
+            }
+            if(events.length > 0){
+                sync();
+            }
+            waitForEvents();
+        }, function(){
+            $timeout(waitForEvents, 10000);
+        });
+    };
+    waitForEvents();
+    var fallback = $interval(sync, 60000);
+    $scope.$on('$destroy', function(){
+        eventsStopped = true;
+        $interval.cancel(fallback);
+    });
 
 });
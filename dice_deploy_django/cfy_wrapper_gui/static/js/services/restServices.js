@@ -7,6 +7,7 @@ app.factory('RestServices', function ($resource, $rootScope) {
             put: {method: 'PUT'}
         }),
         containerErrors: $resource(BASE_URL + '/containers/:id/errors', {'id': '@id'}, {}),
+        events: $resource(BASE_URL + '/events', {}, {}),
         blueprints: $resource(BASE_URL + '/blueprints', {}, {}),
         blueprint: $resource(BASE_URL + '/blueprints/:id', {'id': '@id'}, {}),
         output: $resource(BASE_URL + '/blueprints/:id/outputs', {'id': '@id'}, {})
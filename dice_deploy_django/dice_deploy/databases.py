@@ -0,0 +1,56 @@
+"""
+Database profiles that can be used in local settings.
+
+SQLite is the default, since it needs no setup, but all writers (web and
+celery workers) share a single database-wide lock. Installations that deploy
+into many containers concurrently should use PostgreSQL instead:
+
+    from dice_deploy.databases import postgresql
+    DATABASES = {
+        "default": postgresql("dice_deploy", "dice", "secret"),
+    }
+
+Both profiles keep connections open for conn_max_age seconds, which means
+that each web worker thread and each celery worker process reuses a single
+connection instead of connecting for each request or task. If connections
+need to be shared between processes, put a pooler (pgbouncer, for example)
+in front of PostgreSQL and point host and port to it.
+"""
+
+import os
+
+CONN_MAX_AGE = 600  # In seconds
+
+
+def sqlite(path, conn_max_age=CONN_MAX_AGE):
+    # Writers wait for database lock for timeout seconds before failing
+    # with "database is locked". Write-ahead log is enabled on connect (see
+    # cfy_wrapper.signals), which lets readers proceed during writes. Tests
+    # use a file next to the database instead of in-memory database, which
+    # cannot be shared between threads of concurrency tests.
+    folder, name = os.path.split(path)
+    return {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": path,
+        "CONN_MAX_AGE": conn_max_age,
+        "OPTIONS": {
+            "timeout": 20,
+        },
+        "TEST": {
+            "NAME": os.path.join(folder, "test_" + name),
+        },
+    }
+
+
+def postgresql(name, user, password, host="localhost", port=5432,
+               conn_max_age=CONN_MAX_AGE):
+    # Requires psycopg2 (see requirements-postgresql.txt)
+    return {
+        "ENGINE": "django.db.backends.postgresql",
+        "NAME": name,
+        "USER": user,
+        "PASSWORD": password,
+        "HOST": host,
+        "PORT": port,
+        "CONN_MAX_AGE": conn_max_age,
+    }
@@ -1,4 +1,5 @@
 #!/bin/bash
 
 kill -3 $(cat gunicorn.pid)
-celery multi stop main-worker@localhost
+kill $(cat celerybeat.pid)
+celery multi stop main-worker@localhost ingest-worker@localhost
@@ -4,10 +4,16 @@ function run()
 {
   # Start celery worker
   echo "Starting celery worker ..."
-  celery worker -A dice_deploy -Q dice_deploy -l debug --without-gossip \
+  celery worker -A dice_deploy -Q dice_deploy -l debug -B --without-gossip \
     --without-mingle --purge > celery-out.log 2> celery-err.log &
   local celery_pid=$!
 
+  # Start ingest worker that keeps upload validation away from deploys
+  celery worker -A dice_deploy -Q dice_deploy_ingest -n ingest@%h -l debug \
+    --without-gossip --without-mingle --purge \
+    > celery-ingest-out.log 2> celery-ingest-err.log &
+  local ingest_pid=$!
+
   # Start celery flower
   celery flower --port=5555 > flower-out.log 2> flower-err.log &
   local flower_pid=$!
@@ -20,6 +26,7 @@ function run()
   echo Cleaning up ...
   kill $flower_pid
   kill $celery_pid
+  kill $ingest_pid
 
   echo All done.
 }
@@ -29,7 +36,7 @@ function reset()
   SUPERUSER_UNAME="${1:-admin}"
   SUPERUSER_PASSWORD="${2:-changeme}"
   SUPERUSER_EMAIL="${3:-admin@example.com}"
-  rm -rf db.sqlite3 uploads cfy_wrapper/migrations
+  rm -rf db.sqlite3 db.sqlite3-wal db.sqlite3-shm test_db.sqlite3* uploads cfy_wrapper/migrations
   python manage.py makemigrations cfy_wrapper
   python manage.py migrate
   python manage.py create-dice-superuser \
@@ -51,6 +58,15 @@ function run_tests()
   set +e
 }
 
+function run_benchmarks()
+{
+  set -e
+  rm -rf cfy_wrapper/migrations
+  python manage.py makemigrations cfy_wrapper
+  python manage.py test --pattern="bench_*.py" ${1:-benchmarks}
+  set +e
+}
+
 case $1 in
   reset)
     reset "$2" "$3" "$4"
@@ -60,6 +76,10 @@ case $1 in
     run_tests "$2"
     ;;
 
+  bench)
+    run_benchmarks "$2"
+    ;;
+
   *)
     run
     ;;
@@ -77,6 +77,16 @@ class BaseTest(TestCase):
     def delete(suffix, auth):
         return BaseTest._request(requests.delete, suffix, auth)
 
+    def wait_for_events(self, container_url, since_version):
+        """
+        Wait for state events of container. Returns version of the last
+        received event or since_version if no event arrived in time.
+        """
+        url = "{}/events?wait=30&since_version={}".format(container_url,
+                                                          since_version)
+        events = self.get(url, True).json()
+        return events[-1]["version"] if events else since_version
+
     # Helpers for retrieving test data, generating (almost) unique names, etc.
     @staticmethod
     def get_blueprint(name):
@@ -1,7 +1,5 @@
 from base import BaseTest
 
-import time
-
 
 class BlueprintTest(BaseTest):
 
@@ -15,6 +13,8 @@ class BlueprintTest(BaseTest):
         container_url = "containers/{}".format(data["id"])
         blueprint_url = "{}/blueprint".format(container_url)
 
+        # Container is new, so all of its events are of interest
+        version = 0
         with open(blueprint, "rb") as f:
             resp = self.post(blueprint_url, True, files=dict(file=f))
 
@@ -23,7 +23,7 @@ class BlueprintTest(BaseTest):
 
         # Wait for blueprint to get from queue
         while self.fail_on_timeout():
-            time.sleep(3)
+            version = self.wait_for_events(container_url, version)
             resp = self.get(blueprint_url, True)
             if resp.status_code != 200:
                 continue
@@ -42,7 +42,7 @@ class BlueprintTest(BaseTest):
         self.assertEqual(202, resp.status_code)
 
         while self.fail_on_timeout():
-            time.sleep(3)
+            version = self.wait_for_events(container_url, version)
             resp = self.get(blueprint_url, True)
             if resp.status_code == 400:
                 break
@@ -63,6 +63,8 @@ class BlueprintTest(BaseTest):
         container_url = "containers/{}".format(data["id"])
         blueprint_url = "{}/blueprint".format(container_url)
 
+        # Container is new, so all of its events are of interest
+        version = 0
         with open(blueprint, "rb") as f:
             resp = self.post(blueprint_url, True, files=dict(file=f))
 
@@ -71,7 +73,7 @@ class BlueprintTest(BaseTest):
 
         # Wait for blueprint to get from queue
         while self.fail_on_timeout():
-            time.sleep(3)
+            version = self.wait_for_events(container_url, version)
             resp = self.get(blueprint_url, True)
             if resp.status_code != 200:
                 continue
@@ -9,9 +9,12 @@ import inspect
 import json
 import yaml
 import sys
+import os
 
 from dsl_parser import parser as cfy_parser
 
+IMPORT_CACHE_TTL = 24 * 60 * 60  # In seconds
+
 
 def _dump_json(data):
     return json.dumps(data, indent=2, separators=(",", ": "), sort_keys=True)
@@ -28,10 +31,31 @@ class ArgParser(argparse.ArgumentParser):
         sys.exit(2)
 
 
+def _get_resolver(cache, offline):
+    """
+    Create import resolver that stores remote imports into cache folder. We
+    share the implementation with deployment service, which is why the
+    service's folder is temporarily added to import path.
+    """
+    if cache is None:
+        return None
+
+    service = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "..", "dice_deploy_django")
+    sys.path.insert(0, service)
+    try:
+        from cfy_wrapper.import_cache import CachingImportResolver
+    finally:
+        sys.path.remove(service)
+    return CachingImportResolver(cache, ttl=IMPORT_CACHE_TTL,
+                                 offline=offline)
+
+
 class Command(object):
 
-    def __init__(self, blueprint):
-        self.blueprint = cfy_parser.parse_from_path(blueprint)
+    def __init__(self, blueprint, resolver=None):
+        self.blueprint = cfy_parser.parse_from_path(blueprint,
+                                                    resolver=resolver)
 
 
 class Inputs(Command):
@@ -212,6 +236,10 @@ def create_parser():
                 issubclass(item, Command))
 
     parser = ArgParser(description="Blueprint data extractor")
+    parser.add_argument("--import-cache", metavar="DIR",
+                        help="Cache remote blueprint imports in DIR")
+    parser.add_argument("--offline", action="store_true",
+                        help="Only use imports from cache")
     parser.add_argument("blueprint", help="Blueprint to inspect")
     subparsers = parser.add_subparsers()
 
@@ -226,7 +254,10 @@ def create_parser():
 def main():
     parser = create_parser()
     args = parser.parse_args()
-    cmd = args.cls(args.blueprint)
+    if args.offline and args.import_cache is None:
+        parser.error("--offline requires --import-cache")
+    resolver = _get_resolver(args.import_cache, args.offline)
+    cmd = args.cls(args.blueprint, resolver)
     cmd.execute(args)
 
 